@@ -8,10 +8,55 @@ import LoadingIndicator from "./LoadingIndicator";
 import logo from "../../img/logo.png";
 
 const API_URL = "http://localhost:9100/askcityhub";
+const STREAM_API_URL = `${API_URL}/stream`;
 // const API_URL =
 //   "https://8f4b-2601-645-c600-65a6-b0b0-49c1-8d55-feac.ngrok-free.app";
 
 type ModelValueType = "gpt" | "codex" | "image";
+
+type StreamEventHandler = (event: string, data: any) => void;
+
+// POST the question and dispatch each Server-Sent Event from the response body.
+// EventSource only supports GET, so the stream is read and parsed manually.
+const streamCityHubAnswer = async (
+  question: string,
+  onEvent: StreamEventHandler
+) => {
+  const response = await fetch(STREAM_API_URL, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ question }),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Request failed with status code ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    const messages = buffer.split("\n\n");
+    buffer = messages.pop() ?? "";
+    for (const message of messages) {
+      let event = "message";
+      let data = "";
+      for (const line of message.split("\n")) {
+        if (line.startsWith("event:")) {
+          event = line.slice("event:".length).trim();
+        } else if (line.startsWith("data:")) {
+          data += line.slice("data:".length).trim();
+        }
+      }
+      onEvent(event, data ? JSON.parse(data) : {});
+    }
+  }
+};
+
 const App = () => {
   const [responseList, setResponseList] = useState<ResponseInterface[]>([
     // {
@@ -211,13 +256,26 @@ const App = () => {
     }
 
     try {
-      // Send a POST request to the API with the prompt in the request body
+      // Stream the answer from the API as it is generated
       console.log(_prompt);
-      const response = await axios.post(API_URL, {
-        question: _prompt,
-      });
-      updateResponse(uniqueId, {
-        response: response?.data?.trim(),
+      let answer = "";
+      await streamCityHubAnswer(_prompt, (event, data) => {
+        switch (event) {
+          case "generation_start":
+            // A re-generation replaces the previous partial answer
+            answer = "";
+            break;
+          case "token":
+            answer += data.token;
+            updateResponse(uniqueId, { response: answer });
+            break;
+          case "verification":
+            updateResponse(uniqueId, { verified: data.verified });
+            break;
+          case "done":
+            updateResponse(uniqueId, { response: data.answer?.trim() });
+            break;
+        }
       });
 
       setPromptToRetry(null);
@@ -61,6 +61,11 @@ const PromptResponseList: FC<PromptResponseListProps> = ({ responseList }) => {
                 }}
               />
             )}
+            {responseData.verified === false && (
+              <div className="unverified-response">
+                This answer could not be verified against CityHub's sources.
+              </div>
+            )}
           </div>
         </div>
       ))}
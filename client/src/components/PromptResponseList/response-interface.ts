@@ -3,5 +3,6 @@ export interface ResponseInterface {
   response?: string;
   selfFlag: boolean;
   error?: boolean;
+  verified?: boolean;
   image?: string;
 }
@@ -0,0 +1,148 @@
+""" Configuration of the CityHub agent.
+
+`AgentConfig` collects every setting used to build the models, retriever, tools and
+chains of the agent. `AgentConfig.from_env()` reads them from environment variables
+(see `.env-example`), falling back to the defaults below.
+
+Example usage:
+```python
+config = AgentConfig.from_env()
+config.grading_mode = "single_call"
+cityhub_agent = get_cityhub_agent(config)
+```
+"""
+
+from dataclasses import dataclass, field, fields
+from typing import List, Optional
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def default_cached_chains() -> List[str]:
+    return [
+        "question_router",
+        "retrieval_grader",
+        "batch_retrieval_grader",
+        "hallucination_grader",
+        "answer_grader",
+        "generation_grader",
+    ]
+
+
+@dataclass
+class AgentConfig:
+    # Vector store and embeddings
+    index_path: str = "../data/chroma_db"
+    embedding_model: str = "Alibaba-NLP/gte-base-en-v1.5"
+    # Unix socket of a shared `embedding_server.py`; None loads the model in-process
+    embedding_socket: Optional[str] = None
+    # "chroma" or "quantized" (int8 IVF index built from the Chroma collection)
+    vector_backend: str = "chroma"
+    quantized_nprobe: int = 8  # Inverted lists scanned per search.
+    quantized_rescore: int = 50  # Candidates rescored with the float vectors.
+    retriever_k: int = 3
+    # "dense" or "hybrid" (BM25 + dense with reciprocal-rank fusion)
+    retriever_mode: str = "hybrid"
+    retriever_candidates: int = 10  # Results per search before fusion.
+    retriever_rrf_k: int = 60
+    # "similarity" or "mmr" (maximal marginal relevance among the candidates)
+    retriever_search_type: str = "similarity"
+    retriever_mmr_lambda: float = 0.5  # 1 ranks by relevance only, 0 by diversity only.
+    # Only retrieve chunks of these domains (e.g. "sfmta.com") or source URLs
+    retriever_domains: List[str] = field(default_factory=list)
+    retriever_sources: List[str] = field(default_factory=list)
+    # Adaptive k: retrieve `retriever_max_k` docs when the best one has a cosine
+    # similarity below `retriever_min_score`; 0 disables it
+    retriever_max_k: int = 0
+    retriever_min_score: float = 0.5
+
+    # On-disk cache of embeddings, shared by the indexer and the query-time embedder
+    embedding_cache_enabled: bool = True
+    embedding_cache_path: str = "../data/embedding_cache"
+    embedding_cache_max_entries: int = 200000
+    embedding_cache_dtype: str = "float16"  # Or "float32".
+
+    # Context compression before generation and answer verification: keep the sentences
+    # most similar to the question, within a token budget
+    context_compression_enabled: bool = True
+    context_max_tokens: int = 1500
+    context_min_similarity: float = 0.4
+
+    # LLM and web search
+    groq_model: str = "llama3-70b-8192"
+    brave_api_key: Optional[str] = None
+    web_search_count: int = 3
+
+    # Routing: "llm" or "local" (keyword rules, example prototypes and corpus match,
+    # falling back to the LLM router when uncertain). The local router embeds the
+    # question; the retriever reuses the embedding only if the embedding cache is enabled
+    router_mode: str = "local"
+    router_margin: float = 0.05  # Min. similarity gap between the routes' closest examples.
+    router_corpus_threshold: float = 0.5  # Min. corpus match of vectorstore questions.
+
+    # Speculative mode (async graph): retrieve, and web search when the best corpus
+    # match is below the threshold, while the router runs
+    speculative_mode: bool = False
+    speculative_web_search_threshold: float = 0.5
+    speculative_web_search_per_minute: float = 10.0  # Budget of speculative searches.
+
+    # Budget of the generate/grade loop of a question: deadline in seconds (0 disables
+    # it) and maximum generations and web searches, retries included
+    loop_deadline: float = 30.0
+    loop_max_generations: int = 3
+    loop_max_web_searches: int = 1
+
+    # Document grading: "serial", "concurrent", "single_call" or "rerank"
+    grading_mode: str = "concurrent"
+    grading_max_concurrency: int = 4
+    grading_timeout: float = 10.0  # Seconds per grader call.
+    # "rerank" retrieves `rerank_candidates` docs and keeps the best `retriever_k` of
+    # them that score at least `rerank_threshold` with a local cross-encoder
+    rerank_model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    rerank_candidates: int = 20
+    rerank_threshold: float = 0.5
+    rerank_batch_size: int = 32
+
+    # Generation verification: "serial" (hallucination grader, then answer grader),
+    # "concurrent" (both graders in parallel) or "single_call" (one combined grader)
+    verification_mode: str = "concurrent"
+
+    # Exact-match cache of router and grader calls: "memory" or "sqlite"
+    llm_cache_backend: str = "memory"
+    llm_cache_path: str = "../data/llm_cache.sqlite"
+    llm_cache_max_entries: int = 10000
+    llm_cache_chains: List[str] = field(default_factory=default_cached_chains)
+
+    # Semantic cache of verified answers
+    answer_cache_enabled: bool = True
+    answer_cache_threshold: float = 0.9
+    answer_cache_ttl: float = 24 * 60 * 60
+    answer_cache_websearch_ttl: float = 60 * 60
+    answer_cache_max_entries: int = 1000
+
+    @classmethod
+    def from_env(cls) -> "AgentConfig":
+        """Build a config from environment variables named after the upper-cased fields.
+
+        `brave_api_key` is read from BRAVE_API_KEY, `grading_mode` from GRADING_MODE and so
+        on. List settings are comma separated and booleans are "true" or "false".
+        """
+        config = cls()
+        for config_field in fields(cls):
+            value = os.getenv(config_field.name.upper())
+            if value is None:
+                continue
+            current = getattr(config, config_field.name)
+            if isinstance(current, bool):
+                value = value.lower() == "true"
+            elif isinstance(current, int):
+                value = int(value)
+            elif isinstance(current, float):
+                value = float(value)
+            elif isinstance(current, list):
+                value = [item.strip() for item in value.split(",") if item.strip()]
+            setattr(config, config_field.name, value)
+        return config
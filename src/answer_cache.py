@@ -0,0 +1,201 @@
+""" Semantic cache of verified CityHub answers.
+
+Near-duplicate questions ("how do I get a residential parking permit" vs "apply for
+RPP") are answered from the cache instead of running the full agent graph:
+1. The incoming question is embedded with the same embedding model as the retriever.
+2. The cached question with the highest cosine similarity is looked up; if it is above
+    `threshold` and has not expired, its answer is served.
+3. Only verified answers are stored. Answers that came through the `websearch` branch
+    expire after `websearch_ttl` seconds, all others after `ttl` seconds.
+4. At most `max_entries` answers are kept; the least recently used one is evicted first.
+5. The whole cache is dropped when the Chroma index or the quantized index under
+    `index_path` is rebuilt, so answers never outlive the documents they were generated
+    from.
+
+Hit and miss counters are exposed by `stats()` to help tune the threshold.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+from quantized_index import QUANTIZED_DIRECTORY
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    embedding: np.ndarray  # Normalized to unit length.
+    answer: str
+    source: str  # "vectorstore" or "websearch"
+    expires_at: float
+
+
+def normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def get_mtime(path: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def get_index_version(index_path: str) -> Tuple[Optional[float], Optional[float]]:
+    """Return the modification times of the Chroma index and of the quantized index.
+
+    The quantized index is rebuilt into a new directory, so the modification time of its
+    `offsets.npy` changes with every build. None stands for an index that does not exist.
+    """
+    return (
+        get_mtime(os.path.join(index_path, "chroma.sqlite3")),
+        get_mtime(os.path.join(index_path, QUANTIZED_DIRECTORY, "offsets.npy")),
+    )
+
+
+class SemanticAnswerCache:
+    """Serve verified answers for questions similar to ones already answered."""
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        index_path: str,
+        threshold: float = 0.9,
+        ttl: float = 24 * 60 * 60,
+        websearch_ttl: float = 60 * 60,
+        max_entries: int = 1000,
+    ):
+        """
+        Args:
+            embedding_function: The embedding model used by the retriever.
+            index_path: The Chroma persist directory; a rebuild of the Chroma or the
+                quantized index invalidates the cache.
+            threshold: Minimum cosine similarity for a cached answer to be served.
+            ttl: Seconds a vectorstore answer stays valid.
+            websearch_ttl: Seconds an answer that used web search stays valid.
+            max_entries: Maximum number of cached answers.
+        """
+        self.embedding_function = embedding_function
+        self.index_path = index_path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.websearch_ttl = websearch_ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, CachedAnswer] = OrderedDict()
+        self.index_version = get_index_version(index_path)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = Lock()
+
+    def embed(self, question: str) -> np.ndarray:
+        return normalize(self.embedding_function.embed_query(question))
+
+    async def aembed(self, question: str) -> np.ndarray:
+        return normalize(await self.embedding_function.aembed_query(question))
+
+    def lookup(self, question: str) -> Tuple[Optional[str], np.ndarray]:
+        """Look up a cached answer for the question.
+
+        Returns:
+            The cached answer, or None on a miss, and the question embedding so it can
+            be passed to `store()` without embedding the question again.
+        """
+        embedding = self.embed(question)
+        return self.lookup_embedding(embedding), embedding
+
+    async def alookup(self, question: str) -> Tuple[Optional[str], np.ndarray]:
+        """Async version of `lookup`."""
+        embedding = await self.aembed(question)
+        return self.lookup_embedding(embedding), embedding
+
+    def lookup_embedding(self, embedding: np.ndarray) -> Optional[str]:
+        with self.lock:
+            self.check_index_version()
+            self.remove_expired()
+            if not self.entries:
+                self.misses += 1
+                return None
+            keys = list(self.entries)
+            matrix = np.stack([self.entries[key].embedding for key in keys])
+            similarities = matrix @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(keys[best])
+            entry = self.entries[keys[best]]
+            logger.info(
+                f"Answer cache hit ({similarities[best]:.3f}) for cached question: "
+                f"{entry.question}"
+            )
+            return entry.answer
+
+    def store(self, question: str, embedding: np.ndarray, answer: str, source: str):
+        """Cache a verified answer.
+
+        Args:
+            question: The question that was answered.
+            embedding: The question embedding returned by `lookup()`.
+            answer: The verified answer.
+            source: "websearch" if the answer used web search, else "vectorstore".
+        """
+        ttl = self.websearch_ttl if source == "websearch" else self.ttl
+        with self.lock:
+            self.check_index_version()
+            self.entries[question] = CachedAnswer(
+                question=question,
+                embedding=embedding,
+                answer=answer,
+                source=source,
+                expires_at=time.time() + ttl,
+            )
+            self.entries.move_to_end(question)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def remove_expired(self):
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if entry.expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+
+    def check_index_version(self):
+        index_version = get_index_version(self.index_path)
+        if index_version != self.index_version:
+            logger.info("Vector index changed, invalidating the answer cache")
+            self.entries.clear()
+            self.invalidations += 1
+            self.index_version = index_version
+
+    def invalidate(self):
+        """Drop all cached answers."""
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "threshold": self.threshold,
+            }
@@ -1,3 +1,4 @@
+import json
 from typing import Dict, Any
 from pydantic import BaseModel, Field
 
@@ -38,4 +39,9 @@ def get_response_schema() -> Dict[str, Any]:
     return {
         code: {"description": description, "model": ChatbotResponse}
         for code, description in STATUS_CODES.items()
-    }
\ No newline at end of file
+    }
+
+
+def format_server_sent_event(event: str, data: Dict[str, Any]) -> str:
+    """Format an event and its JSON payload as a Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
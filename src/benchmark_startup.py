@@ -0,0 +1,77 @@
+""" Measure the start-up time of a CityHub API worker.
+
+Each measurement runs in a fresh Python process, like a new uvicorn worker would, and
+reports the wall-clock time of:
+    1. `import main`: what a worker pays before it can accept requests when resources
+        are built lazily (run with WARM_UP_ON_STARTUP=false).
+    2. `warm_up`: building the models, the vector store and the chains the config uses
+        up front, as the FastAPI lifespan hook does by default.
+It also lists the resources the warm-up built, to check that the ones the config turns
+off (e.g. EMBEDDING_CACHE_ENABLED=false, RETRIEVER_MODE=dense) are skipped.
+
+To compare against an older build, check it out in a separate work tree and point
+`--src` at its `src` directory. Older builds without `get_resources()` build everything
+at import time, so only the import is measured for them:
+```bash
+git worktree add /tmp/cityhub-before <commit>
+python src/benchmark_startup.py --src /tmp/cityhub-before/src --runs 3
+python src/benchmark_startup.py --runs 3
+```
+"""
+
+from argparse import ArgumentParser
+from statistics import median
+import json
+import os
+import subprocess
+import sys
+
+MEASURE = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter() - start
+warm_up = None
+built = []
+get_resources = getattr(main, "get_resources", None)
+if get_resources is not None:
+    resources = get_resources()
+    start = time.perf_counter()
+    resources.warm_up()
+    warm_up = time.perf_counter() - start
+    built = sorted(name for name in vars(resources) if name in vars(type(resources)))
+print(json.dumps({"import": imported, "warm_up": warm_up, "built": built}))
+"""
+
+
+def measure_startup(src: str) -> dict:
+    """Import `main` from `src` in a fresh process and time the start-up phases."""
+    env = {**os.environ, "WARM_UP_ON_STARTUP": "false"}
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE],
+        cwd=src,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--src", type=str, default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    results = [measure_startup(args.src) for _ in range(args.runs)]
+    import_times = [result["import"] for result in results]
+    print(f"Source: {args.src} ({args.runs} runs)")
+    print(f"  import main: median={median(import_times):.2f}s max={max(import_times):.2f}s")
+    warm_up_times = [result["warm_up"] for result in results if result["warm_up"] is not None]
+    if warm_up_times:
+        print(
+            f"  warm up:     median={median(warm_up_times):.2f}s "
+            f"max={max(warm_up_times):.2f}s"
+        )
+        print(f"  built:       {', '.join(results[-1]['built'])}")
@@ -0,0 +1,143 @@
+""" Near-duplicate detection of index chunks with MinHash and locality-sensitive hashing.
+
+sf.gov pages repeat the same banners, contact blocks and program descriptions, which
+end up as many near-identical chunks. `NearDuplicateIndex` finds, for a new chunk, an
+indexed chunk with nearly the same text, so the indexer can keep one canonical chunk
+and record all the pages it comes from:
+1. `MinHasher.signature()` turns a text into a MinHash signature: for each of
+    `num_perm` hash functions, the minimum hash of the text's word 5-grams. The share
+    of equal positions in two signatures estimates the Jaccard similarity of the texts'
+    5-gram sets.
+2. Signatures are split into `bands` bands; chunks that share any band land in the same
+    bucket. With 64 hashes in 8 bands of 8, pairs above ~0.77 similarity are found with
+    high probability, while dissimilar chunks are almost never compared.
+3. Candidates from the buckets are checked with the estimated similarity against
+    `threshold`.
+
+The signatures of the indexed chunks are saved next to the index
+("data/chroma_db/chunk_signatures.npz") so incremental updates dedup new chunks against
+the existing ones without re-reading the collection.
+
+Example usage:
+```python
+duplicates = NearDuplicateIndex.load(path)
+signature = duplicates.hasher.signature(text)
+match = duplicates.query(signature)  # Id of a near-duplicate chunk, or None.
+if match is None:
+    duplicates.add(chunk_id, signature)
+duplicates.save(path)
+```
+"""
+
+from typing import AbstractSet, Dict, Iterator, List, Optional, Tuple
+import os
+import re
+import zlib
+
+import numpy as np
+
+CHUNK_SIGNATURES_NAME = "chunk_signatures.npz"
+
+
+def shingles(text: str, size: int = 5) -> np.ndarray:
+    """32-bit hashes of the distinct word `size`-grams of a text."""
+    words = re.findall(r"\w+", text.lower())
+    grams = [" ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))]
+    return np.unique(
+        np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64)
+    )
+
+
+class MinHasher:
+    """MinHash signatures from multiply-shift hashes of word shingles."""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.integers(0, 2**64, num_perm, dtype=np.uint64, endpoint=False) | 1
+        self.b = rng.integers(0, 2**64, num_perm, dtype=np.uint64, endpoint=False)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingles(text, self.shingle_size)[:, None]
+        # (a * x + b) mod 2**64, keeping the high 32 bits: uint64 arithmetic wraps around.
+        return ((hashes * self.a + self.b) >> np.uint64(32)).min(axis=0).astype(np.uint32)
+
+
+class NearDuplicateIndex:
+    """LSH index of the MinHash signatures of the indexed chunks."""
+
+    def __init__(
+        self, hasher: Optional[MinHasher] = None, bands: int = 8, threshold: float = 0.8
+    ):
+        """
+        Args:
+            hasher: Computes the signatures, 64 hashes by default.
+            bands: Number of LSH bands, which must divide the signature length.
+            threshold: Minimum estimated Jaccard similarity of near-duplicates.
+        """
+        self.hasher = hasher or MinHasher()
+        if self.hasher.num_perm % bands:
+            raise ValueError(f"{bands} bands do not divide {self.hasher.num_perm} hashes")
+        self.bands = bands
+        self.threshold = threshold
+        self.signatures: Dict[str, np.ndarray] = {}
+        self.buckets: Dict[Tuple[int, bytes], List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self.signatures
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.signatures)
+
+    def band_keys(self, signature: np.ndarray) -> Iterator[Tuple[int, bytes]]:
+        for band, rows in enumerate(np.split(signature, self.bands)):
+            yield band, rows.tobytes()
+
+    def add(self, chunk_id: str, signature: np.ndarray) -> None:
+        self.signatures[chunk_id] = signature
+        for key in self.band_keys(signature):
+            self.buckets.setdefault(key, []).append(chunk_id)
+
+    def remove(self, chunk_id: str) -> None:
+        """Forget a chunk. Its stale bucket entries are skipped by `query`."""
+        self.signatures.pop(chunk_id, None)
+
+    def query(
+        self, signature: np.ndarray, exclude: AbstractSet[str] = frozenset()
+    ) -> Optional[str]:
+        """The most similar indexed chunk above the threshold, if any, not in `exclude`."""
+        best_id, best_similarity = None, self.threshold
+        seen = set(exclude)
+        for key in self.band_keys(signature):
+            for chunk_id in self.buckets.get(key, []):
+                if chunk_id in seen or chunk_id not in self.signatures:
+                    continue
+                seen.add(chunk_id)
+                similarity = float(np.mean(self.signatures[chunk_id] == signature))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = chunk_id, similarity
+        return best_id
+
+    def save(self, path: str) -> None:
+        ids = list(self.signatures)
+        signatures = np.array(
+            [self.signatures[chunk_id] for chunk_id in ids], dtype=np.uint32
+        ).reshape(len(ids), self.hasher.num_perm)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            np.savez(file, ids=np.array(ids, dtype=str), signatures=signatures)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str, bands: int = 8, threshold: float = 0.8) -> "NearDuplicateIndex":
+        """Load the saved signatures, or start an empty index if there are none."""
+        index = cls(bands=bands, threshold=threshold)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                for chunk_id, signature in zip(data["ids"].tolist(), data["signatures"]):
+                    index.add(chunk_id, signature)
+        return index
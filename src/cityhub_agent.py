@@ -1,7 +1,12 @@
-import os
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
 from typing import List, Literal
 from typing_extensions import TypedDict
 import json
+import os
+import numpy as np
 from dotenv import load_dotenv
 from loguru import logger
 from datetime import date
@@ -15,14 +20,28 @@ from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
 from langchain_community.tools import BraveSearch
 from langgraph.graph import END, StateGraph
 
+from agent_config import AgentConfig
+from answer_cache import SemanticAnswerCache
+from context_compression import ContextCompressor
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from embedding_server import EmbeddingClient
+from hybrid_retrieval import BM25Index, HybridRetriever, cosine_similarity
+from llm_cache import InMemoryLRUBackend, LLMCallCache, SQLiteBackend
+from local_router import LocalRouter
+from loop_budget import LoopBudget, LoopMetrics
+from quantized_index import QUANTIZED_DIRECTORY, QuantizedIndex, QuantizedVectorStore
+from reranker import CrossEncoderReranker
+from speculation import Speculation, SpeculationBudget
+
 load_dotenv()
 
 # Tools
 ## RAG tool
-def get_retriever(index_path, model_name = "Alibaba-NLP/gte-base-en-v1.5"):
+def get_embedding_function(model_name = "Alibaba-NLP/gte-base-en-v1.5"):
     model_kwargs = {'device': 'cpu', 'trust_remote_code': True} #'cuda'
     encode_kwargs = {'normalize_embeddings': False}
     embedding_function = HuggingFaceEmbeddings(
@@ -30,18 +49,56 @@ def get_retriever(index_path, model_name = "Alibaba-NLP/gte-base-en-v1.5"):
         model_kwargs=model_kwargs,
         encode_kwargs=encode_kwargs
     )
+    return embedding_function
+
+def get_vectorstore(index_path, embedding_function):
     vectorstore = Chroma(collection_name="rag-chroma", 
                          persist_directory=index_path, 
                          embedding_function=embedding_function)
     logger.info(f"Number of docs loaded from vector store: {len(vectorstore)}")
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+    return vectorstore
+
+def get_quantized_vectorstore(index_path, embedding_function, nprobe=8, rescore=50):
+    directory = os.path.join(index_path, QUANTIZED_DIRECTORY)
+    if not QuantizedIndex.exists(directory):
+        logger.warning("No quantized index found, run quantized_index.py build. Using Chroma")
+        return get_vectorstore(index_path, embedding_function)
+    index = QuantizedIndex(directory, nprobe=nprobe, rescore=rescore)
+    vectorstore = QuantizedVectorStore(index, embedding_function)
+    logger.info(f"Number of docs loaded from quantized index: {len(vectorstore)}")
+    return vectorstore
+
+def get_metadata_filter(domains=None, sources=None):
+    clauses = []
+    if domains:
+        clauses.append({"domain": {"$in": list(domains)}})
+    if sources:
+        clauses.append({"source": {"$in": list(sources)}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def get_retriever(
+    vectorstore, k=3, sparse_index=None, candidates=10, rrf_k=60,
+    search_type="similarity", lambda_mult=0.5, filter=None, max_k=None, min_score=0.5,
+):
+    if max_k is not None and max_k <= k:
+        max_k = None
+    if sparse_index is not None or search_type == "mmr" or filter or max_k:
+        # Fuse BM25 keyword search with similarity search, diversify with MMR,
+        # filter on metadata or widen k for poorly covered questions
+        return HybridRetriever(
+            vectorstore=vectorstore, sparse_index=sparse_index, k=k,
+            candidates=candidates, rrf_k=rrf_k, search_type=search_type,
+            lambda_mult=lambda_mult, filter=filter, max_k=max_k, min_score=min_score,
+        )
+    retriever = vectorstore.as_retriever(search_kwargs={"k": k})
     return retriever
-retriever = get_retriever("../data/chroma_db")
 
 
 ## Web search tool
-BRAVE_API_KEY = os.getenv("BRAVE_API_KEY")
-web_search_tool = BraveSearch.from_api_key(api_key=BRAVE_API_KEY, search_kwargs={"count": 3})
+def get_web_search_tool(api_key, count=3):
+    return BraveSearch.from_api_key(api_key=api_key, search_kwargs={"count": count})
 
 # Data model
 class RouteQuery(BaseModel):
@@ -51,9 +108,9 @@ class RouteQuery(BaseModel):
         description="Given a user question choose to route it to web search or a vectorstore.",
     )
 
-def get_question_router():
+def get_question_router(model="llama3-70b-8192"):
     # LLM with function call 
-    llm = ChatGroq(model="llama3-70b-8192")
+    llm = ChatGroq(model=model)
     structured_llm_router = llm.with_structured_output(RouteQuery)
 
     # Prompt 
@@ -69,7 +126,6 @@ def get_question_router():
 
     question_router = route_prompt | structured_llm_router
     return question_router
-question_router = get_question_router()
 
 
 class GradeDocuments(BaseModel):
@@ -77,9 +133,9 @@ class GradeDocuments(BaseModel):
 
     binary_score: str = Field(description="Documents are relevant to the question, 'yes' or 'no'")
 
-def get_retrieval_grader():
+def get_retrieval_grader(model="llama3-70b-8192", timeout=None):
     # LLM with function call 
-    llm = ChatGroq(model="llama3-70b-8192")
+    llm = ChatGroq(model=model, timeout=timeout)
     structured_llm_grader = llm.with_structured_output(GradeDocuments)
 
     # Prompt 
@@ -95,11 +151,37 @@ def get_retrieval_grader():
 
     retrieval_grader = grade_prompt | structured_llm_grader
     return retrieval_grader
-retrieval_grader = get_retrieval_grader()
+
+
+class GradeDocumentsBatch(BaseModel):
+    """Binary scores for relevance check on a numbered list of retrieved documents."""
+
+    binary_scores: List[str] = Field(
+        description="One score per document in the order given, each 'yes' or 'no'"
+    )
+
+def get_batch_retrieval_grader(model="llama3-70b-8192", timeout=None):
+    # LLM with function call 
+    llm = ChatGroq(model=model, timeout=timeout)
+    structured_llm_grader = llm.with_structured_output(GradeDocumentsBatch)
+
+    # Prompt 
+    system = """You are a grader assessing relevance of each retrieved document to a user question. \n 
+        If a document contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
+        Give a binary score 'yes' or 'no' for every document, in the same order as the numbered documents."""
+    grade_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            ("human", "Retrieved documents: \n\n {documents} \n\n User question: {question}"),
+        ]
+    )
+
+    batch_retrieval_grader = grade_prompt | structured_llm_grader
+    return batch_retrieval_grader
 
 
 # generation
-def get_rag_chain():
+def get_rag_chain(model="llama3-70b-8192"):
     # Prompt
     #prompt = hub.pull("rlm/rag-prompt")
     prompt = PromptTemplate(
@@ -120,12 +202,11 @@ def get_rag_chain():
     )
 
     # LLM
-    llm = ChatGroq(model="llama3-70b-8192")
+    llm = ChatGroq(model=model)
 
-    # Chain
-    rag_chain = prompt | llm | StrOutputParser()
+    # Chain, tagged so token streaming callbacks can pick out the answer
+    rag_chain = (prompt | llm | StrOutputParser()).with_config(tags=["rag_chain"])
     return rag_chain
-rag_chain = get_rag_chain()
 
 ### Hallucination Grader 
 # Data model
@@ -134,9 +215,9 @@ class GradeHallucinations(BaseModel):
 
     binary_score: str = Field(description="Answer is grounded in the facts, 'yes' or 'no'")
 
-def get_hallucination_grader():
+def get_hallucination_grader(model="llama3-70b-8192"):
     # LLM with function call 
-    llm = ChatGroq(model="llama3-70b-8192")
+    llm = ChatGroq(model=model)
     structured_llm_grader = llm.with_structured_output(GradeHallucinations)
 
     # Prompt 
@@ -151,7 +232,6 @@ def get_hallucination_grader():
 
     hallucination_grader = hallucination_prompt | structured_llm_grader
     return hallucination_grader
-hallucination_grader = get_hallucination_grader()
 
 ### Answer Grader 
 # Data model
@@ -160,9 +240,9 @@ class GradeAnswer(BaseModel):
 
     binary_score: str = Field(description="Answer addresses the question, 'yes' or 'no'")
 
-def get_answer_grader():
+def get_answer_grader(model="llama3-70b-8192"):
     # LLM with function call 
-    llm = ChatGroq(model="llama3-70b-8192")
+    llm = ChatGroq(model=model)
     structured_llm_grader = llm.with_structured_output(GradeAnswer)
 
     # Prompt 
@@ -176,7 +256,307 @@ def get_answer_grader():
     )
     answer_grader = answer_prompt | structured_llm_grader
     return answer_grader
-answer_grader = get_answer_grader()
+
+### Generation Grader
+# Data model
+class GradeGeneration(BaseModel):
+    """Binary scores for grounding in the facts and usefulness of an answer."""
+
+    grounded: str = Field(description="Answer is grounded in / supported by the facts, 'yes' or 'no'")
+    useful: str = Field(description="Answer addresses the question, 'yes' or 'no'")
+
+def get_generation_grader(model="llama3-70b-8192"):
+    # LLM with function call 
+    llm = ChatGroq(model=model)
+    structured_llm_grader = llm.with_structured_output(GradeGeneration)
+
+    # Prompt 
+    system = """You are a grader assessing an LLM generation in two ways. \n 
+        First, whether it is grounded in / supported by a set of retrieved facts: give a binary score 'yes' or 'no' for grounded. \n
+        Second, whether it addresses / resolves the user question: give a binary score 'yes' or 'no' for useful. \n
+        Grade both independently."""
+    generation_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            ("human", "Set of facts: \n\n {documents} \n\n User question: {question} \n\n LLM generation: {generation}"),
+        ]
+    )
+    generation_grader = generation_prompt | structured_llm_grader
+    return generation_grader
+
+
+# Resources
+class lazy_resource:
+    """Like `functools.cached_property`, but builds each resource only once across threads."""
+
+    def __init__(self, build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, resources, owner=None):
+        if resources is None:
+            return self
+        if self.name not in resources.__dict__:
+            with resources.lock:
+                if self.name not in resources.__dict__:
+                    start = time.perf_counter()
+                    resources.__dict__[self.name] = self.build(resources)
+                    logger.info(f"Built {self.name} in {time.perf_counter() - start:.2f}s")
+        return resources.__dict__[self.name]
+
+class CityHubResources:
+    """
+    Models, vector store, tools and chains used by the graph nodes.
+
+    Nothing is built when the object is created: each resource is built on first
+    use, or up front by `warm_up()` (e.g. from the FastAPI lifespan hook).
+    """
+
+    def __init__(self, config=None):
+        self.config = config or AgentConfig.from_env()
+        self.lock = RLock()
+
+    @lazy_resource
+    def embedding_cache(self):
+        return EmbeddingCache(
+            self.config.embedding_cache_path,
+            self.config.embedding_model,
+            max_entries=self.config.embedding_cache_max_entries,
+            dtype=self.config.embedding_cache_dtype,
+        )
+
+    @lazy_resource
+    def base_embedding_function(self):
+        if self.config.embedding_socket:
+            # Share one model across workers through the embedding server
+            return EmbeddingClient(self.config.embedding_socket)
+        return get_embedding_function(self.config.embedding_model)
+
+    @lazy_resource
+    def embedding_function(self):
+        if not self.config.embedding_cache_enabled:
+            return self.base_embedding_function
+        return CachedEmbeddings(self.base_embedding_function, self.embedding_cache)
+
+    @lazy_resource
+    def vectorstore(self):
+        if self.config.vector_backend == "quantized":
+            return get_quantized_vectorstore(
+                self.config.index_path,
+                self.embedding_function,
+                nprobe=self.config.quantized_nprobe,
+                rescore=self.config.quantized_rescore,
+            )
+        return get_vectorstore(self.config.index_path, self.embedding_function)
+
+    @lazy_resource
+    def sparse_index(self):
+        sparse_index = BM25Index.load(self.config.index_path)
+        if sparse_index is None:
+            logger.warning("No BM25 index found, run indexing.py to build it")
+        return sparse_index
+
+    @lazy_resource
+    def retriever(self):
+        sparse_index = self.sparse_index if self.config.retriever_mode == "hybrid" else None
+        k = self.config.retriever_k
+        if self.config.grading_mode == "rerank":
+            # Over-retrieve, the reranker keeps the best `retriever_k`
+            k = self.config.rerank_candidates
+        return get_retriever(
+            self.vectorstore,
+            k=k,
+            sparse_index=sparse_index,
+            candidates=self.config.retriever_candidates,
+            rrf_k=self.config.retriever_rrf_k,
+            search_type=self.config.retriever_search_type,
+            lambda_mult=self.config.retriever_mmr_lambda,
+            filter=get_metadata_filter(
+                self.config.retriever_domains, self.config.retriever_sources
+            ),
+            max_k=self.config.retriever_max_k or None,
+            min_score=self.config.retriever_min_score,
+        )
+
+    @lazy_resource
+    def reranker(self):
+        if self.config.grading_mode != "rerank":
+            return None
+        return CrossEncoderReranker(
+            self.config.rerank_model, batch_size=self.config.rerank_batch_size
+        )
+
+    @lazy_resource
+    def context_compressor(self):
+        if not self.config.context_compression_enabled:
+            return None
+        # Sentences are rarely seen twice: embedding them through the persistent cache
+        # would evict the chunk and query vectors it is there for
+        return ContextCompressor(
+            self.base_embedding_function,
+            max_tokens=self.config.context_max_tokens,
+            min_similarity=self.config.context_min_similarity,
+        )
+
+    @lazy_resource
+    def web_search_tool(self):
+        return get_web_search_tool(self.config.brave_api_key, count=self.config.web_search_count)
+
+    @lazy_resource
+    def speculation_budget(self):
+        return SpeculationBudget(per_minute=self.config.speculative_web_search_per_minute)
+
+    @lazy_resource
+    def loop_metrics(self):
+        return LoopMetrics()
+
+    def new_loop_budget(self):
+        """Budget of the generate/grade loop of a new question, starting now."""
+        return LoopBudget(
+            deadline_seconds=self.config.loop_deadline,
+            max_generations=self.config.loop_max_generations,
+            max_web_searches=self.config.loop_max_web_searches,
+            metrics=self.loop_metrics,
+        )
+
+    def recursion_limit(self, margin=2):
+        """
+        LangGraph recursion limit of a run within the loop budget: the route_question
+        node, retrieve and grade_documents, every web search, and every generation, one
+        per web search on top of the `loop_max_generations` retries. The loop budget
+        ends the run first; the limit only catches a run the budget failed to stop.
+        """
+        web_searches = max(self.config.loop_max_web_searches, 1)
+        generations = max(self.config.loop_max_generations, 1) + web_searches
+        return 3 + web_searches + generations + margin
+
+    @lazy_resource
+    def llm_cache(self):
+        if self.config.llm_cache_backend == "sqlite":
+            return LLMCallCache(SQLiteBackend(self.config.llm_cache_path))
+        return LLMCallCache(InMemoryLRUBackend(max_entries=self.config.llm_cache_max_entries))
+
+    def cache_chain(self, chain, name, output_type):
+        """Memoize a structured-output chain if it is listed in `llm_cache_chains`."""
+        if name not in self.config.llm_cache_chains:
+            return chain
+        return self.llm_cache.wrap(
+            chain, name=name, model=self.config.groq_model, output_type=output_type
+        )
+
+    @lazy_resource
+    def question_router(self):
+        router = get_question_router(self.config.groq_model)
+        return self.cache_chain(router, "question_router", RouteQuery)
+
+    @lazy_resource
+    def local_router(self):
+        if self.config.router_mode != "local":
+            return None
+        if not self.config.embedding_cache_enabled:
+            logger.warning(
+                "The embedding cache is disabled: the local router and the retriever "
+                "will each embed the question"
+            )
+        return LocalRouter(
+            self.embedding_function,
+            margin=self.config.router_margin,
+            corpus_threshold=self.config.router_corpus_threshold,
+        )
+
+    @lazy_resource
+    def retrieval_grader(self):
+        grader = get_retrieval_grader(self.config.groq_model, timeout=self.config.grading_timeout)
+        return self.cache_chain(grader, "retrieval_grader", GradeDocuments)
+
+    @lazy_resource
+    def batch_retrieval_grader(self):
+        grader = get_batch_retrieval_grader(
+            self.config.groq_model, timeout=self.config.grading_timeout
+        )
+        return self.cache_chain(grader, "batch_retrieval_grader", GradeDocumentsBatch)
+
+    @lazy_resource
+    def rag_chain(self):
+        return get_rag_chain(self.config.groq_model)
+
+    @lazy_resource
+    def hallucination_grader(self):
+        grader = get_hallucination_grader(self.config.groq_model)
+        return self.cache_chain(grader, "hallucination_grader", GradeHallucinations)
+
+    @lazy_resource
+    def answer_grader(self):
+        grader = get_answer_grader(self.config.groq_model)
+        return self.cache_chain(grader, "answer_grader", GradeAnswer)
+
+    @lazy_resource
+    def generation_grader(self):
+        grader = get_generation_grader(self.config.groq_model)
+        return self.cache_chain(grader, "generation_grader", GradeGeneration)
+
+    @lazy_resource
+    def verification_executor(self):
+        # Threads of the concurrent grader calls of the sync graph, shared by all questions
+        return ThreadPoolExecutor(thread_name_prefix="verification")
+
+    @lazy_resource
+    def answer_cache(self):
+        return SemanticAnswerCache(
+            embedding_function=self.embedding_function,
+            index_path=self.config.index_path,
+            threshold=self.config.answer_cache_threshold,
+            ttl=self.config.answer_cache_ttl,
+            websearch_ttl=self.config.answer_cache_websearch_ttl,
+            max_entries=self.config.answer_cache_max_entries,
+        )
+
+    def is_used(self, name):
+        """
+        Whether the graph uses a resource with this config. Fallbacks (e.g. concurrent
+        grading when single-call grading fails) are not counted, they build on first use.
+        """
+        config = self.config
+        used = {
+            "embedding_cache": config.embedding_cache_enabled,
+            "sparse_index": config.retriever_mode == "hybrid",
+            "reranker": config.grading_mode == "rerank",
+            "context_compressor": config.context_compression_enabled,
+            "speculation_budget": config.speculative_mode,
+            "llm_cache": bool(config.llm_cache_chains),
+            "local_router": config.router_mode == "local",
+            "retrieval_grader": config.grading_mode in ("serial", "concurrent"),
+            "batch_retrieval_grader": config.grading_mode == "single_call",
+            "hallucination_grader": config.verification_mode in ("serial", "concurrent"),
+            "answer_grader": config.verification_mode in ("serial", "concurrent"),
+            "generation_grader": config.verification_mode == "single_call",
+            "verification_executor": config.verification_mode == "concurrent",
+            "answer_cache": config.answer_cache_enabled,
+        }
+        return used.get(name, True)
+
+    def warm_up(self):
+        """Build every resource the config uses now instead of on first use."""
+        start = time.perf_counter()
+        for name, attribute in vars(type(self)).items():
+            if isinstance(attribute, lazy_resource) and self.is_used(name):
+                getattr(self, name)
+        logger.info(f"Warmed up CityHub resources in {time.perf_counter() - start:.2f}s")
+
+    def is_built(self, name):
+        return name in self.__dict__
+
+resources = CityHubResources()
+
+def get_resources():
+    return resources
+
+def configure(config):
+    """Replace the resources used by the graph nodes with ones built from `config`."""
+    global resources
+    resources = CityHubResources(config)
+    return resources
 
 
 # Graph
@@ -189,11 +569,27 @@ class GraphState(TypedDict):
         generation: LLM generation
         web_search: whether to add search
         documents: list of documents 
+        route: datasource picked by the router (speculative mode)
+        speculation: in-flight speculative retrieval and web search (speculative mode)
+        budget: generations, web searches and time left for the generate/grade loop
+        context: documents compressed to the sentences the generation is based on
     """
     question : str
     generation : str
     web_search : str
     documents : List[Document]
+    route : str
+    speculation : Speculation
+    budget : LoopBudget
+    context : List[Document]
+
+def get_initial_state(question):
+    """Graph input for a question, with a loop budget whose deadline starts now."""
+    return {"question": question, "budget": resources.new_loop_budget()}
+
+def get_loop_budget(state):
+    """The loop budget of the state, or a new one if the input had none."""
+    return state.get("budget") or resources.new_loop_budget()
 
 
 # Nodes
@@ -211,58 +607,267 @@ def retrieve(state):
     question = state["question"]
 
     # Retrieval
-    documents = retriever.invoke(question)
+    documents = resources.retriever.invoke(question)
+    logger.info(f"Retrived {len(documents)} docs")
+    if len(documents) == 0:
+        logger.warning("No documents found")
+    return {"documents": documents, "question": question}
+
+async def aretrieve(state):
+    """Async version of `retrieve`, which reuses the speculative retrieval if any."""
+    logger.info("---RETRIEVE---")
+    question = state["question"]
+
+    # Retrieval
+    documents = None
+    if state.get("speculation") is not None:
+        documents = await state["speculation"].take_retrieval()
+    if documents is None:
+        documents = await resources.retriever.ainvoke(question)
     logger.info(f"Retrived {len(documents)} docs")
     if len(documents) == 0:
         logger.warning("No documents found")
     return {"documents": documents, "question": question}
 
+def compress_context(question, documents):
+    """
+    Reduce the documents to the sentences most relevant to the question, within the
+    token budget. The documents are used as they are if compression is disabled or fails.
+
+    Args:
+        question (str): The user question
+        documents (list): Retrieved documents and web results
+
+    Returns:
+        list: Compressed documents
+    """
+    if resources.context_compressor is None or not documents:
+        return documents
+    try:
+        return resources.context_compressor.compress(question, documents)
+    except Exception as error:
+        logger.warning(f"Context compression failed, using the full documents: {error}")
+        return documents
+
+async def acompress_context(question, documents):
+    """Async version of `compress_context`."""
+    if resources.context_compressor is None or not documents:
+        return documents
+    try:
+        return await resources.context_compressor.acompress(question, documents)
+    except Exception as error:
+        logger.warning(f"Context compression failed, using the full documents: {error}")
+        return documents
+
+def get_context(state):
+    """The documents the generation was based on, compressed or not."""
+    context = state.get("context")
+    return state["documents"] if context is None else context
+
 def generate(state):
     """
-    Generate answer using RAG on retrieved documents
+    Generate answer using RAG on the retrieved documents, compressed to the sentences
+    relevant to the question
 
     Args:
         state (dict): The current graph state
 
     Returns:
-        state (dict): New key added to state, generation, that contains LLM generation
+        state (dict): New keys added to state, generation, that contains LLM generation,
+            and context, the compressed documents
     """
     logger.info("---GENERATE---")
     question = state["question"]
     documents = state["documents"]
+    budget = get_loop_budget(state)
+    budget.start_generation()
+    context = compress_context(question, documents)
     
-    # RAG generation
-    generation = rag_chain.invoke({"context": documents, "question": question})
+    # RAG generation, streamed so callbacks receive the answer token by token
+    generation = "".join(resources.rag_chain.stream({"context": context, "question": question}))
     logger.info(f"{generation=}")
-    return {"documents": documents, "question": question, "generation": generation}
+    return {
+        "documents": documents, "question": question, "generation": generation,
+        "budget": budget, "context": context,
+    }
 
-def grade_documents(state):
+async def agenerate(state):
+    """Async version of `generate`."""
+    logger.info("---GENERATE---")
+    question = state["question"]
+    documents = state["documents"]
+    budget = get_loop_budget(state)
+    budget.start_generation()
+    context = await acompress_context(question, documents)
+
+    # RAG generation, streamed so callbacks receive the answer token by token
+    chunks = resources.rag_chain.astream({"context": context, "question": question})
+    generation = "".join([chunk async for chunk in chunks])
+    logger.info(f"{generation=}")
+    return {
+        "documents": documents, "question": question, "generation": generation,
+        "budget": budget, "context": context,
+    }
+
+def grade_documents_serially(question, documents):
     """
-    Determines whether the retrieved documents are relevant to the question
-    If any document is not relevant, we will set a flag to run web search
+    Grade each document with one retrieval grader call after the other
 
     Args:
-        state (dict): The current graph state
+        question (str): The user question
+        documents (list): Retrieved documents
 
     Returns:
-        state (dict): Filtered out irrelevant documents and updated web_search state
+        list: 'yes' or 'no' grade per document
     """
+    grades = []
+    for d in documents:
+        score = resources.retrieval_grader.invoke({"question": question, "document": d.page_content})
+        grades.append(score.binary_score)
+    return grades
 
-    logger.info("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
-    question = state["question"]
-    documents = state["documents"]
-    
-    if documents:
-        web_search = "No"
-    else:
-        # if no docs then use web search
-        web_search = "Yes"
-        return {"documents": [], "question": question, "web_search": web_search}
-    # Score each doc
-    filtered_docs = []
+async def agrade_documents_serially(question, documents):
+    """Async version of `grade_documents_serially`."""
+    grades = []
     for d in documents:
-        score = retrieval_grader.invoke({"question": question, "document": d.page_content})
-        grade = score.binary_score
+        score = await resources.retrieval_grader.ainvoke({"question": question, "document": d.page_content})
+        grades.append(score.binary_score)
+    return grades
+
+def scores_to_grades(scores):
+    grades = []
+    for score in scores:
+        if isinstance(score, Exception):
+            logger.warning(f"Grading failed, treating document as not relevant: {score}")
+            grades.append("no")
+        else:
+            grades.append(score.binary_score)
+    return grades
+
+def grade_documents_concurrently(question, documents):
+    """
+    Grade all documents with parallel retrieval grader calls, at most
+    `grading_max_concurrency` at a time. A call that fails or times out grades
+    its document as not relevant.
+
+    Args:
+        question (str): The user question
+        documents (list): Retrieved documents
+
+    Returns:
+        list: 'yes' or 'no' grade per document
+    """
+    inputs = [{"question": question, "document": d.page_content} for d in documents]
+    scores = resources.retrieval_grader.batch(
+        inputs,
+        config={"max_concurrency": resources.config.grading_max_concurrency},
+        return_exceptions=True,
+    )
+    return scores_to_grades(scores)
+
+async def agrade_documents_concurrently(question, documents):
+    """Async version of `grade_documents_concurrently`."""
+    inputs = [{"question": question, "document": d.page_content} for d in documents]
+    scores = await resources.retrieval_grader.abatch(
+        inputs,
+        config={"max_concurrency": resources.config.grading_max_concurrency},
+        return_exceptions=True,
+    )
+    return scores_to_grades(scores)
+
+def format_numbered_documents(documents):
+    return "\n\n".join(
+        f"Document {i}: \n{d.page_content}" for i, d in enumerate(documents, start=1)
+    )
+
+def grade_documents_in_single_call(question, documents):
+    """
+    Grade all documents with one structured-output call returning a verdict
+    per document. Falls back to concurrent grading if the call fails or the
+    number of verdicts does not match the number of documents.
+
+    Args:
+        question (str): The user question
+        documents (list): Retrieved documents
+
+    Returns:
+        list: 'yes' or 'no' grade per document
+    """
+    try:
+        score = resources.batch_retrieval_grader.invoke(
+            {"question": question, "documents": format_numbered_documents(documents)}
+        )
+    except Exception as error:
+        logger.warning(f"Single call grading failed, grading concurrently: {error}")
+        return grade_documents_concurrently(question, documents)
+    if len(score.binary_scores) != len(documents):
+        logger.warning(
+            f"Got {len(score.binary_scores)} grades for {len(documents)} docs, grading concurrently"
+        )
+        return grade_documents_concurrently(question, documents)
+    return score.binary_scores
+
+async def agrade_documents_in_single_call(question, documents):
+    """Async version of `grade_documents_in_single_call`."""
+    try:
+        score = await resources.batch_retrieval_grader.ainvoke(
+            {"question": question, "documents": format_numbered_documents(documents)}
+        )
+    except Exception as error:
+        logger.warning(f"Single call grading failed, grading concurrently: {error}")
+        return await agrade_documents_concurrently(question, documents)
+    if len(score.binary_scores) != len(documents):
+        logger.warning(
+            f"Got {len(score.binary_scores)} grades for {len(documents)} docs, grading concurrently"
+        )
+        return await agrade_documents_concurrently(question, documents)
+    return score.binary_scores
+
+DOCUMENT_GRADERS = {
+    "serial": (grade_documents_serially, agrade_documents_serially),
+    "concurrent": (grade_documents_concurrently, agrade_documents_concurrently),
+    "single_call": (grade_documents_in_single_call, agrade_documents_in_single_call),
+}
+
+def rerank_documents(question, documents):
+    """
+    Keep the `retriever_k` documents the cross-encoder reranker scores highest,
+    if they pass `rerank_threshold`. Web search is needed when fewer pass.
+
+    Args:
+        question (str): The user question
+        documents (list): Retrieved documents
+
+    Returns:
+        state (dict): Reranked relevant documents and updated web_search state
+    """
+    config = resources.config
+    kept, scores = resources.reranker.rerank(
+        question, documents, top_n=config.retriever_k, threshold=config.rerank_threshold
+    )
+    logger.info(f"Reranker kept {len(kept)}/{len(documents)} docs, scores: {scores}")
+    web_search = "Yes" if len(kept) < config.retriever_k else "No"
+    return {"documents": kept, "question": question, "web_search": web_search}
+
+async def arerank_documents(question, documents):
+    """Async version of `rerank_documents`, run in a thread to keep the event loop free."""
+    return await asyncio.to_thread(rerank_documents, question, documents)
+
+def filter_relevant_documents(question, documents, grades):
+    """
+    Keep the documents graded as relevant
+
+    Args:
+        question (str): The user question
+        documents (list): Retrieved documents
+        grades (list): 'yes' or 'no' grade per document
+
+    Returns:
+        state (dict): Filtered out irrelevant documents and updated web_search state
+    """
+    web_search = "No"
+    filtered_docs = []
+    for d, grade in zip(documents, grades):
         # Document relevant
         if grade.lower() == "yes":
             logger.info("---GRADE: DOCUMENT RELEVANT---")
@@ -275,30 +880,67 @@ def grade_documents(state):
             web_search = "Yes"
             continue
     return {"documents": filtered_docs, "question": question, "web_search": web_search}
-    
-def web_search(state):
+
+def grade_documents(state):
     """
-    Web search based based on the question
+    Determines whether the retrieved documents are relevant to the question
+    If any document is not relevant, we will set a flag to run web search
 
     Args:
         state (dict): The current graph state
 
     Returns:
-        state (dict): Appended web results to documents
+        state (dict): Filtered out irrelevant documents and updated web_search state
     """
 
-    logger.info("---WEB SEARCH---")
+    logger.info("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
+    question = state["question"]
+    documents = state["documents"]
+    
+    if not documents:
+        # if no docs then use web search
+        return {"documents": [], "question": question, "web_search": "Yes"}
+    if resources.config.grading_mode == "rerank":
+        return rerank_documents(question, documents)
+    # Score each doc
+    grader, _ = DOCUMENT_GRADERS[resources.config.grading_mode]
+    grades = grader(question, documents)
+    return filter_relevant_documents(question, documents, grades)
+
+async def agrade_documents(state):
+    """
+    Async version of `grade_documents`. In speculative mode, a speculative web search
+    is cancelled once the documents turn out to be relevant.
+    """
+    result = await agrade_retrieved_documents(state)
+    if result["web_search"] == "No" and state.get("speculation") is not None:
+        state["speculation"].cancel("web_search")
+    return result
+
+async def agrade_retrieved_documents(state):
+    logger.info("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state["question"]
     documents = state["documents"]
 
+    if not documents:
+        # if no docs then use web search
+        return {"documents": [], "question": question, "web_search": "Yes"}
+    if resources.config.grading_mode == "rerank":
+        return await arerank_documents(question, documents)
+    # Score each doc
+    _, agrader = DOCUMENT_GRADERS[resources.config.grading_mode]
+    grades = await agrader(question, documents)
+    return filter_relevant_documents(question, documents, grades)
+
+def augment_search_query(question):
     # query augmentation
     if ' now ' in question or 'right now' in question:
         # Get today's date
         today = date.today()
         question += f"arround {today}"
+    return question
 
-    # Web search
-    docs = web_search_tool.invoke({"query": question})
+def add_web_results(question, documents, docs):
     logger.info(f"Web search query: {question} \n docs: {docs}")
     if docs:
       docs = json.loads(docs)
@@ -310,21 +952,43 @@ def web_search(state):
         documents = [web_results]
     return {"documents": documents, "question": question}
 
-## Edges
-def route_question(state):
+def web_search(state):
     """
-    Route question to web search or RAG 
+    Web search based based on the question
 
     Args:
         state (dict): The current graph state
 
     Returns:
-        str: Next node to call
+        state (dict): Appended web results to documents
     """
 
-    logger.info("---ROUTE QUESTION---")
-    question = state["question"]
-    source = question_router.invoke({"question": question})   
+    logger.info("---WEB SEARCH---")
+    question = augment_search_query(state["question"])
+    budget = get_loop_budget(state)
+    budget.start_web_search()
+
+    # Web search
+    docs = resources.web_search_tool.invoke({"query": question})
+    return {**add_web_results(question, state["documents"], docs), "budget": budget}
+
+async def aweb_search(state):
+    """Async version of `web_search`, which reuses the speculative web search if any."""
+    logger.info("---WEB SEARCH---")
+    question = augment_search_query(state["question"])
+    budget = get_loop_budget(state)
+    budget.start_web_search()
+
+    # Web search
+    docs = None
+    if state.get("speculation") is not None:
+        docs = await state["speculation"].take_web_search()
+    if docs is None:
+        docs = await resources.web_search_tool.ainvoke({"query": question})
+    return {**add_web_results(question, state.get("documents"), docs), "budget": budget}
+
+## Edges
+def source_to_route(source):
     if source.datasource == 'websearch':
         logger.info("---ROUTE QUESTION TO WEB SEARCH---")
         return "websearch"
@@ -332,6 +996,142 @@ def route_question(state):
         logger.info("---ROUTE QUESTION TO RAG---")
         return "vectorstore"
 
+def corpus_match_score(embedding):
+    """Cosine similarity of a query embedding and its nearest chunk in the vector store."""
+    result = resources.vectorstore._collection.query(
+        query_embeddings=[embedding], n_results=1, include=["embeddings"],
+    )
+    if not result["ids"][0]:
+        return 0.0
+    return cosine_similarity(np.asarray(embedding, dtype=np.float32), result["embeddings"][0][0])
+
+def question_signals(question):
+    """The query embedding of the question and its corpus match score, None if they failed."""
+    try:
+        embedding = resources.embedding_function.embed_query(question)
+        return embedding, corpus_match_score(embedding)
+    except Exception as error:
+        logger.warning(f"Corpus match scoring failed: {error}")
+        return None, None
+
+async def aquestion_signals(question):
+    """Async version of `question_signals`."""
+    try:
+        embedding = await resources.embedding_function.aembed_query(question)
+        return embedding, await asyncio.to_thread(corpus_match_score, embedding)
+    except Exception as error:
+        logger.warning(f"Corpus match scoring failed: {error}")
+        return None, None
+
+def local_route(question, embedding, score):
+    """The route picked by the local router, or None if it is uncertain or disabled."""
+    if resources.local_router is None or embedding is None:
+        return None
+    decision = resources.local_router.route(question, embedding, score)
+    if decision.route is None:
+        logger.info(f"Local router uncertain {decision.scores}, asking the LLM router")
+        return None
+    logger.info(f"---ROUTE QUESTION LOCALLY ({decision.reason})---")
+    return decision.route
+
+def route_question(state):
+    """
+    Route question to web search or RAG, with the local router if it is confident
+    and with the LLM router otherwise
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        str: Next node to call
+    """
+
+    logger.info("---ROUTE QUESTION---")
+    question = state["question"]
+    if resources.local_router is not None:
+        route = local_route(question, *question_signals(question))
+        if route is not None:
+            return route
+    source = resources.question_router.invoke({"question": question})   
+    return source_to_route(source)
+
+async def aroute_question(state):
+    """Async version of `route_question`."""
+    logger.info("---ROUTE QUESTION---")
+    question = state["question"]
+    if resources.local_router is not None:
+        route = local_route(question, *await aquestion_signals(question))
+        if route is not None:
+            return route
+    return await allm_route_question(question)
+
+async def allm_route_question(question):
+    source = await resources.question_router.ainvoke({"question": question})
+    return source_to_route(source)
+
+def route_question_node(state):
+    """
+    Route question to web search or RAG, storing the route in the state.
+    Only the async graph speculates.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): New key added to state, route, the next node to call
+    """
+    return {"question": state["question"], "route": route_question(state)}
+
+async def aspeculative_route_question(state):
+    """
+    Route question to web search or RAG while retrieval, and web search if the
+    corpus match of the question is weak and the budget allows it, run
+    speculatively. The retrieval is cancelled if the question is routed to web search.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): New keys added to state, route and speculation, the in-flight
+            speculative work taken over by the retrieve and websearch nodes
+    """
+    logger.info("---ROUTE QUESTION---")
+    question = state["question"]
+    config = resources.config
+    budget = resources.speculation_budget
+    retrieval = asyncio.create_task(resources.retriever.ainvoke(question))
+    router = web_search = None
+    if resources.local_router is None:
+        router = asyncio.create_task(allm_route_question(question))
+    try:
+        embedding, score = await aquestion_signals(question)
+        route = None if router is not None else local_route(question, embedding, score)
+        if route is None and router is None:
+            router = asyncio.create_task(allm_route_question(question))
+        if route == "websearch":
+            pass  # The websearch node runs right away, there is nothing to speculate.
+        elif score is None or score >= config.speculative_web_search_threshold:
+            budget.record("web_search_skipped")
+        elif budget.try_spend():
+            logger.info(f"Weak corpus match ({score:.2f}), speculating web search")
+            web_search = asyncio.create_task(resources.web_search_tool.ainvoke(
+                {"query": augment_search_query(question)}
+            ))
+        if route is None:
+            route = await router
+    except BaseException:
+        for task in (router, retrieval, web_search):
+            if task is not None:
+                task.cancel()
+        raise
+    speculation = Speculation(retrieval, web_search, budget)
+    if route == "websearch":
+        speculation.cancel("retrieval")
+    return {"question": question, "route": route, "speculation": speculation}
+
+def route_from_state(state):
+    return state["route"]
+
 def decide_to_generate(state):
     """
     Determines whether to generate an answer, or add web search
@@ -358,9 +1158,121 @@ def decide_to_generate(state):
         logger.info("---DECISION: GENERATE---")
         return "generate"
 
+def verify_generation_serially(question, documents, generation, budget):
+    """
+    Grade the grounding of the generation, then, if it is grounded and the deadline
+    has not passed, its usefulness, with two grader calls one after the other
+
+    Args:
+        question (str): The user question
+        documents (list): Documents the generation is based on
+        generation (str): The generation to grade
+        budget (LoopBudget): Loop budget of the question
+
+    Returns:
+        tuple: hallucination score, and answer score or None if it was not graded
+    """
+    grounded = resources.hallucination_grader.invoke({"documents": documents, "generation": generation})
+    if not is_grounded(grounded) or budget.expired():
+        return grounded, None
+    # Check question-answering
+    logger.info("---GRADE GENERATION vs QUESTION---")
+    useful = resources.answer_grader.invoke({"question": question,"generation": generation})
+    return grounded, useful
+
+async def averify_generation_serially(question, documents, generation, budget):
+    """Async version of `verify_generation_serially`."""
+    grounded = await resources.hallucination_grader.ainvoke({"documents": documents, "generation": generation})
+    if not is_grounded(grounded) or budget.expired():
+        return grounded, None
+    # Check question-answering
+    logger.info("---GRADE GENERATION vs QUESTION---")
+    useful = await resources.answer_grader.ainvoke({"question": question,"generation": generation})
+    return grounded, useful
+
+def verify_generation_concurrently(question, documents, generation, budget):
+    """
+    Grade the grounding and the usefulness of the generation with two parallel grader
+    calls. The usefulness call is wasted when the generation is not grounded.
+
+    Args:
+        question (str): The user question
+        documents (list): Documents the generation is based on
+        generation (str): The generation to grade
+        budget (LoopBudget): Loop budget of the question
+
+    Returns:
+        tuple: hallucination score and answer score
+    """
+    executor = resources.verification_executor
+    grounded = executor.submit(
+        resources.hallucination_grader.invoke, {"documents": documents, "generation": generation}
+    )
+    useful = executor.submit(
+        resources.answer_grader.invoke, {"question": question, "generation": generation}
+    )
+    return grounded.result(), useful.result()
+
+async def averify_generation_concurrently(question, documents, generation, budget):
+    """Async version of `verify_generation_concurrently`."""
+    return tuple(await asyncio.gather(
+        resources.hallucination_grader.ainvoke({"documents": documents, "generation": generation}),
+        resources.answer_grader.ainvoke({"question": question, "generation": generation}),
+    ))
+
+def split_generation_score(score):
+    return (
+        GradeHallucinations(binary_score=score.grounded),
+        GradeAnswer(binary_score=score.useful),
+    )
+
+def verify_generation_in_single_call(question, documents, generation, budget):
+    """
+    Grade the grounding and the usefulness of the generation with one structured-output
+    call. Falls back to concurrent grading if the call fails.
+
+    Args:
+        question (str): The user question
+        documents (list): Documents the generation is based on
+        generation (str): The generation to grade
+        budget (LoopBudget): Loop budget of the question
+
+    Returns:
+        tuple: hallucination score and answer score
+    """
+    try:
+        score = resources.generation_grader.invoke(
+            {"documents": documents, "question": question, "generation": generation}
+        )
+    except Exception as error:
+        logger.warning(f"Single call verification failed, grading concurrently: {error}")
+        return verify_generation_concurrently(question, documents, generation, budget)
+    return split_generation_score(score)
+
+async def averify_generation_in_single_call(question, documents, generation, budget):
+    """Async version of `verify_generation_in_single_call`."""
+    try:
+        score = await resources.generation_grader.ainvoke(
+            {"documents": documents, "question": question, "generation": generation}
+        )
+    except Exception as error:
+        logger.warning(f"Single call verification failed, grading concurrently: {error}")
+        return await averify_generation_concurrently(question, documents, generation, budget)
+    return split_generation_score(score)
+
+GENERATION_VERIFIERS = {
+    "serial": (verify_generation_serially, averify_generation_serially),
+    "concurrent": (verify_generation_concurrently, averify_generation_concurrently),
+    "single_call": (verify_generation_in_single_call, averify_generation_in_single_call),
+}
+
 def grade_generation_v_documents_and_question(state):
     """
-    Determines whether the generation is grounded in the document and answers question
+    Determines whether the generation is grounded in the documents it was generated
+    from (the compressed context) and answers question, with the graders of
+    `verification_mode`.
+    Retries only within the loop budget of the question: once it is exhausted, or the
+    deadline has passed, the graph ends with the best unverified answer.
 
     Args:
         state (dict): The current graph state
@@ -371,48 +1283,114 @@ def grade_generation_v_documents_and_question(state):
 
     logger.info("---CHECK HALLUCINATIONS---")
     question = state["question"]
-    documents = state["documents"]
+    documents = get_context(state)
     generation = state["generation"]
+    budget = state["budget"]
 
-    score = hallucination_grader.invoke({"documents": documents, "generation": generation})
-    grade = score.binary_score
+    if budget.expired():
+        return budget.exhaust("deadline")
+    verifier, _ = GENERATION_VERIFIERS[resources.config.verification_mode]
+    grounded, useful = verifier(question, documents, generation, budget)
+    return verdicts_to_route(budget, generation, grounded, useful)
 
+async def agrade_generation_v_documents_and_question(state):
+    """
+    Async version of `grade_generation_v_documents_and_question`, which also cuts the
+    grader calls short at the deadline.
+    """
+    logger.info("---CHECK HALLUCINATIONS---")
+    question = state["question"]
+    documents = get_context(state)
+    generation = state["generation"]
+    budget = state["budget"]
+
+    _, averifier = GENERATION_VERIFIERS[resources.config.verification_mode]
+    try:
+        grounded, useful = await asyncio.wait_for(
+            averifier(question, documents, generation, budget), budget.remaining()
+        )
+    except asyncio.TimeoutError:
+        return budget.exhaust("deadline")
+    return verdicts_to_route(budget, generation, grounded, useful)
+
+def verdicts_to_route(budget, generation, grounded, useful):
+    if not is_grounded(grounded):
+        return budget.retry("not supported")
+    budget.record_grounded(generation)
+    if useful is None:
+        # Grounded, but the deadline passed before the usefulness check
+        return budget.exhaust("deadline")
+    return finish_grading(budget, usefulness_to_route(useful))
+
+def finish_grading(budget, route):
+    if route == "useful":
+        budget.finish("verified")
+        return route
+    return budget.retry(route)
+
+def is_grounded(score):
     # Check hallucination
-    if grade == "yes":
+    if score.binary_score == "yes":
         logger.info("---DECISION: GENERATION IS GROUNDED IN DOCUMENTS---")
-        # Check question-answering
-        logger.info("---GRADE GENERATION vs QUESTION---")
-        score = answer_grader.invoke({"question": question,"generation": generation})
-        grade = score.binary_score
-        if grade == "yes":
-            logger.info("---DECISION: GENERATION ADDRESSES QUESTION---")
-            return "useful"
-        else:
-            logger.info("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
-            return "not useful"
+        return True
+    logger.info("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
+    return False
+
+def usefulness_to_route(score):
+    if score.binary_score == "yes":
+        logger.info("---DECISION: GENERATION ADDRESSES QUESTION---")
+        return "useful"
     else:
-        logger.info("---DECISION: GENERATION IS NOT GROUNDED IN DOCUMENTS, RE-TRY---")
-        return "not supported"
+        logger.info("---DECISION: GENERATION DOES NOT ADDRESS QUESTION---")
+        return "not useful"
     
 
 # Define the workflow
-def get_cityhub_agent():
+def get_cityhub_agent(config=None):
+    """
+    Build the CityHub graph. Every node and edge has a sync and an async
+    implementation, so the compiled agent supports both `stream` and `astream`.
+    With `speculative_mode`, routing is a node of its own that, in `astream`, starts
+    retrieval and web search while the router runs (see `speculation.py`).
+    Start runs from `get_initial_state(question)`, so the deadline of the
+    generate/grade loop includes routing and retrieval (see `loop_budget.py`).
+
+    Args:
+        config (AgentConfig): Settings of the models, retriever and chains used by
+            the nodes. Defaults to the current resources (built from the environment).
+            Resources are built lazily, so compiling the graph is cheap.
+    """
+    if config is not None:
+        configure(config)
     workflow = StateGraph(GraphState)
 
     # Define the nodes
-    workflow.add_node("websearch", web_search) # web search
-    workflow.add_node("retrieve", retrieve) # retrieve
-    workflow.add_node("grade_documents", grade_documents) # grade documents
-    workflow.add_node("generate", generate) # generatae
+    workflow.add_node("websearch", RunnableLambda(web_search, afunc=aweb_search, name="web_search")) # web search
+    workflow.add_node("retrieve", RunnableLambda(retrieve, afunc=aretrieve, name="retrieve")) # retrieve
+    workflow.add_node("grade_documents", RunnableLambda(grade_documents, afunc=agrade_documents, name="grade_documents")) # grade documents
+    workflow.add_node("generate", RunnableLambda(generate, afunc=agenerate, name="generate")) # generatae
 
     # Build graph
-    workflow.set_conditional_entry_point(
-        route_question,
-        {
-            "websearch": "websearch",
-            "vectorstore": "retrieve",
-        },
-    )
+    if resources.config.speculative_mode:
+        # Route in a node, so the speculative work it starts is passed on in the state
+        workflow.add_node("route_question", RunnableLambda(route_question_node, afunc=aspeculative_route_question, name="route_question"))
+        workflow.set_entry_point("route_question")
+        workflow.add_conditional_edges(
+            "route_question",
+            route_from_state,
+            {
+                "websearch": "websearch",
+                "vectorstore": "retrieve",
+            },
+        )
+    else:
+        workflow.set_conditional_entry_point(
+            RunnableLambda(route_question, afunc=aroute_question, name="route_question"),
+            {
+                "websearch": "websearch",
+                "vectorstore": "retrieve",
+            },
+        )
     workflow.add_edge("websearch", "generate")
     workflow.add_edge("retrieve", "grade_documents")
     workflow.add_conditional_edges(
@@ -425,14 +1403,19 @@ def get_cityhub_agent():
     )
     workflow.add_conditional_edges(
         "generate",
-        grade_generation_v_documents_and_question,
+        RunnableLambda(
+            grade_generation_v_documents_and_question,
+            afunc=agrade_generation_v_documents_and_question,
+            name="grade_generation_v_documents_and_question",
+        ),
         {
             "not supported": "generate",
             "useful": END,
             "not useful": "websearch",
+            "exhausted": END,
         },
     )
 
     # Compile
     app = workflow.compile()
-    return app
\ No newline at end of file
+    return app
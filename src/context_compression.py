@@ -0,0 +1,180 @@
+""" Compression of the retrieved context before generation and answer verification.
+
+The RAG chain gets full 500-token chunks and the concatenated Brave snippets, and the
+hallucination grader is sent the same documents again, on every retry. Most of their
+sentences are not about the question, and adjacent chunks of a page repeat the 100
+tokens of their `chunk_overlap`. `ContextCompressor` keeps only what the question needs:
+1. The documents are split into sentences (and snippet lines).
+2. Sentences repeated in another document, or contained in a longer sentence of the
+    context (a fragment cut at a chunk boundary), are dropped.
+3. The remaining sentences are embedded locally with the retriever's embedding model
+    and scored by cosine similarity to the question. The agent gives the compressor the
+    model without the embedding cache: sentences would fill the persistent cache and
+    evict the chunk and query vectors it is for.
+4. The best sentences scoring at least `min_similarity` are kept, in the order of the
+    best first, until `max_tokens` tokens (tiktoken) are used; the best sentence is
+    always kept.
+5. Each document is rebuilt from its kept sentences in their original order, with its
+    metadata, and documents without any kept sentence are dropped.
+
+The compressed documents are generated from and graded against, so the hallucination
+grader judges the answer on the facts the generation actually saw. Counters of the
+tokens before and after compression are exposed by `stats()`.
+
+Example usage:
+```python
+compressor = ContextCompressor(embedding_function, max_tokens=1500, min_similarity=0.4)
+context = compressor.compress(question, documents)
+```
+"""
+
+from collections import Counter
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import re
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])|\n+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split a text into sentences, and lines for texts like lists of snippets."""
+    return [sentence.strip() for sentence in SENTENCE_END.split(text) if sentence.strip()]
+
+
+def normalize_sentence(sentence: str) -> str:
+    return " ".join(re.findall(r"\w+", sentence.lower()))
+
+
+def get_token_counter(encoding_name: str) -> Callable[[str], int]:
+    """Count tokens with tiktoken, or estimate them if the encoding cannot be loaded."""
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as error:
+        logger.warning(f"Could not load the {encoding_name} encoding, estimating tokens: {error}")
+        return lambda text: (len(text) + 3) // 4
+
+
+class ContextCompressor:
+    """Keep the sentences of the retrieved documents most similar to the question."""
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        max_tokens: int = 1500,
+        min_similarity: float = 0.4,
+        encoding_name: str = "cl100k_base",
+    ):
+        """
+        Args:
+            embedding_function: The embedding model used by the retriever, without the
+                embedding cache.
+            max_tokens: Token budget of the compressed context.
+            min_similarity: Minimum cosine similarity of a kept sentence to the question.
+            encoding_name: tiktoken encoding used to count tokens.
+        """
+        self.embedding_function = embedding_function
+        self.max_tokens = max_tokens
+        self.min_similarity = min_similarity
+        self.encoding_name = encoding_name
+        self.token_counter: Optional[Callable[[str], int]] = None
+        self.counters: Counter = Counter()
+        self.lock = Lock()
+
+    def count_tokens(self, text: str) -> int:
+        if self.token_counter is None:
+            self.token_counter = get_token_counter(self.encoding_name)
+        return self.token_counter(text)
+
+    def split(self, documents: List[Document]) -> List[Tuple[int, int, str]]:
+        """(document, position, sentence) of the sentences left after deduplication."""
+        sentences, seen = [], set()
+        for document_index, document in enumerate(documents):
+            for position, sentence in enumerate(split_sentences(document.page_content)):
+                key = normalize_sentence(sentence)
+                if key and key not in seen:
+                    seen.add(key)
+                    sentences.append((document_index, position, sentence, key))
+        # Fragments cut at chunk boundaries are contained in the full sentence
+        keys = [key for *_, key in sentences]
+        return [
+            (document_index, position, sentence)
+            for document_index, position, sentence, key in sentences
+            if not any(key != other and f" {key} " in f" {other} " for other in keys)
+        ]
+
+    def select(
+        self,
+        documents: List[Document],
+        sentences: List[Tuple[int, int, str]],
+        query: List[float],
+        embeddings: List[List[float]],
+    ) -> List[Document]:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        similarities = vectors @ query / np.where(norms == 0, 1, norms)
+
+        kept, tokens = [], 0
+        for index in np.argsort(-similarities):
+            if kept and similarities[index] < self.min_similarity:
+                break
+            sentence_tokens = self.count_tokens(sentences[index][2])
+            if kept and tokens + sentence_tokens > self.max_tokens:
+                continue
+            kept.append(sentences[index])
+            tokens += sentence_tokens
+
+        compressed = []
+        for document_index, document in enumerate(documents):
+            document_sentences = sorted(
+                (position, sentence)
+                for kept_index, position, sentence in kept
+                if kept_index == document_index
+            )
+            if document_sentences:
+                compressed.append(Document(
+                    page_content=" ".join(sentence for _, sentence in document_sentences),
+                    metadata=dict(document.metadata),
+                ))
+        self.record(documents, compressed)
+        return compressed
+
+    def compress(self, question: str, documents: List[Document]) -> List[Document]:
+        """The documents reduced to their sentences most relevant to the question."""
+        sentences = self.split(documents)
+        if not sentences:
+            return documents
+        query = self.embedding_function.embed_query(question)
+        embeddings = self.embedding_function.embed_documents([s for *_, s in sentences])
+        return self.select(documents, sentences, query, embeddings)
+
+    async def acompress(self, question: str, documents: List[Document]) -> List[Document]:
+        """Async version of `compress`."""
+        sentences = self.split(documents)
+        if not sentences:
+            return documents
+        query = await self.embedding_function.aembed_query(question)
+        embeddings = await self.embedding_function.aembed_documents([s for *_, s in sentences])
+        return self.select(documents, sentences, query, embeddings)
+
+    def record(self, documents: List[Document], compressed: List[Document]) -> None:
+        tokens_in = sum(self.count_tokens(document.page_content) for document in documents)
+        tokens_out = sum(self.count_tokens(document.page_content) for document in compressed)
+        with self.lock:
+            self.counters["contexts"] += 1
+            self.counters["tokens_in"] += tokens_in
+            self.counters["tokens_out"] += tokens_out
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            tokens_in = self.counters["tokens_in"]
+            ratio = self.counters["tokens_out"] / tokens_in if tokens_in else None
+            return {**self.counters, "compression_ratio": ratio}
@@ -0,0 +1,168 @@
+""" Persistent crawl frontier for `smart_scraper`, so a crawl can resume after a crash.
+
+`CrawlFrontier` keeps the crawl state in a SQLite database ("data/crawl_frontier.sqlite"
+by default) instead of in memory:
+- `urls`: every URL ever queued, which doubles as the dedup set, with its description,
+    queue position, number of failed attempts and state: "pending", "in_progress",
+    "done", "failed" (invalid URL, or a page the scraper found nothing in), "retry" (the
+    check or the scrape raised, e.g. a timeout or a rate limit) or "redirected" (done,
+    with the redirect target recorded).
+- `results`: the scraped URL descriptions that end up in "data/visited_urls.json".
+
+Pending URLs are taken in queue order through an index on (state, position), so a
+dequeue does not scan the frontier. Writes are committed by `checkpoint()`, which the
+crawler calls after every visit and which commits at most every `checkpoint_interval`
+seconds, and on exit. On resume, URLs that were "in_progress" when the crawl stopped,
+and "retry" URLs that failed fewer than `max_attempts` times, are pending again, and
+URLs that are already done are not scraped (and paid for) twice.
+
+Example usage:
+```python
+frontier = CrawlFrontier("data/crawl_frontier.sqlite", resume=True)
+frontier.add("https://www.sf.gov/", "The main page.")
+for url, description in frontier.pending():
+    ...
+frontier.mark(url, "done")
+frontier.checkpoint(force=True)
+```
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import os
+import sqlite3
+import time
+
+from loguru import logger
+
+STATES = ("pending", "in_progress", "done", "failed", "retry", "redirected")
+
+
+class CrawlFrontier:
+    """URL queue, dedup set, per-URL state and scraped results of a crawl, in SQLite."""
+
+    def __init__(
+        self,
+        path: str,
+        resume: bool = False,
+        checkpoint_interval: float = 10.0,
+        max_attempts: int = 3,
+    ):
+        """
+        Args:
+            path: The SQLite database file.
+            resume: Continue the crawl saved in `path` instead of starting a new one.
+            checkpoint_interval: Maximum number of seconds between two commits.
+            max_attempts: Number of failed attempts after which a "retry" URL is not
+                queued again on resume.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.monotonic()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, description TEXT, "
+            "state TEXT NOT NULL, position INTEGER NOT NULL, redirect TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(urls)")]
+        if "attempts" not in columns:
+            self.connection.execute(
+                "ALTER TABLE urls ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+            )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS queue ON urls (state, position)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (url TEXT PRIMARY KEY, description TEXT)"
+        )
+        # URLs being visited when the previous run stopped, or whose visit failed for a
+        # reason that may have gone away, have to be visited again.
+        self.connection.execute(
+            "UPDATE urls SET state = 'pending' "
+            "WHERE state = 'in_progress' OR (state = 'retry' AND attempts < ?)",
+            (max_attempts,),
+        )
+        self.connection.commit()
+        self.next_position = self.connection.execute(
+            "SELECT COALESCE(MAX(position), 0) + 1 FROM urls"
+        ).fetchone()[0]
+        if resume:
+            logger.info(f"Resuming crawl from {path}: {self.counts()}")
+
+    def add(self, url: str, description: Any) -> bool:
+        """Queue a URL unless it was queued before. Returns whether it was new."""
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO urls (url, description, state, position) "
+            "VALUES (?, ?, 'pending', ?)",
+            (url, json.dumps(description), self.next_position),
+        )
+        self.next_position += 1
+        return cursor.rowcount == 1
+
+    def pending(self, limit: Optional[int] = None) -> List[Tuple[str, Any]]:
+        """Pending URLs and their descriptions, in queue order."""
+        rows = self.connection.execute(
+            "SELECT url, description FROM urls WHERE state = 'pending' ORDER BY position "
+            "LIMIT ?",
+            (-1 if limit is None else limit,),
+        )
+        return [(url, json.loads(description)) for url, description in rows]
+
+    def pop(self) -> Optional[Tuple[str, Any]]:
+        """Take the next pending URL and mark it in progress."""
+        next_urls = self.pending(limit=1)
+        if not next_urls:
+            return None
+        self.mark(next_urls[0][0], "in_progress")
+        return next_urls[0]
+
+    def mark(self, url: str, state: str, redirect: Optional[str] = None) -> None:
+        """Set the state of a URL; marking it "retry" counts a failed attempt."""
+        if state not in STATES:
+            raise ValueError(f"Unknown crawl state {state!r}, expected one of {STATES}")
+        self.connection.execute(
+            "UPDATE urls SET state = ?, redirect = COALESCE(?, redirect), "
+            "attempts = attempts + ? WHERE url = ?",
+            (state, redirect, int(state == "retry"), url),
+        )
+
+    def save_result(self, url: str, description: Any) -> None:
+        """Add or update a scraped URL description, keeping its original position."""
+        self.connection.execute(
+            "INSERT INTO results (url, description) VALUES (?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET description = excluded.description",
+            (url, json.dumps(description)),
+        )
+
+    def urls(self) -> List[str]:
+        return [url for (url,) in self.connection.execute("SELECT url FROM urls")]
+
+    def redirects(self) -> Dict[str, str]:
+        rows = self.connection.execute("SELECT url, redirect FROM urls WHERE redirect IS NOT NULL")
+        return dict(rows.fetchall())
+
+    def results(self) -> Dict[str, Any]:
+        rows = self.connection.execute("SELECT url, description FROM results ORDER BY rowid")
+        return {url: json.loads(description) for url, description in rows}
+
+    def counts(self) -> Dict[str, int]:
+        rows = self.connection.execute("SELECT state, COUNT(*) FROM urls GROUP BY state")
+        return dict(rows.fetchall())
+
+    def checkpoint(self, force: bool = False) -> None:
+        """Commit pending writes if `checkpoint_interval` has passed (or if forced)."""
+        now = time.monotonic()
+        if force or now - self.last_checkpoint >= self.checkpoint_interval:
+            self.connection.commit()
+            self.last_checkpoint = now
+
+    def close(self) -> None:
+        self.checkpoint(force=True)
+        self.connection.close()
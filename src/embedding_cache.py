@@ -0,0 +1,333 @@
+""" Persistent, content-addressed cache of text embeddings.
+
+Shared footers, navigation boilerplate and popular questions are embedded over and over,
+by `indexing.py` on every run and by the retriever on every query. `EmbeddingCache`
+stores each vector once, keyed by the sha256 of its text, in a directory per model:
+- `vectors.float16`: a fixed-capacity float16 (or float32) array that is memory-mapped,
+    so lookups only read the rows they need.
+- `index.sqlite`: maps each text hash to its row and last use time, which drives the
+    least-recently-used eviction once `max_entries` rows are taken.
+- `keys.uint64`: a checksum of the text hash stored in each row, checked on every read,
+    so a row another worker is evicting and overwriting reads as a miss.
+
+Slots are taken from the free ones and the evicted ones in a committed transaction
+before any row is overwritten, and only become visible once their vectors are written.
+Evicted entries are dropped for good: if storing the new vectors fails, their slots go
+back to the free list.
+
+`CachedEmbeddings` wraps any LangChain `Embeddings` with the cache. Query and document
+embeddings are keyed separately, since some models embed them differently. Its async
+methods run the cache's SQLite and memmap I/O in a worker thread, off the event loop.
+
+Example usage:
+```python
+cache = EmbeddingCache("../data/embedding_cache", "Alibaba-NLP/gte-base-en-v1.5")
+embedding_function = CachedEmbeddings(get_embedding_function(), cache)
+```
+"""
+
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+
+# SQLite limits the number of variables in one statement.
+QUERY_BATCH_SIZE = 500
+
+
+def get_text_key(text: str, kind: str = "document") -> str:
+    return hashlib.sha256(f"{kind}\n{text}".encode("utf-8")).hexdigest()
+
+
+def get_key_checksum(key: str) -> np.uint64:
+    """First 64 bits of a text key, never 0, which marks a row being written."""
+    return np.uint64(int(key[:16], 16) or 1)
+
+
+class EmbeddingCache:
+    """Memory-mapped embedding vectors of one model, indexed by text hash in SQLite."""
+
+    def __init__(
+        self,
+        path: str,
+        model_name: str,
+        max_entries: int = 200000,
+        dtype: str = "float16",
+    ):
+        """
+        Args:
+            path: The cache directory; each model gets its own sub-directory.
+            model_name: The embedding model the vectors come from.
+            max_entries: Number of vectors kept before the least recently used are evicted.
+            dtype: "float16" halves the file size, "float32" keeps full precision.
+        """
+        self.directory = os.path.join(path, model_name.replace("/", "__"))
+        os.makedirs(self.directory, exist_ok=True)
+        self.model_name = model_name
+        self.capacity = max_entries
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(self.directory, f"vectors.{self.dtype.name}")
+        self.vectors: Optional[np.memmap] = None
+        self.checksums: Optional[np.memmap] = None
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(
+            os.path.join(self.directory, "index.sqlite"), check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, slot INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS lru ON entries (last_used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS free_slots (slot INTEGER PRIMARY KEY)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.commit()
+        dim = self.get_meta("dim")
+        if dim is not None:
+            self.open_vectors(int(dim))
+
+    def get_meta(self, name: str) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name: str, value) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value))
+        )
+
+    def select_slots(self, keys: Sequence[str]) -> Dict[str, int]:
+        slots = {}
+        for start in range(0, len(keys), QUERY_BATCH_SIZE):
+            batch = keys[start : start + QUERY_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT key, slot FROM entries WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            slots.update(rows)
+        return slots
+
+    def open_vectors(self, dim: int) -> None:
+        """Map the vector and checksum files, growing them if `max_entries` was raised."""
+        capacity = max(self.capacity, int(self.get_meta("capacity") or 0))
+        checksums_path = os.path.join(self.directory, "keys.uint64")
+        if self.get_meta("next_slot") is None:
+            # Rows of a cache written before checksums existed cannot be checked
+            self.connection.execute("DELETE FROM entries")
+            self.connection.execute("DELETE FROM free_slots")
+            self.set_meta("next_slot", 0)
+        for path, dtype, row_size in [
+            (self.vectors_path, self.dtype, dim),
+            (checksums_path, np.dtype(np.uint64), 1),
+        ]:
+            size = capacity * row_size * dtype.itemsize
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                with open(path, "ab") as file:
+                    file.truncate(size)  # Sparse on Linux: untouched rows take no disk space.
+        self.vectors = np.memmap(
+            self.vectors_path, dtype=self.dtype, mode="r+", shape=(capacity, dim)
+        )
+        self.checksums = np.memmap(checksums_path, dtype=np.uint64, mode="r+", shape=(capacity,))
+        self.capacity = capacity
+        self.set_meta("dim", dim)
+        self.set_meta("capacity", capacity)
+        self.connection.commit()
+
+    def read_row(self, key: str, slot: int) -> Optional[np.ndarray]:
+        """The vector in a slot, or None if the slot does not hold this key (anymore)."""
+        checksum = get_key_checksum(key)
+        if self.checksums[slot] != checksum:
+            return None
+        vector = np.asarray(self.vectors[slot], dtype=np.float32)
+        # A writer clears the checksum before overwriting the row
+        return vector if self.checksums[slot] == checksum else None
+
+    def write_row(self, key: str, slot: int, vector: Sequence[float]) -> None:
+        self.checksums[slot] = 0
+        self.vectors[slot] = vector
+        self.checksums[slot] = get_key_checksum(key)
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Return the cached vector of each key, or None if it is not cached."""
+        if not keys:
+            return []
+        with self.lock:
+            if self.vectors is None:
+                slots = {}
+            else:
+                slots = self.select_slots(list(dict.fromkeys(keys)))
+            if slots:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in slots],
+                )
+                self.connection.commit()
+            results = [
+                self.read_row(key, slots[key]) if key in slots else None for key in keys
+            ]
+        hits = sum(result is not None for result in results)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def reserve_slots(self, keys: Sequence[str]) -> Tuple[List[str], List[int], int]:
+        """Take slots for the keys that are not cached yet, evicting the least recently used.
+
+        The evictions and the reservation are committed before any row is written, so no
+        reader finds the key of a row being overwritten and no writer takes the same slot.
+
+        Returns:
+            The keys to store, their slots and the number of evicted entries.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")  # Serialize slot allocation across workers.
+        try:
+            existing = self.select_slots(list(keys))
+            keys = [key for key in keys if key not in existing][-self.capacity :]
+            free = [
+                slot for (slot,) in self.connection.execute(
+                    "SELECT slot FROM free_slots ORDER BY slot LIMIT ?", (len(keys),)
+                )
+            ]
+            self.connection.executemany(
+                "DELETE FROM free_slots WHERE slot = ?", [(slot,) for slot in free]
+            )
+            next_slot = int(self.get_meta("next_slot"))
+            fresh = list(range(next_slot, min(next_slot + len(keys) - len(free), self.capacity)))
+            self.set_meta("next_slot", next_slot + len(fresh))
+            slots = free + fresh
+            evict = len(keys) - len(slots)
+            if evict > 0:
+                rows = self.connection.execute(
+                    "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (evict,)
+                ).fetchall()
+                self.connection.executemany(
+                    "DELETE FROM entries WHERE key = ?", [(key,) for key, _ in rows]
+                )
+                slots.extend(slot for _, slot in rows)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        return keys[: len(slots)], slots, max(evict, 0)
+
+    def release_slots(self, slots: Sequence[int]) -> None:
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO free_slots (slot) VALUES (?)", [(slot,) for slot in slots]
+        )
+        self.connection.commit()
+
+    def put_many(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """Store vectors, evicting the least recently used ones when the cache is full."""
+        new = dict(zip(keys, vectors))
+        if not new:
+            return
+        with self.lock:
+            if self.vectors is None:
+                self.open_vectors(len(next(iter(new.values()))))
+            keys, slots, evict = self.reserve_slots(list(new))
+            if not keys:
+                return
+            try:
+                for key, slot in zip(keys, slots):
+                    self.write_row(key, slot, new[key])
+                self.vectors.flush()
+                self.checksums.flush()
+                self.connection.execute("BEGIN IMMEDIATE")
+                now = time.time()
+                # Another worker may have stored some of the keys in the meantime
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                    [(key, slot, now) for key, slot in zip(keys, slots)],
+                )
+                stored = set(self.select_slots(keys).values())
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                # The evicted entries are gone; only their slots are given back
+                self.release_slots(slots)
+                raise
+            unused = [slot for slot in slots if slot not in stored]
+            if unused:
+                self.release_slots(unused)
+        if evict > 0:
+            logger.info(f"Evicted {evict} vectors from the embedding cache")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "model": self.model_name,
+            "entries": entries,
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """Serve embeddings from an `EmbeddingCache`, embedding and storing only the misses."""
+
+    def __init__(self, embedding_function: Embeddings, cache: EmbeddingCache):
+        self.embedding_function = embedding_function
+        self.cache = cache
+
+    def lookup(self, texts: List[str], kind: str):
+        """Return the cached vector (or None) of each text and the unique texts to embed."""
+        try:
+            vectors = self.cache.get_many([get_text_key(text, kind) for text in texts])
+        except Exception as error:
+            logger.warning(f"Embedding cache lookup failed: {error}")
+            vectors = [None] * len(texts)
+        missing = [text for text, vector in zip(texts, vectors) if vector is None]
+        missing = list(dict.fromkeys(missing))
+        return vectors, missing
+
+    def update(self, texts, vectors, missing, embedded, kind) -> List[List[float]]:
+        """Store the new vectors and merge them with the cached ones, in input order."""
+        computed = dict(zip(missing, embedded))
+        try:
+            self.cache.put_many([get_text_key(text, kind) for text in missing], embedded)
+        except Exception as error:
+            logger.warning(f"Embedding cache update failed: {error}")
+        return [
+            computed[text] if vector is None else vector.tolist()
+            for text, vector in zip(texts, vectors)
+        ]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors, missing = self.lookup(texts, "document")
+        embedded = self.embedding_function.embed_documents(missing) if missing else []
+        return self.update(texts, vectors, missing, embedded, "document")
+
+    def embed_query(self, text: str) -> List[float]:
+        vectors, missing = self.lookup([text], "query")
+        embedded = [self.embedding_function.embed_query(text)] if missing else []
+        return self.update([text], vectors, missing, embedded, "query")[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors, missing = await asyncio.to_thread(self.lookup, texts, "document")
+        embedded = await self.embedding_function.aembed_documents(missing) if missing else []
+        return await asyncio.to_thread(
+            self.update, texts, vectors, missing, embedded, "document"
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vectors, missing = await asyncio.to_thread(self.lookup, [text], "query")
+        embedded = [await self.embedding_function.aembed_query(text)] if missing else []
+        updated = await asyncio.to_thread(self.update, [text], vectors, missing, embedded, "query")
+        return updated[0]
@@ -0,0 +1,169 @@
+""" Batched, multi-core embedding of document chunks for index builds.
+
+The main functionality is provided by `EmbeddingPipeline.index()`, which:
+1. Sorts the chunks by text length so every batch holds texts of similar length and
+    little compute is wasted on padding.
+2. Embeds the sorted chunks window by window. With a sentence-transformers model and
+    `processes` > 1, each window is spread over a pool of encoder processes (one per
+    core by default); otherwise it is embedded in batches of `batch_size` in-process.
+3. Inserts each window into Chroma with its precomputed embeddings as soon as it is
+    ready, instead of one giant insert at the end.
+4. Logs progress and throughput (chunks/sec) after every window.
+
+When the embedding function is a `CachedEmbeddings`, chunks whose text is already in
+the embedding cache are not encoded again, and new vectors are added to the cache.
+
+Example usage:
+```python
+pipeline = EmbeddingPipeline(embedding_function, batch_size=64, processes=32)
+pipeline.index(vectorstore, {chunk_id: chunk, ...})
+```
+"""
+
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+import os
+import time
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+from embedding_cache import CachedEmbeddings, get_text_key
+
+
+@contextmanager
+def threads_per_process(threads: int) -> Iterator[None]:
+    """Limit the BLAS/OpenMP threads of processes spawned inside the block."""
+    previous = os.environ.get("OMP_NUM_THREADS")
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("OMP_NUM_THREADS", None)
+        else:
+            os.environ["OMP_NUM_THREADS"] = previous
+
+
+class EmbeddingPipeline:
+    """Embed chunks in length-sorted batches, optionally across processes, and index them."""
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        batch_size: int = 64,
+        processes: Optional[int] = None,
+        insert_batch_size: int = 500,
+    ):
+        """
+        Args:
+            embedding_function: The embedding model used by the retriever.
+            batch_size: Number of texts per encoder forward pass.
+            processes: Number of encoder processes; defaults to one per core. 1 embeds
+                in-process. Only sentence-transformers models can use several processes.
+            insert_batch_size: Number of chunks embedded and inserted per window.
+        """
+        self.cache = None
+        if isinstance(embedding_function, CachedEmbeddings):
+            self.cache = embedding_function.cache
+            embedding_function = embedding_function.embedding_function
+        self.embedding_function = embedding_function
+        self.batch_size = batch_size
+        self.processes = processes or os.cpu_count() or 1
+        self.insert_batch_size = insert_batch_size
+        self.model = getattr(embedding_function, "client", None)
+        self.encode_kwargs = getattr(embedding_function, "encode_kwargs", {})
+        self.pool = None
+        self.started = False
+
+    def start(self) -> None:
+        """Start the encoder processes, if the model supports them."""
+        self.started = True
+        if self.processes <= 1 or not hasattr(self.model, "start_multi_process_pool"):
+            return
+        threads = max(1, (os.cpu_count() or 1) // self.processes)
+        try:
+            with threads_per_process(threads):
+                self.pool = self.model.start_multi_process_pool(["cpu"] * self.processes)
+            logger.info(f"Started {self.processes} encoder processes")
+        except Exception as error:
+            logger.warning(f"Failed to start encoder processes, embedding in-process: {error}")
+            self.pool = None
+
+    def stop(self) -> None:
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+        self.started = False
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts, preserving their order, reading and updating the cache if any."""
+        if self.cache is None:
+            return self.encode(texts)
+        keys = [get_text_key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if not missing:
+            return np.stack(cached)
+        encoded = self.encode([texts[i] for i in missing])
+        self.cache.put_many([keys[i] for i in missing], encoded)
+        for i, vector in zip(missing, encoded):
+            cached[i] = vector
+        return np.stack(cached).astype(np.float32)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Run the model on texts, in the encoder processes if they are running."""
+        if not self.started:
+            self.start()  # Only pay for the process pool once there is something to encode.
+        if self.pool is not None:
+            # Same preprocessing as HuggingFaceEmbeddings.embed_documents.
+            texts = [text.replace("\n", " ") for text in texts]
+            return self.model.encode_multi_process(
+                texts,
+                self.pool,
+                batch_size=self.batch_size,
+                normalize_embeddings=self.encode_kwargs.get("normalize_embeddings", False),
+            )
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(
+                self.embedding_function.embed_documents(texts[start : start + self.batch_size])
+            )
+        return np.asarray(vectors, dtype=np.float32)
+
+    def index(self, vectorstore, chunks: Dict[str, Document]) -> None:
+        """Embed the chunks and stream them into the Chroma vector store.
+
+        Args:
+            vectorstore: The Chroma vector store to insert into.
+            chunks: The chunks to insert, keyed by chunk id.
+        """
+        if not chunks:
+            return
+        ids = sorted(chunks, key=lambda chunk_id: len(chunks[chunk_id].page_content))
+        start_time = time.perf_counter()
+        try:
+            for start in range(0, len(ids), self.insert_batch_size):
+                window = ids[start : start + self.insert_batch_size]
+                texts = [chunks[chunk_id].page_content for chunk_id in window]
+                vectors = self.embed(texts)
+                vectorstore._collection.upsert(
+                    ids=window,
+                    embeddings=[vector.tolist() for vector in vectors],
+                    metadatas=[chunks[chunk_id].metadata for chunk_id in window],
+                    documents=texts,
+                )
+                done = start + len(window)
+                elapsed = time.perf_counter() - start_time
+                logger.info(
+                    f"Embedded and indexed {done}/{len(ids)} chunks "
+                    f"({done / elapsed:.1f} chunks/sec)"
+                )
+        finally:
+            self.stop()
+        elapsed = time.perf_counter() - start_time
+        logger.info(
+            f"Indexed {len(ids)} chunks in {elapsed:.1f}s ({len(ids) / elapsed:.1f} chunks/sec)"
+        )
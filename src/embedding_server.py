@@ -0,0 +1,234 @@
+""" Serve embeddings from one process to all CityHub API workers over a Unix socket.
+
+Every uvicorn worker used to load its own copy of the embedding model. In embedding
+server mode a single process owns the `HuggingFaceEmbeddings` model and workers use the
+thin `EmbeddingClient`, which implements the LangChain `Embeddings` interface.
+
+The server micro-batches concurrent requests: it waits up to `max_wait_ms` after the
+first pending request for others to arrive, encodes up to `max_batch_size` texts in one
+call and sends every client its slice of the result.
+
+Wire format (both directions start with a 4-byte big-endian length of a JSON header):
+- request header: `{"texts": [...]}`
+- response header: `{"n": <rows>, "dim": <columns>}` followed by n * dim float32
+    values, or `{"error": "<message>"}` with no payload.
+
+Example usage:
+```bash
+python src/embedding_server.py --socket /tmp/cityhub-embeddings.sock
+EMBEDDING_SOCKET=/tmp/cityhub-embeddings.sock python src/main.py
+```
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+
+HEADER = struct.Struct("!I")
+
+
+def encode_message(header: dict, payload: bytes = b"") -> bytes:
+    data = json.dumps(header).encode("utf-8")
+    return HEADER.pack(len(data)) + data + payload
+
+
+def decode_vectors(header: dict, payload: bytes) -> List[List[float]]:
+    vectors = np.frombuffer(payload, dtype=np.float32).reshape(header["n"], header["dim"])
+    return vectors.tolist()
+
+
+class EmbeddingServer:
+    """Own the embedding model and answer batched embed requests over a Unix socket."""
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        socket_path: str,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+    ):
+        """
+        Args:
+            embedding_function: The embedding model to serve.
+            socket_path: The path of the Unix socket to listen on.
+            max_batch_size: Maximum number of texts encoded in one call.
+            max_wait_ms: How long to wait for more requests before encoding a batch.
+        """
+        self.embedding_function = embedding_function
+        self.socket_path = socket_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # One encoder thread: the model already uses every core for a single batch.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def serve(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        batcher = asyncio.create_task(self.batch_loop())
+        logger.info(f"Serving embeddings on {self.socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+                except asyncio.IncompleteReadError:
+                    break  # Client closed the connection.
+                request = json.loads(await reader.readexactly(length))
+                future = loop.create_future()
+                await self.queue.put((request["texts"], future))
+                try:
+                    vectors = await future
+                except Exception as error:
+                    writer.write(encode_message({"error": str(error)}))
+                else:
+                    header = {"n": vectors.shape[0], "dim": vectors.shape[1]}
+                    writer.write(encode_message(header, vectors.tobytes()))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def next_batch(self) -> List[Tuple[List[str], asyncio.Future]]:
+        """Wait for a request, then collect more until the batch is full or time is up."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                vectors = await loop.run_in_executor(
+                    self.executor, self.embedding_function.embed_documents, texts
+                )
+                vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+            except Exception as error:
+                logger.error(f"Failed to embed a batch of {len(texts)} texts: {error}")
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            start = 0
+            for request_texts, future in batch:
+                future.set_result(vectors[start : start + len(request_texts)])
+                start += len(request_texts)
+
+
+class EmbeddingClient(Embeddings):
+    """Embed texts by calling an `EmbeddingServer` over its Unix socket."""
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()  # One connection per thread.
+
+    def connection(self) -> socket.socket:
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self.local.sock = sock
+        return sock
+
+    def receive(self, sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Embedding server closed the connection")
+            data.extend(chunk)
+        return bytes(data)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        sock = self.connection()
+        try:
+            sock.sendall(encode_message({"texts": texts}))
+            (length,) = HEADER.unpack(self.receive(sock, HEADER.size))
+            header = json.loads(self.receive(sock, length))
+            if "error" in header:
+                raise RuntimeError(f"Embedding server error: {header['error']}")
+            payload = self.receive(sock, header["n"] * header["dim"] * 4)
+        except (OSError, ConnectionError):
+            sock.close()
+            self.local.sock = None
+            raise
+        return decode_vectors(header, payload)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(encode_message({"texts": texts}))
+            await writer.drain()
+            (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+            header = json.loads(await reader.readexactly(length))
+            if "error" in header:
+                raise RuntimeError(f"Embedding server error: {header['error']}")
+            payload = await reader.readexactly(header["n"] * header["dim"] * 4)
+        finally:
+            writer.close()
+        return decode_vectors(header, payload)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+if __name__ == "__main__":
+    from agent_config import AgentConfig
+    from cityhub_agent import get_embedding_function
+
+    config = AgentConfig.from_env()
+    parser = ArgumentParser()
+    parser.add_argument("--socket", type=str, default="/tmp/cityhub-embeddings.sock")
+    parser.add_argument("--model", type=str, default=config.embedding_model)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    server = EmbeddingServer(
+        get_embedding_function(args.model),
+        socket_path=args.socket,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    asyncio.run(server.serve())
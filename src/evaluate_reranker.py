@@ -0,0 +1,121 @@
+""" Compare the cross-encoder reranker with the LLM retrieval grader.
+
+The main functionality is provided by the `evaluate()` function, which for every
+question of a fixed set:
+    1. Retrieves `candidates` documents with the configured retriever.
+    2. Grades them with the LLM retrieval grader (concurrent calls, no cache) and scores
+        them with the cross-encoder reranker, timing both.
+    3. Records whether each document passes the reranker threshold, and whether each
+        grader would send the question to web search (fewer than `retriever_k` relevant
+        documents).
+
+It then reports latency percentiles of both graders, and the agreement of the reranker
+with the LLM grader, per document and per web search decision, for a range of
+thresholds to help pick RERANK_THRESHOLD.
+
+Example usage (from the `src` directory, needs GROQ_API_KEY):
+```bash
+python evaluate_reranker.py --candidates 20 --thresholds 0.1 0.3 0.5 0.7
+```
+"""
+
+from argparse import ArgumentParser
+from statistics import median
+from typing import Dict, Sequence
+import time
+
+from loguru import logger
+
+from agent_config import AgentConfig
+from cityhub_agent import CityHubResources, get_retrieval_grader, get_retriever
+from reranker import CrossEncoderReranker
+
+QUESTIONS = [
+    "How do I apply for a residential parking permit?",
+    "How much does an RPP permit cost?",
+    "How to apply for the slow street program in SF?",
+    "How do I give feedback on a slow street?",
+    "How do I register to vote in San Francisco?",
+    "What do the colored curbs mean in San Francisco?",
+    "Can I park at a white curb?",
+    "How can I avoid parking tickets in SF?",
+    "What safety gear should motorcycle riders wear?",
+    "Who won the Giants game last night?",
+    "What is the weather in San Francisco right now?",
+]
+
+
+def evaluate(
+    config: AgentConfig, candidates: int = 20, thresholds: Sequence[float] = (0.5,)
+) -> Dict[str, object]:
+    """Grade the retrieved documents of every question with both graders."""
+    resources = CityHubResources(config)
+    sparse_index = resources.sparse_index if config.retriever_mode == "hybrid" else None
+    retriever = get_retriever(resources.vectorstore, k=candidates, sparse_index=sparse_index)
+    llm_grader = get_retrieval_grader(config.groq_model, timeout=config.grading_timeout)
+    reranker = CrossEncoderReranker(config.rerank_model, batch_size=config.rerank_batch_size)
+
+    llm_latencies, rerank_latencies, results = [], [], []
+    for question in QUESTIONS:
+        documents = retriever.invoke(question)
+        inputs = [{"question": question, "document": d.page_content} for d in documents]
+
+        start = time.perf_counter()
+        grades = llm_grader.batch(
+            inputs,
+            config={"max_concurrency": config.grading_max_concurrency},
+            return_exceptions=True,
+        )
+        llm_latencies.append(time.perf_counter() - start)
+        relevant = [
+            not isinstance(grade, Exception) and grade.binary_score.lower() == "yes"
+            for grade in grades
+        ]
+
+        start = time.perf_counter()
+        scores = reranker.score(question, documents)
+        rerank_latencies.append(time.perf_counter() - start)
+
+        results.append({"question": question, "relevant": relevant, "scores": scores.tolist()})
+        logger.info(
+            f"{question}: {sum(relevant)}/{len(documents)} relevant by LLM, "
+            f"reranker scores {scores.round(2)}"
+        )
+
+    agreement = {}
+    for threshold in thresholds:
+        documents_agree = documents_total = decisions_agree = 0
+        for result in results:
+            passed = [score >= threshold for score in result["scores"]]
+            documents_agree += sum(p == r for p, r in zip(passed, result["relevant"]))
+            documents_total += len(passed)
+            llm_web_search = sum(result["relevant"]) < config.retriever_k
+            rerank_web_search = sum(passed) < config.retriever_k
+            decisions_agree += llm_web_search == rerank_web_search
+        agreement[threshold] = {
+            "documents": documents_agree / max(documents_total, 1),
+            "web_search": decisions_agree / len(results),
+        }
+    return {
+        "llm_latency": {"p50": median(llm_latencies), "max": max(llm_latencies)},
+        "rerank_latency": {"p50": median(rerank_latencies), "max": max(rerank_latencies)},
+        "agreement": agreement,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.1, 0.3, 0.5, 0.7])
+    args = parser.parse_args()
+
+    report = evaluate(AgentConfig.from_env(), args.candidates, args.thresholds)
+    print(f"Questions: {len(QUESTIONS)}, candidates per question: {args.candidates}")
+    for name in ["llm_latency", "rerank_latency"]:
+        print(f"  {name}: p50={report[name]['p50']:.2f}s max={report[name]['max']:.2f}s")
+    for threshold, values in report["agreement"].items():
+        print(
+            f"  threshold {threshold:.2f}: document agreement {values['documents']:.0%}, "
+            f"web search agreement {values['web_search']:.0%}"
+        )
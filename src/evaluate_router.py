@@ -0,0 +1,143 @@
+""" Compare the local question router with the LLM router on labelled questions.
+
+The main functionality is provided by the `evaluate()` function, which for every
+labelled question:
+    1. Embeds the question and scores its corpus match, as the agent does.
+    2. Routes it with the local router for each margin, timing the decision.
+    3. Routes it with the LLM router (no cache), timing the call.
+
+It then reports, for each margin, the share of questions the local router decides
+without the LLM, the agreement of those decisions with the LLM router and with the
+labels, and the accuracy of the agent's routing (local decisions, LLM fallback for the
+rest), to help pick ROUTER_MARGIN and ROUTER_CORPUS_THRESHOLD.
+
+Example usage (from the `src` directory, needs GROQ_API_KEY):
+```bash
+python evaluate_router.py --margins 0.02 0.05 0.1 --corpus-threshold 0.5
+```
+"""
+
+from argparse import ArgumentParser
+from statistics import median
+from typing import Dict, Sequence
+import time
+
+from loguru import logger
+
+from agent_config import AgentConfig
+from cityhub_agent import configure, get_question_router, question_signals, source_to_route
+from local_router import LocalRouter
+
+LABELLED_QUESTIONS = [
+    ("How do I apply for a residential parking permit?", "vectorstore"),
+    ("Can I get a visitor permit for my guests?", "vectorstore"),
+    ("Where can I park my car overnight near Dolores Park?", "vectorstore"),
+    ("How do I join the slow streets program on my block?", "vectorstore"),
+    ("How do I give feedback on a slow street?", "vectorstore"),
+    ("Am I registered to vote in San Francisco?", "vectorstore"),
+    ("Can I park at a white curb?", "vectorstore"),
+    ("How can I avoid parking tickets in SF?", "vectorstore"),
+    ("My car was towed, how do I get it back?", "vectorstore"),
+    ("What safety gear should motorcycle riders wear?", "vectorstore"),
+    ("How do I report a broken streetlight?", "vectorstore"),
+    ("How do I get a permit for a block party?", "vectorstore"),
+    ("Who won the Giants game last night?", "websearch"),
+    ("What is the weather in San Francisco right now?", "websearch"),
+    ("Is there a Warriors game tonight?", "websearch"),
+    ("What are good brunch spots in North Beach?", "websearch"),
+    ("What exhibitions are on at SFMOMA this month?", "websearch"),
+    ("What happened at the Board of Supervisors meeting yesterday?", "websearch"),
+    ("How far is Napa from San Francisco?", "websearch"),
+    ("What is a good itinerary for two days in San Francisco?", "websearch"),
+    ("Who is the current mayor of San Francisco?", "websearch"),
+    ("Are there any BART delays now?", "websearch"),
+]
+
+
+def evaluate(config: AgentConfig, margins: Sequence[float] = (0.05,)) -> Dict[str, object]:
+    """Route every labelled question with the local routers and the LLM router."""
+    resources = configure(config)
+    llm_router = get_question_router(config.groq_model)
+    routers = {
+        margin: LocalRouter(
+            resources.embedding_function,
+            margin=margin,
+            corpus_threshold=config.router_corpus_threshold,
+        )
+        for margin in margins
+    }
+
+    signal_latencies, local_latencies, llm_latencies, results = [], [], [], []
+    for question, label in LABELLED_QUESTIONS:
+        start = time.perf_counter()
+        embedding, score = question_signals(question)
+        signal_latencies.append(time.perf_counter() - start)
+        if embedding is None:
+            raise RuntimeError("Could not embed the question, check the vector store")
+
+        decisions = {}
+        for margin, router in routers.items():
+            router.load_prototypes()
+            start = time.perf_counter()
+            decisions[margin] = router.route(question, embedding, score)
+            local_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        llm_route = source_to_route(llm_router.invoke({"question": question}))
+        llm_latencies.append(time.perf_counter() - start)
+
+        results.append(
+            {"question": question, "label": label, "llm": llm_route, "decisions": decisions}
+        )
+        logger.info(
+            f"{question}: label {label}, LLM {llm_route}, corpus {score:.2f}, local "
+            + ", ".join(f"{margin}: {d.route} ({d.reason})" for margin, d in decisions.items())
+        )
+
+    report = {}
+    for margin in margins:
+        decided = [result for result in results if result["decisions"][margin].route]
+        routes = [result["decisions"][margin].route or result["llm"] for result in results]
+        report[margin] = {
+            "local_rate": len(decided) / len(results),
+            "llm_agreement": sum(
+                r["decisions"][margin].route == r["llm"] for r in decided
+            ) / max(len(decided), 1),
+            "local_accuracy": sum(
+                r["decisions"][margin].route == r["label"] for r in decided
+            ) / max(len(decided), 1),
+            "accuracy": sum(
+                route == r["label"] for route, r in zip(routes, results)
+            ) / len(results),
+        }
+    return {
+        "signal_latency": {"p50": median(signal_latencies), "max": max(signal_latencies)},
+        "local_latency": {"p50": median(local_latencies), "max": max(local_latencies)},
+        "llm_latency": {"p50": median(llm_latencies), "max": max(llm_latencies)},
+        "llm_accuracy": sum(r["llm"] == r["label"] for r in results) / len(results),
+        "margins": report,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--margins", type=float, nargs="+", default=[0.02, 0.05, 0.1])
+    parser.add_argument("--corpus-threshold", type=float, default=None)
+    args = parser.parse_args()
+
+    config = AgentConfig.from_env()
+    if args.corpus_threshold is not None:
+        config.router_corpus_threshold = args.corpus_threshold
+    report = evaluate(config, args.margins)
+    print(f"Questions: {len(LABELLED_QUESTIONS)}, LLM accuracy {report['llm_accuracy']:.0%}")
+    for name in ["signal_latency", "local_latency", "llm_latency"]:
+        latency = report[name]
+        print(f"  {name}: p50={latency['p50'] * 1000:.2f}ms max={latency['max'] * 1000:.2f}ms")
+    for margin, values in report["margins"].items():
+        print(
+            f"  margin {margin:.2f}: decided locally {values['local_rate']:.0%}, "
+            f"LLM agreement {values['llm_agreement']:.0%}, "
+            f"local accuracy {values['local_accuracy']:.0%}, "
+            f"accuracy with fallback {values['accuracy']:.0%}"
+        )
@@ -0,0 +1,140 @@
+""" Compare the answer verification modes of the CityHub agent.
+
+The main functionality is provided by the `evaluate()` function, which for every
+question of a fixed set:
+    1. Retrieves documents with the configured retriever, compresses them as the agent
+        does (see `compress_context`) and generates an answer from the compressed context.
+    2. Verifies the answer, and the answer of another question as an off-topic
+        negative, against the same compressed context with every verification mode (no
+        cache), timing each.
+    3. Records the grounding and usefulness verdicts and the resulting route
+        ("useful", "not useful" or "not supported") of each mode.
+
+It then reports latency percentiles of every mode and the agreement of the grounding
+verdicts, usefulness verdicts and routes of each mode with the serial mode (the
+hallucination grader, then the answer grader), to help pick VERIFICATION_MODE.
+
+Example usage (from the `src` directory, needs GROQ_API_KEY):
+```bash
+python evaluate_verification.py --modes serial concurrent single_call
+```
+"""
+
+from argparse import ArgumentParser
+from statistics import median
+from typing import Dict, Sequence
+import time
+
+from loguru import logger
+
+from agent_config import AgentConfig
+from cityhub_agent import (
+    GENERATION_VERIFIERS,
+    compress_context,
+    configure,
+    is_grounded,
+    usefulness_to_route,
+)
+from loop_budget import LoopBudget
+
+QUESTIONS = [
+    "How do I apply for a residential parking permit?",
+    "How much does an RPP permit cost?",
+    "How to apply for the slow street program in SF?",
+    "How do I register to vote in San Francisco?",
+    "What do the colored curbs mean in San Francisco?",
+    "Can I park at a white curb?",
+    "How can I avoid parking tickets in SF?",
+    "What safety gear should motorcycle riders wear?",
+]
+
+
+def verdicts(grounded, useful) -> Dict[str, object]:
+    """Verdicts of a verification, with the route the agent would take."""
+    grounded = is_grounded(grounded)
+    useful = None if useful is None else usefulness_to_route(useful) == "useful"
+    route = "not supported" if not grounded else "useful" if useful else "not useful"
+    return {"grounded": grounded, "useful": useful, "route": route}
+
+
+def evaluate(
+    config: AgentConfig, modes: Sequence[str] = ("serial", "concurrent", "single_call")
+) -> Dict[str, object]:
+    """Verify the answer and an off-topic answer of every question with every mode."""
+    config.llm_cache_chains = []
+    resources = configure(config)
+
+    cases = []
+    for question in QUESTIONS:
+        # Generate from, and verify against, the context the agent would use
+        context = compress_context(question, resources.retriever.invoke(question))
+        generation = resources.rag_chain.invoke({"context": context, "question": question})
+        cases.append({"question": question, "documents": context, "generation": generation})
+    # The answer of the next question is an off-topic, ungrounded answer to this one
+    negatives = [
+        {**case, "generation": cases[(i + 1) % len(cases)]["generation"], "negative": True}
+        for i, case in enumerate(cases)
+    ]
+
+    latencies = {mode: [] for mode in modes}
+    results = []
+    for case in cases + negatives:
+        result = {"question": case["question"], "negative": case.get("negative", False)}
+        for mode in modes:
+            verifier, _ = GENERATION_VERIFIERS[mode]
+            start = time.perf_counter()
+            grounded, useful = verifier(
+                case["question"], case["documents"], case["generation"], LoopBudget(None)
+            )
+            latencies[mode].append(time.perf_counter() - start)
+            result[mode] = verdicts(grounded, useful)
+        results.append(result)
+        logger.info(
+            f"{case['question']} ({'negative' if result['negative'] else 'answer'}): "
+            + ", ".join(f"{mode}: {result[mode]['route']}" for mode in modes)
+        )
+
+    agreement = {}
+    for mode in modes:
+        agreement[mode] = {}
+        for verdict in ["grounded", "useful", "route"]:
+            # Serial grading skips the usefulness check of ungrounded answers
+            pairs = [
+                (result[mode][verdict], result["serial"][verdict])
+                for result in results
+                if "serial" in result and result["serial"][verdict] is not None
+            ]
+            agreement[mode][verdict] = (
+                sum(a == b for a, b in pairs) / len(pairs) if pairs else None
+            )
+    return {
+        "latency": {
+            mode: {"p50": median(values), "max": max(values)}
+            for mode, values in latencies.items()
+        },
+        "agreement": agreement,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--modes", nargs="+", default=["serial", "concurrent", "single_call"],
+        choices=list(GENERATION_VERIFIERS),
+    )
+    args = parser.parse_args()
+
+    report = evaluate(AgentConfig.from_env(), args.modes)
+    print(f"Questions: {len(QUESTIONS)}, each with its answer and an off-topic answer")
+    for mode in args.modes:
+        latency = report["latency"][mode]
+        agreement = ", ".join(
+            f"{verdict} {value:.0%}"
+            for verdict, value in report["agreement"][mode].items()
+            if value is not None
+        )
+        print(
+            f"  {mode}: p50={latency['p50']:.2f}s max={latency['max']:.2f}s, "
+            f"agreement with serial: {agreement or 'n/a'}"
+        )
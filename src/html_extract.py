@@ -0,0 +1,370 @@
+""" Single-pass text and link extraction from HTML, without building a parse tree.
+
+BeautifulSoup builds a full tree of Python objects (with the pure-Python `html5lib`
+parser in `web_scraper`) only for the scrapers to read the links and the text of a page.
+`extract_page()` instead streams the parser events into a `PageExtractor` that keeps:
+- the anchors with an href, with their class attribute, so the sf.gov topic cards
+    (`class="sfgov-topic-card"`) can be selected without a tree,
+- the visible text (everything outside script, style, noscript and template tags),
+- the main content text, without the header, footer, navigation and sidebars that
+    sf.gov repeats on every page (see `PageExtractor`), for indexing,
+- the title, description and language, and the `<base href>` used to resolve relative
+    links.
+
+Two backends feed the extractor:
+- "lxml": libxml2's HTML parser with a parser target, used when lxml is installed.
+- "html.parser": the standard library `HTMLParser`, always available.
+
+The backend is picked by the HTML_PARSER environment variable ("auto" by default: lxml
+if installed). "html5lib" is only supported by BeautifulSoup, so in that case the
+extractor uses "html.parser".
+
+Example usage:
+```python
+page = extract_page(html, "https://www.sf.gov/", link_class="sfgov-topic-card")
+page.links  # Absolute URLs of the topic cards.
+page.text
+```
+
+Run as a script to compare parse time and memory of the backends and of BeautifulSoup
+on the pages saved in the HTTP cache (or on HTML files):
+```bash
+python src/html_extract.py --limit 200
+```
+"""
+
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from statistics import mean
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlparse, urlunparse
+import os
+import sqlite3
+import time
+import tracemalloc
+
+from loguru import logger
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Tags whose content is not visible text.
+HIDDEN_TAGS = {"script", "style", "noscript", "template"}
+# Site chrome repeated on every page, and the elements holding the page's own content.
+BOILERPLATE_TAGS = {"nav", "aside"}
+BOILERPLATE_ROLES = {"banner", "navigation", "contentinfo", "complementary", "search"}
+MAIN_TAGS = {"main", "article"}
+# Site header and footer only at page level: inside these elements, a header or footer
+# belongs to the content (the header of an article holds its h1).
+LANDMARK_TAGS = {"header", "footer"}
+SECTIONING_TAGS = {"main", "article", "section", "nav", "aside"}
+# Elements that start a new line of text.
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption",
+    "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main",
+    "nav", "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul",
+}
+# Elements without an end tag.
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr",
+}
+
+
+def get_backend(name: Optional[str] = None) -> str:
+    """Resolve a parser name ("auto", "lxml", "html.parser" or "html5lib")."""
+    name = name or os.getenv("HTML_PARSER", "auto")
+    if name == "auto":
+        return "lxml" if etree is not None else "html.parser"
+    if name == "lxml" and etree is None:
+        logger.warning("lxml is not installed, parsing HTML with html.parser")
+        return "html.parser"
+    if name not in ("lxml", "html.parser", "html5lib"):
+        raise ValueError(f"Unknown HTML parser {name!r}")
+    return name
+
+
+def join_lines(parts: List[str]) -> str:
+    """Join text pieces, dropping blank lines and trailing spaces."""
+    lines = "".join(parts).splitlines()
+    return "\n".join(line.rstrip() for line in lines if line.strip())
+
+
+@dataclass
+class PageContent:
+    """Text, links and metadata of a page."""
+
+    text: str  # All visible text.
+    main_text: str = ""  # Visible text of the main content, without the boilerplate.
+    links: List[str] = field(default_factory=list)  # Absolute URLs, in page order.
+    title: Optional[str] = None
+    description: Optional[str] = None
+    language: Optional[str] = None
+
+
+class PageExtractor:
+    """Parser target collecting links and visible text from start/end/data events.
+
+    Besides all visible text, it keeps the main content of the page: the text of the
+    `<main>` / `<article>` / `role="main"` elements if there are any, else the whole page,
+    in both cases without the site header, footer, navigation and sidebars. A `<header>`
+    or `<footer>` is only the site's when it is not inside a sectioning element or the
+    main content, as for the banner and contentinfo landmarks of ARIA.
+
+    The methods follow lxml's parser target interface; `StreamingHTMLParser` adapts the
+    standard library parser to it.
+    """
+
+    def __init__(self, url: str, link_class: Optional[str] = None):
+        """
+        Args:
+            url: The URL of the page. Without a base tag, links are resolved against its
+                scheme and host.
+            link_class: Only keep the links of anchors with this class.
+        """
+        parsed_url = urlparse(url)
+        self.base_url = urlunparse((parsed_url.scheme, parsed_url.netloc, "", "", "", ""))
+        self.has_base = False
+        self.link_class = link_class
+        self.hrefs: List[str] = []
+        self.text: List[str] = []
+        self.content_text: List[str] = []  # Visible text outside boilerplate.
+        self.main_text: List[str] = []  # Visible text inside main content.
+        self.title: List[str] = []
+        self.description: Optional[str] = None
+        self.language: Optional[str] = None
+        self.hidden_depth = 0
+        self.in_title = False
+        # Open elements per tag name, and the (kind, tag, depth) of the boilerplate and
+        # main content elements that are open, to find where they end.
+        self.open_tags: Dict[str, int] = {}
+        self.regions: List[Tuple[str, str, int]] = []
+        self.region_depths = {"boilerplate": 0, "main": 0}
+
+    def region_kind(self, tag: str, attrib: Dict[str, Optional[str]]) -> Optional[str]:
+        role = attrib.get("role")
+        if tag in BOILERPLATE_TAGS or role in BOILERPLATE_ROLES:
+            return "boilerplate"
+        if tag in LANDMARK_TAGS and not self.in_section():
+            return "boilerplate"
+        if tag in MAIN_TAGS or role == "main":
+            return "main"
+        return None
+
+    def in_section(self) -> bool:
+        return bool(self.region_depths["main"]) or any(
+            self.open_tags.get(tag) for tag in SECTIONING_TAGS
+        )
+
+    def start(self, tag: str, attrib: Dict[str, Optional[str]]) -> None:
+        if tag not in VOID_TAGS:
+            self.open_tags[tag] = self.open_tags.get(tag, 0) + 1
+            kind = self.region_kind(tag, attrib)
+            if kind is not None:
+                self.regions.append((kind, tag, self.open_tags[tag]))
+                self.region_depths[kind] += 1
+
+        if tag in BLOCK_TAGS:
+            self.data("\n")
+        if tag in HIDDEN_TAGS:
+            self.hidden_depth += 1
+        elif tag == "a":
+            href = attrib.get("href")
+            if href and (
+                self.link_class is None
+                or self.link_class in (attrib.get("class") or "").split()
+            ):
+                self.hrefs.append(href)
+        elif tag == "title":
+            self.in_title = True
+        elif tag == "base" and not self.has_base and attrib.get("href"):
+            self.base_url = attrib["href"]
+            self.has_base = True
+        elif tag == "meta" and attrib.get("name") == "description":
+            self.description = attrib.get("content")
+        elif tag == "html" and attrib.get("lang"):
+            self.language = attrib["lang"]
+
+    def end(self, tag: str) -> None:
+        if self.open_tags.get(tag):
+            # Close the region if this is its own end tag, not the one of a nested element.
+            if self.regions and self.regions[-1][1:] == (tag, self.open_tags[tag]):
+                kind, _, _ = self.regions.pop()
+                self.region_depths[kind] -= 1
+            self.open_tags[tag] -= 1
+
+        if tag in HIDDEN_TAGS:
+            self.hidden_depth = max(self.hidden_depth - 1, 0)
+        elif tag == "title":
+            self.in_title = False
+        elif tag in BLOCK_TAGS:
+            self.data("\n")
+
+    def data(self, data: str) -> None:
+        if self.hidden_depth:
+            return
+        self.text.append(data)
+        if self.in_title:
+            self.title.append(data)
+        if not self.region_depths["boilerplate"]:
+            self.content_text.append(data)
+            if self.region_depths["main"]:
+                self.main_text.append(data)
+
+    def close(self) -> PageContent:
+        main_text = join_lines(self.main_text)
+        return PageContent(
+            text=join_lines(self.text),
+            main_text=main_text or join_lines(self.content_text),
+            links=[urljoin(self.base_url, href) for href in self.hrefs],
+            title="".join(self.title).strip() if self.title else None,
+            description=self.description,
+            language=self.language,
+        )
+
+
+class StreamingHTMLParser(HTMLParser):
+    """Standard library parser forwarding its events to a `PageExtractor`."""
+
+    def __init__(self, target: PageExtractor):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        self.target.start(tag, dict(attrs))
+        self.target.end(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        self.target.end(tag)
+
+    def handle_data(self, data: str) -> None:
+        self.target.data(data)
+
+
+def extract_page(
+    html: str, url: str, link_class: Optional[str] = None, backend: Optional[str] = None
+) -> PageContent:
+    """Extract the text and links of a page in one pass.
+
+    Args:
+        html: The HTML content of the page.
+        url: The URL of the page.
+        link_class: Only keep the links of anchors with this class.
+        backend: "lxml" or "html.parser", defaults to the HTML_PARSER setting.
+
+    Returns:
+        The visible text, title and absolute link URLs of the page.
+    """
+    target = PageExtractor(url, link_class=link_class)
+    if get_backend(backend) == "lxml":
+        parser = etree.HTMLParser(target=target)
+        parser.feed(html)
+        return parser.close()
+    parser = StreamingHTMLParser(target)
+    parser.feed(html)
+    parser.close()
+    return target.close()
+
+
+def extract_text(html: str, backend: Optional[str] = None) -> str:
+    """Visible text of a page, e.g. as `RecursiveUrlLoader` extractor."""
+    return extract_page(html, "", backend=backend).text
+
+
+def load_cached_pages(path: str, limit: int) -> List[Tuple[str, str]]:
+    """(URL, HTML) of the HTML pages saved in the HTTP cache."""
+    connection = sqlite3.connect(path)
+    rows = connection.execute(
+        "SELECT url, headers, body FROM responses WHERE status = 200 LIMIT ?", (limit,)
+    ).fetchall()
+    connection.close()
+    return [
+        (url, body.decode("utf-8", errors="replace"))
+        for url, headers, body in rows
+        if "text/html" in headers.lower()
+    ]
+
+
+def benchmark(pages: List[Tuple[str, str]], repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """Time the parsers on the pages, and measure their peak Python memory.
+
+    Every method extracts the links and text of each page. The BeautifulSoup methods do
+    it like `web_scraper` did: build a soup, then `find_all("a")` and `get_text()`.
+    Memory is measured with `tracemalloc`, which does not see libxml2's own allocations.
+    """
+    from bs4 import BeautifulSoup
+
+    def soup_method(parser: str) -> Callable[[str, str], object]:
+        def parse(html: str, url: str) -> object:
+            soup = BeautifulSoup(html, parser)
+            return [link["href"] for link in soup.find_all("a", href=True)], soup.get_text()
+
+        return parse
+
+    methods = {
+        "bs4/html5lib": soup_method("html5lib"),
+        "bs4/html.parser": soup_method("html.parser"),
+        "stream/html.parser": lambda html, url: extract_page(html, url, backend="html.parser"),
+    }
+    if etree is not None:
+        methods["bs4/lxml"] = soup_method("lxml")
+        methods["stream/lxml"] = lambda html, url: extract_page(html, url, backend="lxml")
+
+    megabytes = sum(len(html) for _, html in pages) / 1e6
+    report = {}
+    for name, parse in methods.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for url, html in pages:
+                parse(html, url)
+        elapsed = (time.perf_counter() - start) / repeat
+
+        peaks = []
+        for url, html in pages:
+            tracemalloc.start()
+            parse(html, url)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        report[name] = {
+            "ms_per_page": 1000 * elapsed / len(pages),
+            "mb_per_s": megabytes / elapsed,
+            "peak_kb_mean": mean(peaks) / 1024,
+            "peak_kb_max": max(peaks) / 1024,
+        }
+        logger.info(f"{name}: {report[name]}")
+    return report
+
+
+if __name__ == "__main__":
+    from http_cache import DEFAULT_PATH
+
+    parser = ArgumentParser()
+    parser.add_argument("--cache", type=str, default=os.getenv("HTTP_CACHE_PATH") or DEFAULT_PATH)
+    parser.add_argument("--files", type=str, nargs="*", help="HTML files instead of the cache.")
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.files:
+        pages = []
+        for path in args.files:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                pages.append(("https://www.sf.gov/", f.read()))
+    else:
+        pages = load_cached_pages(args.cache, args.limit)
+    if not pages:
+        raise SystemExit("No pages to parse: fetch some pages first or pass --files.")
+
+    print(f"{len(pages)} pages, {sum(len(html) for _, html in pages) / 1e6:.1f} MB")
+    for name, values in benchmark(pages, repeat=args.repeat).items():
+        print(
+            f"  {name:20} {values['ms_per_page']:7.2f} ms/page {values['mb_per_s']:6.1f} MB/s "
+            f"peak {values['peak_kb_mean']:8.0f} KB mean {values['peak_kb_max']:8.0f} KB max"
+        )
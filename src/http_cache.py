@@ -0,0 +1,309 @@
+""" Shared on-disk HTTP cache for the scrapers, URL validation and the indexer.
+
+`web_scraper`, `smart_scraper`, `validate_urls` and `indexing` fetch the same sf.gov
+pages over and over. `HTTPCache` keeps, in one SQLite file ("data/http_cache.sqlite"):
+- `responses`: body, headers, final URL, ETag and Last-Modified of every page fetched
+    with `get()`. A cached page is revalidated with If-None-Match / If-Modified-Since,
+    so an unchanged page costs a 304 instead of a full download.
+- `redirects`: the status and final URL of every URL checked with `head()` (or fetched
+    with `get()`), so validity and redirect resolution are computed once and reused
+    for `redirect_max_age` seconds. Only definite answers are kept: successes and client
+    errors such as 404 or 410, not network errors, timeouts, 429s or server errors.
+
+Servers that do not allow HEAD (405 Method Not Allowed) are checked with a GET whose
+body is not downloaded.
+
+In offline mode (HTTP_CACHE_OFFLINE=true) no request is sent: everything is served from
+the cache and a miss raises `CacheMissError`, which lets the whole pipeline run against
+a recorded cache.
+
+Example usage:
+```python
+http_cache = get_http_cache()
+response = http_cache.get("https://www.sf.gov/")  # 200, then 304 revalidations.
+head = http_cache.head("https://www.sf.gov/topics/parking")
+head.ok, head.final_url
+```
+"""
+
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Mapping, Optional
+import json
+import os
+import sqlite3
+import time
+
+import httpx
+import requests
+from loguru import logger
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "http_cache.sqlite")
+
+# Client errors that may go away when the request is sent again, or sent as a GET.
+TRANSIENT_CLIENT_ERRORS = {405, 408, 425, 429}
+
+
+class CacheMissError(requests.RequestException):
+    """Raised in offline mode for a URL that is not in the cache."""
+
+
+@dataclass
+class CachedResponse:
+    """The subset of `requests.Response` used by the scrapers, served from the cache."""
+
+    url: str  # Final URL, after redirects.
+    status_code: int
+    headers: Mapping[str, str] = field(default_factory=CaseInsensitiveDict)
+    content: bytes = b""
+    from_cache: bool = False
+    not_modified: bool = False  # Served from the cache after a 304 (or offline).
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        encoding = requests.utils.get_encoding_from_headers(self.headers) or "utf-8"
+        return self.content.decode(encoding, errors="replace")
+
+    def raise_for_status(self) -> None:
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}")
+
+
+@dataclass
+class HeadResult:
+    """Validity and redirect target of a URL."""
+
+    url: str
+    ok: bool
+    final_url: str = ""
+    status: Optional[int] = None  # None if the request failed (network error, timeout).
+
+    @property
+    def redirected(self) -> bool:
+        return self.ok and self.final_url != self.url
+
+    @property
+    def invalid(self) -> bool:
+        """The server answered that the URL does not exist (404, 410, ...)."""
+        return (
+            self.status is not None
+            and 400 <= self.status < 500
+            and self.status not in TRANSIENT_CLIENT_ERRORS
+        )
+
+    @property
+    def definite(self) -> bool:
+        """Whether the result will not change if the URL is checked again right away."""
+        return self.ok or self.invalid
+
+
+class HTTPCache:
+    """Conditional-fetch cache of page bodies and HEAD results, stored in SQLite."""
+
+    def __init__(
+        self,
+        path: str = DEFAULT_PATH,
+        offline: bool = False,
+        redirect_max_age: float = 24 * 60 * 60,
+        pool_size: int = 16,
+    ):
+        """
+        Args:
+            path: The SQLite file of the cache.
+            offline: Serve everything from the cache and never touch the network.
+            redirect_max_age: Seconds a HEAD result is reused before it is checked again.
+            pool_size: Connection pool size of the default requests session.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.offline = offline
+        self.redirect_max_age = redirect_max_age
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, final_url TEXT, "
+            "status INTEGER, headers TEXT, body BLOB, fetched_at REAL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS redirects "
+            "(url TEXT PRIMARY KEY, ok INTEGER, final_url TEXT, checked_at REAL)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(redirects)")]
+        if "status" not in columns:
+            self.connection.execute("ALTER TABLE redirects ADD COLUMN status INTEGER")
+        self.connection.commit()
+        self.lock = Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def cached_response(self, url: str) -> Optional[CachedResponse]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT final_url, status, headers, body FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        final_url, status, headers, body = row
+        headers = CaseInsensitiveDict(json.loads(headers))
+        return CachedResponse(final_url, status, headers, body, from_cache=True)
+
+    def store_response(self, url: str, response: requests.Response) -> None:
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(url, final_url, status, headers, body, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    response.url,
+                    response.status_code,
+                    json.dumps(dict(response.headers)),
+                    response.content,
+                    time.time(),
+                ),
+            )
+            self.connection.commit()
+
+    def get(
+        self, url: str, session: Optional[requests.Session] = None, timeout: float = 30.0
+    ) -> CachedResponse:
+        """GET a page, revalidating the cached copy if there is one.
+
+        Raises:
+            requests.RequestException: If the request fails, or `CacheMissError` offline.
+        """
+        cached = self.cached_response(url)
+        if self.offline:
+            if cached is None:
+                raise CacheMissError(f"{url} is not in the HTTP cache (offline mode)")
+            cached.not_modified = True
+            return cached
+
+        headers = {}
+        if cached is not None:
+            if cached.headers.get("ETag"):
+                headers["If-None-Match"] = cached.headers["ETag"]
+            if cached.headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        response = (session or self.session).get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached is not None:
+            cached.not_modified = True
+            return cached
+        if response.ok:
+            self.store_response(url, response)
+            self.store_head(
+                HeadResult(url, ok=True, final_url=response.url, status=response.status_code)
+            )
+        return CachedResponse(
+            response.url, response.status_code, response.headers, response.content
+        )
+
+    def cached_head(self, url: str) -> Optional[HeadResult]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT ok, final_url, status, checked_at FROM redirects WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        ok, final_url, status, checked_at = row
+        if not self.offline and time.time() - checked_at > self.redirect_max_age:
+            return None
+        head = HeadResult(url, ok=bool(ok), final_url=final_url, status=status)
+        if not self.offline and not head.definite:
+            return None  # Failure recorded before statuses were stored, check it again.
+        return head
+
+    def store_head(self, head: HeadResult) -> None:
+        if not head.definite:
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO redirects (url, ok, final_url, status, checked_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (head.url, int(head.ok), head.final_url, head.status, time.time()),
+            )
+            self.connection.commit()
+
+    def offline_head(self, url: str) -> HeadResult:
+        head = self.cached_head(url)
+        if head is None:
+            raise CacheMissError(f"{url} is not in the HTTP cache (offline mode)")
+        return head
+
+    def head(
+        self, url: str, session: Optional[requests.Session] = None, timeout: float = 30.0
+    ) -> HeadResult:
+        """Check validity and redirect target of a URL with one HEAD, unless cached.
+
+        A 405 to the HEAD is checked again with a GET, without downloading the body.
+        Definite results are cached; network errors, timeouts and server errors are not,
+        so they are retried next time.
+        """
+        if self.offline:
+            return self.offline_head(url)
+        head = self.cached_head(url)
+        if head is not None:
+            return head
+        session = session or self.session
+        try:
+            response = session.head(url, allow_redirects=True, timeout=timeout)
+            if response.status_code == 405:
+                with session.get(url, stream=True, timeout=timeout) as response:
+                    pass
+            head = HeadResult(
+                url, ok=response.ok, final_url=response.url, status=response.status_code
+            )
+        except requests.RequestException as e:
+            logger.error(f"An error occurred validating {url=}: {e}")
+            return HeadResult(url, ok=False)
+        self.store_head(head)
+        return head
+
+    async def ahead(self, url: str, client: httpx.AsyncClient) -> HeadResult:
+        """Async version of `head`, sent with an httpx client."""
+        if self.offline:
+            return self.offline_head(url)
+        head = self.cached_head(url)
+        if head is not None:
+            return head
+        try:
+            response = await client.head(url, follow_redirects=True)
+            if response.status_code == 405:
+                async with client.stream("GET", url, follow_redirects=True) as response:
+                    pass
+            head = HeadResult(
+                url,
+                ok=response.is_success,
+                final_url=str(response.url),
+                status=response.status_code,
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"An error occurred validating {url=}: {e}")
+            return HeadResult(url, ok=False)
+        self.store_head(head)
+        return head
+
+
+http_cache: Optional[HTTPCache] = None
+http_cache_lock = Lock()
+
+
+def get_http_cache() -> HTTPCache:
+    """The process-wide cache, configured by HTTP_CACHE_PATH and HTTP_CACHE_OFFLINE."""
+    global http_cache
+    with http_cache_lock:
+        if http_cache is None:
+            http_cache = HTTPCache(
+                path=os.getenv("HTTP_CACHE_PATH") or DEFAULT_PATH,
+                offline=os.getenv("HTTP_CACHE_OFFLINE", "false").lower() == "true",
+            )
+    return http_cache
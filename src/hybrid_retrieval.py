@@ -0,0 +1,327 @@
+""" Hybrid sparse (BM25) + dense retrieval with reciprocal-rank fusion.
+
+Dense similarity search misses exact-term questions (permit codes, street names,
+program names like "RPP"), which then fail grading and fall back to web search.
+`HybridRetriever` runs a BM25 keyword search next to the Chroma similarity search and
+fuses both rankings with reciprocal-rank fusion (RRF), keyed on the Chroma chunk ids.
+
+`BM25Index` is an inverted index over the chunks of the Chroma collection. It is
+rebuilt by `indexing.py` after every index update and saved next to the Chroma files
+("data/chroma_db/bm25") as numpy arrays that are memory-mapped on load:
+- `offsets.npy`: start of each term's postings in the two arrays below.
+- `postings.npy`: row numbers of the chunks containing each term.
+- `weights.npy`: BM25 term-frequency weight of each posting (already length-normalized).
+- `idf.npy`: inverse document frequency of each term.
+- `vocabulary.json` and `chunk_ids.json`: term and chunk id of each row.
+
+`HybridRetriever` also serves the retrieval modes that need more than a plain similarity
+search, with or without BM25: maximal-marginal-relevance selection, metadata filters
+and adaptive k (see its docstring).
+
+Example usage:
+```python
+sparse_index = BM25Index.load("../data/chroma_db")
+retriever = HybridRetriever(vectorstore=vectorstore, sparse_index=sparse_index, k=3)
+documents = retriever.invoke("How do I get an RPP permit?")
+```
+"""
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+import asyncio
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.retrievers import BaseRetriever
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from loguru import logger
+
+BM25_DIRECTORY = "bm25"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i if in is it my of on or the "
+    "to what when where which who why will with you your".split()
+)
+
+# Dense searches run here while the calling thread runs the sparse search.
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="dense-search")
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over chunk texts, stored as flat (memory-mappable) numpy arrays."""
+
+    def __init__(
+        self,
+        chunk_ids: List[str],
+        vocabulary: Dict[str, int],
+        offsets: np.ndarray,
+        postings: np.ndarray,
+        weights: np.ndarray,
+        idf: np.ndarray,
+    ):
+        self.chunk_ids = chunk_ids
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.postings = postings
+        self.weights = weights
+        self.idf = idf
+
+    @classmethod
+    def build(
+        cls, chunk_ids: Sequence[str], texts: Sequence[str], k1: float = 1.5, b: float = 0.75
+    ) -> "BM25Index":
+        """Build the index from chunk texts."""
+        term_postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths[row] = sum(counts.values())
+            for term, count in counts.items():
+                term_postings[term].append((row, count))
+        average_length = float(lengths.mean()) if len(texts) else 0.0
+
+        terms = sorted(term_postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(term_postings[term]) for term in terms])
+        postings = np.empty(offsets[-1], dtype=np.int32)
+        weights = np.empty(offsets[-1], dtype=np.float32)
+        idf = np.empty(len(terms), dtype=np.float32)
+        for term_id, term in enumerate(terms):
+            rows, counts = zip(*term_postings[term])
+            rows = np.asarray(rows, dtype=np.int32)
+            counts = np.asarray(counts, dtype=np.float32)
+            norm = k1 * (1 - b + b * lengths[rows] / max(average_length, 1e-9))
+            postings[offsets[term_id] : offsets[term_id + 1]] = rows
+            weights[offsets[term_id] : offsets[term_id + 1]] = counts * (k1 + 1) / (counts + norm)
+            idf[term_id] = np.log(1 + (len(texts) - len(rows) + 0.5) / (len(rows) + 0.5))
+        vocabulary = {term: term_id for term_id, term in enumerate(terms)}
+        return cls(list(chunk_ids), vocabulary, offsets, postings, weights, idf)
+
+    def save(self, index_path: str) -> None:
+        """Write the index to `index_path/bm25`, replacing the previous one."""
+        directory = os.path.join(index_path, BM25_DIRECTORY)
+        temp_directory = f"{directory}.tmp"
+        shutil.rmtree(temp_directory, ignore_errors=True)
+        os.makedirs(temp_directory)
+        for name in ["offsets", "postings", "weights", "idf"]:
+            np.save(os.path.join(temp_directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(temp_directory, "vocabulary.json"), "w") as file:
+            json.dump(self.vocabulary, file)
+        with open(os.path.join(temp_directory, "chunk_ids.json"), "w") as file:
+            json.dump(self.chunk_ids, file)
+        old_directory = f"{directory}.old"
+        if os.path.exists(directory):
+            os.replace(directory, old_directory)
+        os.replace(temp_directory, directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_path: str) -> Optional["BM25Index"]:
+        """Memory-map the index saved under `index_path`, or return None if there is none."""
+        directory = os.path.join(index_path, BM25_DIRECTORY)
+        if not os.path.exists(os.path.join(directory, "chunk_ids.json")):
+            return None
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            for name in ["offsets", "postings", "weights", "idf"]
+        }
+        with open(os.path.join(directory, "vocabulary.json"), "r") as file:
+            vocabulary = json.load(file)
+        with open(os.path.join(directory, "chunk_ids.json"), "r") as file:
+            chunk_ids = json.load(file)
+        return cls(chunk_ids, vocabulary, **arrays)
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Return the ids and scores of the `k` best matching chunks."""
+        term_ids = {self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary}
+        if not term_ids:
+            return []
+        scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # Rows are unique within a term's postings, so plain fancy indexing adds correctly.
+            scores[self.postings[start:end]] += self.idf[term_id] * self.weights[start:end]
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunk_ids[row], float(scores[row])) for row in top]
+
+
+def build_sparse_index(vectorstore, index_path: str) -> BM25Index:
+    """Rebuild the BM25 index from every chunk of the Chroma collection and save it."""
+    collection = vectorstore.get(include=["documents"])
+    sparse_index = BM25Index.build(collection["ids"], collection["documents"])
+    sparse_index.save(index_path)
+    logger.info(
+        f"Built BM25 index of {len(sparse_index)} chunks, {len(sparse_index.vocabulary)} terms"
+    )
+    return sparse_index
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], rrf_k: int = 60) -> List[str]:
+    """Merge rankings of ids by the sum of 1 / (rrf_k + rank) over the rankings."""
+    scores: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] += 1 / (rrf_k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def cosine_similarity(query: np.ndarray, embedding: Sequence[float]) -> float:
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(query) * np.linalg.norm(embedding)
+    return float(query @ embedding / norm) if norm else 0.0
+
+
+class HybridRetriever(BaseRetriever):
+    """Fuse Chroma similarity search and BM25 keyword search with reciprocal-rank fusion.
+
+    Without a `sparse_index` only the similarity search runs. On top of either ranking:
+    - `search_type="mmr"` picks the `k` results by maximal marginal relevance among all
+        candidates, trading relevance to the question for diversity (`lambda_mult`), so
+        the slots are not taken by overlapping chunks of one page.
+    - `filter` is a Chroma `where` filter on chunk metadata, e.g.
+        `{"domain": {"$in": ["sfmta.com"]}}`, applied to both searches.
+    - `max_k` enables adaptive k: when the best similarity search hit has a cosine
+        similarity below `min_score`, the question is poorly covered and `max_k`
+        results are returned instead of `k`. The results come from the `candidates`
+        of each search, so `max_k` should not exceed it.
+    """
+
+    vectorstore: object
+    sparse_index: Optional[object] = None
+    k: int = 3
+    candidates: int = 10  # Results taken from each search before fusion.
+    rrf_k: int = 60
+    search_type: str = "similarity"  # Or "mmr".
+    lambda_mult: float = 0.5  # MMR: 1 ranks by relevance only, 0 by diversity only.
+    filter: Optional[dict] = None
+    max_k: Optional[int] = None
+    min_score: float = 0.5
+
+    @property
+    def needs_embeddings(self) -> bool:
+        return self.search_type == "mmr" or self.max_k is not None
+
+    @property
+    def include(self) -> List[str]:
+        include = ["documents", "metadatas"]
+        return include + ["embeddings"] if self.needs_embeddings else include
+
+    def query_collection(self, embedding: List[float]) -> Tuple[Dict[str, Document], Dict]:
+        """Similarity search: the documents, and embeddings if needed, of the candidates."""
+        where = {"where": self.filter} if self.filter else {}
+        result = self.vectorstore._collection.query(
+            query_embeddings=[embedding],
+            n_results=self.candidates,
+            include=self.include,
+            **where,
+        )
+        documents = {
+            chunk_id: Document(page_content=text, metadata=metadata or {})
+            for chunk_id, text, metadata in zip(
+                result["ids"][0], result["documents"][0], result["metadatas"][0]
+            )
+        }
+        embeddings = {}
+        if self.needs_embeddings:
+            embeddings = dict(zip(result["ids"][0], result["embeddings"][0]))
+        return documents, embeddings
+
+    def fetch(self, chunk_ids: List[str], documents: Dict[str, Document], embeddings: Dict):
+        """Add the chunks missing from `documents` that pass the filter."""
+        missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in documents]
+        if not missing:
+            return
+        where = {"where": self.filter} if self.filter else {}
+        result = self.vectorstore.get(ids=missing, include=self.include, **where)
+        for i, (chunk_id, text, metadata) in enumerate(
+            zip(result["ids"], result["documents"], result["metadatas"])
+        ):
+            documents[chunk_id] = Document(page_content=text, metadata=metadata or {})
+            if self.needs_embeddings:
+                embeddings[chunk_id] = result["embeddings"][i]
+
+    def select(
+        self,
+        embedding: List[float],
+        documents: Dict[str, Document],
+        embeddings: Dict,
+        sparse: Optional[List[Tuple[str, float]]],
+    ) -> List[Document]:
+        """Fuse the rankings, then take the first `k` (or `max_k`) or the MMR selection."""
+        query = np.asarray(embedding, dtype=np.float32)
+        k = self.k
+        if self.max_k is not None and documents:
+            top_score = cosine_similarity(query, embeddings[next(iter(documents))])
+            if top_score < self.min_score:
+                logger.info(f"Top similarity {top_score:.2f} < {self.min_score}, k={self.max_k}")
+                k = self.max_k
+
+        ranking = list(documents)
+        if sparse is not None:
+            sparse_ids = [chunk_id for chunk_id, _ in sparse]
+            if self.filter or self.search_type == "mmr":
+                # Keyword hits are filtered, and MMR needs all of them: fetch them first.
+                self.fetch(sparse_ids, documents, embeddings)
+                sparse_ids = [chunk_id for chunk_id in sparse_ids if chunk_id in documents]
+            ranking = reciprocal_rank_fusion([ranking, sparse_ids], rrf_k=self.rrf_k)
+
+        if self.search_type == "mmr":
+            ranking = [chunk_id for chunk_id in ranking if chunk_id in embeddings]
+            selected = maximal_marginal_relevance(
+                query, [embeddings[chunk_id] for chunk_id in ranking], self.lambda_mult, k
+            )
+            chunk_ids = [ranking[i] for i in selected]
+        else:
+            chunk_ids = ranking[:k]
+            # Keyword-only hits: fetch their text from the collection.
+            self.fetch(chunk_ids, documents, embeddings)
+        return [documents[chunk_id] for chunk_id in chunk_ids if chunk_id in documents]
+
+    def dense_search(self, query: str) -> Tuple[List[float], Dict[str, Document], Dict]:
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        return (embedding, *self.query_collection(embedding))
+
+    async def adense_search(self, query: str) -> Tuple[List[float], Dict[str, Document], Dict]:
+        embedding = await self.vectorstore.embeddings.aembed_query(query)
+        return (embedding, *await asyncio.to_thread(self.query_collection, embedding))
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self.sparse_index is None:
+            return self.select(*self.dense_search(query), None)
+        dense = SEARCH_EXECUTOR.submit(self.dense_search, query)
+        sparse = self.sparse_index.search(query, self.candidates)
+        return self.select(*dense.result(), sparse)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self.sparse_index is None:
+            dense, sparse = await self.adense_search(query), None
+        else:
+            dense, sparse = await asyncio.gather(
+                self.adense_search(query),
+                asyncio.to_thread(self.sparse_index.search, query, self.candidates),
+            )
+        return await asyncio.to_thread(self.select, *dense, sparse)
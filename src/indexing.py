@@ -1,62 +1,378 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
+""" Build or incrementally update the Chroma index of the CityHub knowledge base.
+
+The main functionality is provided by the `main()` function, which:
+1. Reads the URLs to index from "data/visited_urls.json" plus `CUSTOM_URLS`.
+2. Fetches the pages concurrently with a bounded thread pool, through the shared
+    `HTTPCache`, which sends the ETag and Last-Modified values of the cached copy so
+    unchanged pages come back as cheap 304 responses. With HTTP_CACHE_OFFLINE=true
+    the index is built from the cache alone.
+3. Skips pages whose content hash did not change since the previous run. A 304 only
+    says the cached copy is current, and that copy may already be newer than the index
+    (stored by the scrapers or by a failed run), so revalidated pages are hashed too.
+4. Extracts the main content of new or changed pages, without the header, footer and
+    navigation repeated on every sf.gov page, and splits it into chunks whose ids are
+    a hash of the chunk text.
+5. Drops duplicate chunks before embedding: a chunk with the same text as an indexed
+    chunk, or a near-duplicate found by MinHash (`chunk_dedup`), maps to that
+    canonical chunk, whose `sources` metadata lists the URLs of all its pages (and
+    `source` and `domain` those of the first one, for retriever filters). Only
+    new canonical chunks are embedded, in length-sorted batches across all cores by
+    `EmbeddingPipeline`, and streamed into the index.
+6. Deletes the chunks no page uses anymore (of removed or changed pages).
+7. Rebuilds the BM25 keyword index of the hybrid retriever from the updated collection,
+    and the int8 IVF index when VECTOR_BACKEND=quantized.
+8. Saves the manifest (ETag, Last-Modified, content hash and chunk ids per URL) and
+    the chunk signatures next to the index in "data/chroma_db".
+
+Run from the `src` directory:
+```bash
+python indexing.py            # Incremental update.
+python indexing.py --full     # Rebuild the index from scratch.
+python indexing.py --full --batch-size 128 --processes 8
+```
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AbstractSet, Any, Dict, List, Optional
+from urllib.parse import urlparse
+import hashlib
 import json
-from loguru import logger
+import os
 
-# Open the JSON file
-with open('../data/visited_urls.json', 'r') as file:
-    # Load the JSON data
-    data = json.load(file)
-urls = list(data.keys())
+import requests
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from loguru import logger
 
-# Define embedding model
-model_name = "Alibaba-NLP/gte-base-en-v1.5" #"all-MiniLM-L6-v2" #"intfloat/multilingual-e5-small"
+from agent_config import AgentConfig
+from chunk_dedup import CHUNK_SIGNATURES_NAME, NearDuplicateIndex
+from cityhub_agent import CityHubResources, get_vectorstore
+from embedding_pipeline import EmbeddingPipeline
+from html_extract import extract_page
+from http_cache import get_http_cache
+from hybrid_retrieval import build_sparse_index
+from quantized_index import QUANTIZED_DIRECTORY, build_quantized_index
 
-model_kwargs = {'device': 'cpu', 'trust_remote_code': True} #'cuda'
-encode_kwargs = {'normalize_embeddings': False}
-embedding_function = HuggingFaceEmbeddings(
-    model_name=model_name,
-    model_kwargs=model_kwargs,
-    encode_kwargs=encode_kwargs
-)
+URLS_PATH = "../data/visited_urls.json"
+MANIFEST_NAME = "index_manifest.json"
+# Separator of the page URLs in the `sources` metadata of a chunk (Chroma metadata
+# values are scalars).
+SOURCES_SEPARATOR = " "
+UPDATE_BATCH_SIZE = 500
 
 # add more custom urls if needed
-urls = urls + [
+CUSTOM_URLS = [
     "https://www.sfmta.com/getting-around/drive-park/how-avoid-parking-tickets",
     "https://www.sfmta.com/getting-around/safety/motorcycle-safety",
     "https://www.sf.gov/register-vote",
     "https://www.sfmta.com/permits/residential-parking-permits-rpp",
     "https://www.sfmta.com/projects/slow-streets-program",
     "https://www.sf.gov/give-feedback-slow-streets-program",
-    "https://www.sfmta.com/getting-around/drive-park/color-curbs"
+    "https://www.sfmta.com/getting-around/drive-park/color-curbs",
 ]
 
-docs = WebBaseLoader(urls).load()
-logger.info("Finished loading urls")
-
-text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-    chunk_size=500, chunk_overlap=100
-)
-doc_splits = text_splitter.split_documents(docs)
-logger.info("Finished chunking")
-
-
-# Add to vectorDB
-index_path = "../data/chroma_db"
-vectorstore = Chroma.from_documents(
-    documents=doc_splits,
-    collection_name="rag-chroma",
-    embedding=embedding_function,
-    persist_directory=index_path
-)
-logger.info(f"Number of docs indexed: {len(vectorstore)}")
-del vectorstore
-
-# testing
-vectorstore = Chroma(collection_name="rag-chroma", 
-                    persist_directory=index_path, 
-                    embedding_function=embedding_function)
-logger.info(f"Number of docs loaded from vector store: {len(vectorstore)}")
 
+@dataclass
+class FetchResult:
+    url: str
+    status: str  # "not_modified" (the HTTP cache's copy is current), "fetched" or "failed"
+    html: str = ""
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+def load_urls(path: str = URLS_PATH) -> List[str]:
+    # Open the JSON file
+    with open(path, "r") as file:
+        # Load the JSON data
+        data = json.load(file)
+    urls = list(data.keys()) + CUSTOM_URLS
+    return list(dict.fromkeys(urls))  # Drop duplicates, keep order.
+
+
+def load_manifest(path: str) -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest: Dict[str, Dict[str, Any]], path: str) -> None:
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temp_path, path)
+
+
+def fetch_page(session: requests.Session, url: str, timeout: float = 30.0) -> FetchResult:
+    """Fetch a page through the HTTP cache, which revalidates its cached copy."""
+    try:
+        response = get_http_cache().get(url, session=session, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning(f"Failed to fetch {url}: {e}")
+        return FetchResult(url, "failed")
+    return FetchResult(
+        url,
+        "not_modified" if response.not_modified else "fetched",
+        html=response.text,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+
+
+def fetch_pages(urls: List[str], max_workers: int = 16) -> List[FetchResult]:
+    """Fetch all pages concurrently with at most `max_workers` requests in flight."""
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda url: fetch_page(session, url), urls))
+
+
+def get_domain(url: str) -> str:
+    """The host of a URL without "www.", for domain filters (e.g. "sfmta.com")."""
+    host = urlparse(url).netloc.lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def page_to_document(url: str, html: str) -> Document:
+    """Extract the main content text and metadata of a page, without the site chrome."""
+    page = extract_page(html, url)
+    metadata = {"source": url, "domain": get_domain(url)}
+    if page.title is not None:
+        metadata["title"] = page.title
+    metadata["description"] = page.description or "No description found."
+    metadata["language"] = page.language or "No language found."
+    return Document(page_content=page.main_text, metadata=metadata)
+
+
+def get_chunk_id(text: str) -> str:
+    """Content-addressed chunk id: pages with the same chunk text share one chunk."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_page(
+    document: Document, text_splitter: RecursiveCharacterTextSplitter
+) -> Dict[str, Document]:
+    """Split a page into chunks keyed by chunk id (duplicate chunks are dropped)."""
+    chunks = {}
+    for chunk in text_splitter.split_documents([document]):
+        chunk_id = get_chunk_id(chunk.page_content)
+        chunk.metadata["chunk_id"] = chunk_id
+        chunks.setdefault(chunk_id, chunk)
+    return chunks
+
+
+def deduplicate_chunks(
+    chunks: Dict[str, Document],
+    duplicates: NearDuplicateIndex,
+    new_chunks: Dict[str, Document],
+    counts: Dict[str, int],
+    previous_ids: AbstractSet[str] = frozenset(),
+) -> List[str]:
+    """Map the chunks of a page to canonical chunk ids.
+
+    A chunk whose text is already indexed (or queued), or which is a near-duplicate of
+    an indexed chunk, maps to that chunk. Any other chunk becomes canonical: it is added
+    to `duplicates` and `new_chunks`. Chunks in `previous_ids`, the old chunks of this
+    page only, are not near-duplicate candidates: an edited chunk replaces its old text.
+
+    Returns:
+        The canonical ids of the page's chunks.
+    """
+    chunk_ids = []
+    for chunk_id, chunk in chunks.items():
+        if chunk_id in duplicates:
+            counts["exact"] += 1
+        else:
+            signature = duplicates.hasher.signature(chunk.page_content)
+            match = duplicates.query(signature, exclude=previous_ids)
+            if match is not None:
+                counts["near"] += 1
+                chunk_id = match
+            else:
+                counts["new"] += 1
+                duplicates.add(chunk_id, signature)
+                new_chunks[chunk_id] = chunk
+        chunk_ids.append(chunk_id)
+    return list(dict.fromkeys(chunk_ids))
+
+
+def get_sources(manifest: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
+    """The URLs of the pages each chunk comes from, in manifest order."""
+    sources: Dict[str, List[str]] = {}
+    for url, entry in manifest.items():
+        for chunk_id in entry.get("chunk_ids", []):
+            sources.setdefault(chunk_id, []).append(url)
+    return sources
+
+
+def update_sources(vectorstore, sources: Dict[str, List[str]]) -> None:
+    """Rewrite the `sources` (and, if its page is gone, `source` and `domain`) metadata."""
+    chunk_ids = list(sources)
+    for start in range(0, len(chunk_ids), UPDATE_BATCH_SIZE):
+        batch = chunk_ids[start : start + UPDATE_BATCH_SIZE]
+        results = vectorstore._collection.get(ids=batch, include=["metadatas"])
+        metadatas = []
+        for chunk_id, metadata in zip(results["ids"], results["metadatas"]):
+            urls = sources[chunk_id]
+            if metadata.get("source") not in urls:
+                metadata["source"] = urls[0]
+                metadata["domain"] = get_domain(urls[0])
+            metadata["sources"] = SOURCES_SEPARATOR.join(urls)
+            metadatas.append(metadata)
+        vectorstore._collection.update(ids=results["ids"], metadatas=metadatas)
+
+
+def update_index(
+    vectorstore,
+    urls: List[str],
+    manifest: Dict[str, Dict[str, Any]],
+    pipeline: EmbeddingPipeline,
+    duplicates: NearDuplicateIndex,
+    max_workers: int = 16,
+) -> Dict[str, Dict[str, Any]]:
+    """Bring the index in line with the pages at `urls`.
+
+    Args:
+        vectorstore: The Chroma vector store to update.
+        urls: The URLs that should be indexed.
+        manifest: Per-URL state of the previous run; empty for a full build.
+        pipeline: Embeds the new chunks and inserts them into the vector store.
+        duplicates: MinHash signatures of the indexed chunks, updated in place.
+        max_workers: Maximum number of concurrent page fetches.
+
+    Returns:
+        The manifest describing the updated index.
+    """
+    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        chunk_size=500, chunk_overlap=100
+    )
+    new_manifest: Dict[str, Dict[str, Any]] = {}
+    new_chunks: Dict[str, Document] = {}
+    previous_sources = get_sources(manifest)
+    counts = {"not_modified": 0, "unchanged": 0, "changed": 0, "failed": 0}
+    chunk_counts = {"new": 0, "exact": 0, "near": 0}
+
+    for result in fetch_pages(urls, max_workers=max_workers):
+        previous = manifest.get(result.url, {})
+        if result.status == "failed":
+            counts["failed"] += 1
+            if previous:
+                new_manifest[result.url] = previous
+            continue
+
+        content_hash = hashlib.sha256(result.html.encode("utf-8")).hexdigest()
+        if result.status == "not_modified" and previous.get("content_hash") == content_hash:
+            counts["not_modified"] += 1
+            new_manifest[result.url] = previous
+            continue
+        entry = {
+            "etag": result.etag,
+            "last_modified": result.last_modified,
+            "content_hash": content_hash,
+            "chunk_ids": previous.get("chunk_ids", []),
+        }
+        if previous.get("content_hash") == content_hash:
+            counts["unchanged"] += 1
+            new_manifest[result.url] = entry
+            continue
+
+        counts["changed"] += 1
+        chunks = split_page(page_to_document(result.url, result.html), text_splitter)
+        own_ids = {
+            chunk_id
+            for chunk_id in previous.get("chunk_ids", [])
+            if previous_sources.get(chunk_id) == [result.url]
+        }
+        entry["chunk_ids"] = deduplicate_chunks(
+            chunks, duplicates, new_chunks, chunk_counts, previous_ids=own_ids
+        )
+        new_manifest[result.url] = entry
+
+    # Chunks are shared between pages, so a chunk is only stale once no page uses it.
+    sources = get_sources(new_manifest)
+    stale_ids = [chunk_id for chunk_id in duplicates if chunk_id not in sources]
+    for chunk_id in stale_ids:
+        duplicates.remove(chunk_id)
+    changed_sources = {
+        chunk_id: urls
+        for chunk_id, urls in sources.items()
+        if chunk_id not in new_chunks and previous_sources.get(chunk_id) != urls
+    }
+    for chunk_id, chunk in new_chunks.items():
+        chunk.metadata["sources"] = SOURCES_SEPARATOR.join(sources[chunk_id])
+
+    logger.info(
+        f"Pages: {counts}, removed: {len(set(manifest) - set(urls))}. "
+        f"Chunks of changed pages: {chunk_counts}. Chunks to embed: {len(new_chunks)}, "
+        f"to delete: {len(stale_ids)}, with new sources: {len(changed_sources)}"
+    )
+
+    if stale_ids:
+        vectorstore.delete(ids=stale_ids)
+    if changed_sources:
+        update_sources(vectorstore, changed_sources)
+    pipeline.index(vectorstore, new_chunks)
+    return new_manifest
+
+
+def main():
+    """Build or update the index and its manifest."""
+    parser = ArgumentParser()
+    parser.add_argument("--full", action="store_true", help="Rebuild the index from scratch.")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent page fetches.")
+    parser.add_argument("--urls", type=str, default=URLS_PATH)
+    parser.add_argument("--batch-size", type=int, default=64, help="Texts per encoder call.")
+    parser.add_argument(
+        "--processes", type=int, default=None, help="Encoder processes (default: one per core)."
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.8,
+        help="Minimum MinHash similarity of chunks merged as near-duplicates.",
+    )
+    args = parser.parse_args()
+
+    config = AgentConfig.from_env()
+    manifest_path = os.path.join(config.index_path, MANIFEST_NAME)
+    signatures_path = os.path.join(config.index_path, CHUNK_SIGNATURES_NAME)
+    embedding_function = CityHubResources(config).embedding_function
+    vectorstore = get_vectorstore(config.index_path, embedding_function)
+
+    manifest = load_manifest(manifest_path)
+    duplicates = NearDuplicateIndex.load(signatures_path, threshold=args.dedup_threshold)
+    if args.full or not manifest or not duplicates:
+        logger.info("Rebuilding the index from scratch")
+        vectorstore.delete_collection()
+        vectorstore = get_vectorstore(config.index_path, embedding_function)
+        manifest = {}
+        duplicates = NearDuplicateIndex(threshold=args.dedup_threshold)
+
+    urls = load_urls(args.urls)
+    pipeline = EmbeddingPipeline(
+        embedding_function, batch_size=args.batch_size, processes=args.processes
+    )
+    manifest = update_index(
+        vectorstore, urls, manifest, pipeline, duplicates, max_workers=args.workers
+    )
+    os.makedirs(config.index_path, exist_ok=True)
+    duplicates.save(signatures_path)
+    build_sparse_index(vectorstore, config.index_path)
+    if config.vector_backend == "quantized":
+        build_quantized_index(
+            vectorstore._collection, os.path.join(config.index_path, QUANTIZED_DIRECTORY)
+        )
+    save_manifest(manifest, manifest_path)
+    logger.info(f"Number of docs indexed: {len(vectorstore)}")
+
+
+if __name__ == "__main__":
+    main()
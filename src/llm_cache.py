@@ -0,0 +1,193 @@
+""" Exact-match memoization of deterministic LLM chains.
+
+The router and grader chains in `cityhub_agent` are yes/no classifiers that are
+re-invoked with identical inputs all the time (same popular question, same retrieved
+chunk). `LLMCallCache.wrap()` puts a chain behind a cache keyed on a hash of
+(chain name, model, prompt inputs), so a repeated call costs no Groq request.
+
+Two storage backends are available:
+- `InMemoryLRUBackend`: a bounded in-process LRU dictionary.
+- `SQLiteBackend`: an on-disk table that survives restarts and is shared by workers.
+
+Per-chain hit and miss counters are available from `LLMCallCache.stats()`. The wrapped
+chain gets the caller's config (callbacks, tags), and in async calls the SQLite reads
+and writes run in a worker thread, off the event loop.
+
+Example usage:
+```python
+llm_cache = LLMCallCache(SQLiteBackend("../data/llm_cache.sqlite"))
+retrieval_grader = llm_cache.wrap(
+    get_retrieval_grader(), name="retrieval_grader", model="llama3-70b-8192",
+    output_type=GradeDocuments,
+)
+```
+"""
+
+from collections import OrderedDict, defaultdict
+from threading import Lock
+from typing import Any, Dict, Optional, Type
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from langchain.schema import Document
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from loguru import logger
+
+
+class InMemoryLRUBackend:
+    """Keep up to `max_entries` cached outputs in memory, evicting the least recently used."""
+
+    blocking = False  # Get and set are fast enough to run on the event loop.
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SQLiteBackend:
+    """Keep cached outputs in a SQLite database so they survive restarts."""
+
+    blocking = True  # Get and set wait for the disk and for other workers' locks.
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            self.connection.commit()
+
+
+def serialize_input(value: Any) -> Any:
+    """JSON fallback for prompt inputs that are not plain JSON types, e.g. Documents."""
+    if isinstance(value, Document):
+        return {"page_content": value.page_content, "metadata": value.metadata}
+    if isinstance(value, BaseModel):
+        return value.dict()
+    return str(value)
+
+
+def get_cache_key(name: str, model: str, inputs: Dict[str, Any]) -> str:
+    payload = json.dumps(
+        {"chain": name, "model": model, "inputs": inputs},
+        sort_keys=True,
+        default=serialize_input,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCallCache:
+    """Memoize structured-output chains on their exact inputs."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+
+    def lookup(self, name: str, key: str, output_type: Type[BaseModel]):
+        try:
+            value = self.backend.get(key)
+        except Exception as error:
+            logger.warning(f"LLM cache lookup failed for {name}: {error}")
+            value = None
+        if value is None:
+            self.misses[name] += 1
+            return None
+        self.hits[name] += 1
+        return output_type.parse_raw(value)
+
+    async def run_backend(self, method, *args):
+        """Call `lookup` or `update` from async code, in a thread if the backend blocks."""
+        if getattr(self.backend, "blocking", True):
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    def update(self, name: str, key: str, output: BaseModel) -> None:
+        try:
+            self.backend.set(key, output.json())
+        except Exception as error:
+            logger.warning(f"LLM cache update failed for {name}: {error}")
+
+    def wrap(
+        self, chain: Runnable, name: str, model: str, output_type: Type[BaseModel]
+    ) -> Runnable:
+        """Return a runnable that serves `chain` outputs from the cache when possible.
+
+        Args:
+            chain: A chain returning an `output_type` instance.
+            name: The chain name, part of the cache key and of the stats.
+            model: The LLM model name, part of the cache key.
+            output_type: The pydantic model the chain returns.
+
+        Returns:
+            A runnable with the same sync and async interface as `chain`.
+        """
+
+        def invoke(inputs: Dict[str, Any], config: RunnableConfig):
+            key = get_cache_key(name, model, inputs)
+            output = self.lookup(name, key, output_type)
+            if output is None:
+                output = chain.invoke(inputs, config)
+                self.update(name, key, output)
+            return output
+
+        async def ainvoke(inputs: Dict[str, Any], config: RunnableConfig):
+            key = get_cache_key(name, model, inputs)
+            output = await self.run_backend(self.lookup, name, key, output_type)
+            if output is None:
+                output = await chain.ainvoke(inputs, config)
+                await self.run_backend(self.update, name, key, output)
+            return output
+
+        return RunnableLambda(invoke, afunc=ainvoke, name=name)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = {}
+        for name in sorted(set(self.hits) | set(self.misses)):
+            hits, misses = self.hits[name], self.misses[name]
+            stats[name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            }
+        return stats
@@ -0,0 +1,151 @@
+""" Load test the CityHub API with concurrent questions.
+
+The main functionality is provided by the `run_load_test()` function, which:
+    1. Sends `requests` questions to the `/askcityhub` endpoint of each target server,
+        keeping at most `concurrency` of them in flight.
+    2. While the questions are running, probes a cheap endpoint (`/docs`) every
+        `probe_interval` seconds to measure how responsive the event loop stays.
+    3. Reports throughput (questions per second), question latency percentiles and
+        probe latency percentiles per target.
+
+A blocked event loop shows up as probe latencies close to the question latency, while
+a fully async server answers the probes in milliseconds and completes concurrent
+questions in roughly the time of the slowest one.
+
+Example usage, comparing this build (port 9100) with the previous build (port 9101):
+```bash
+python src/load_test.py --url http://localhost:9100 --baseline-url http://localhost:9101 \
+    --requests 50 --concurrency 25
+```
+"""
+
+from argparse import ArgumentParser
+from statistics import median, quantiles
+from typing import Dict, List, Optional
+import asyncio
+import time
+
+import httpx
+
+QUESTIONS = [
+    "How do I apply for a residential parking permit?",
+    "How to apply for the slow street program in SF?",
+    "How do I register to vote in San Francisco?",
+    "What do the colored curbs mean in San Francisco?",
+    "How can I avoid parking tickets in SF?",
+]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Summarize latencies in seconds as p50/p95/max."""
+    if not latencies:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    p95 = latencies[0]
+    if len(latencies) > 1:
+        p95 = quantiles(latencies, n=20, method="inclusive")[-1]
+    return {"p50": median(latencies), "p95": p95, "max": max(latencies)}
+
+
+async def run_load_test(
+    url: str,
+    requests: int = 50,
+    concurrency: int = 25,
+    probe_interval: float = 0.5,
+    timeout: float = 300.0,
+) -> Dict[str, object]:
+    """Send concurrent questions to a CityHub server and measure throughput.
+
+    Args:
+        url: The base URL of the CityHub server, e.g. "http://localhost:9100".
+        requests: Total number of questions to send.
+        concurrency: Maximum number of questions in flight at once.
+        probe_interval: Seconds between event loop responsiveness probes.
+        timeout: Request timeout in seconds.
+
+    Returns:
+        The measured throughput, question latencies and probe latencies.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    probe_latencies: List[float] = []
+    errors = 0
+    done = asyncio.Event()
+
+    limits = httpx.Limits(max_connections=concurrency + 1)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+
+        async def ask(i: int) -> None:
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        "/askcityhub", json={"question": QUESTIONS[i % len(QUESTIONS)]}
+                    )
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+                except httpx.HTTPError:
+                    errors += 1
+
+        async def probe() -> None:
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    await client.get("/docs")
+                    probe_latencies.append(time.perf_counter() - start)
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(probe_interval)
+
+        prober = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(ask(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await prober
+
+    return {
+        "url": url,
+        "completed": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": summarize(latencies),
+        "probe_latency": summarize(probe_latencies),
+    }
+
+
+def print_report(result: Dict[str, object], label: Optional[str] = None) -> None:
+    latency, probe = result["latency"], result["probe_latency"]
+    print(f"{label or result['url']}")
+    print(
+        f"  completed={result['completed']} errors={result['errors']} "
+        f"elapsed={result['elapsed']:.1f}s throughput={result['throughput']:.2f} q/s"
+    )
+    print(
+        f"  question latency p50={latency['p50']:.2f}s p95={latency['p95']:.2f}s "
+        f"max={latency['max']:.2f}s"
+    )
+    print(
+        f"  probe latency    p50={probe['p50'] * 1000:.0f}ms "
+        f"p95={probe['p95'] * 1000:.0f}ms max={probe['max'] * 1000:.0f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://localhost:9100")
+    parser.add_argument("--baseline-url", type=str, default=None)
+    parser.add_argument("-n", "--requests", type=int, default=50)
+    parser.add_argument("-c", "--concurrency", type=int, default=25)
+    parser.add_argument("--probe-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    targets = [("current", args.url)]
+    if args.baseline_url:
+        targets.append(("baseline", args.baseline_url))
+    for label, url in targets:
+        result = asyncio.run(
+            run_load_test(url, args.requests, args.concurrency, args.probe_interval)
+        )
+        print_report(result, label=f"{label}: {url}")
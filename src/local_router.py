@@ -0,0 +1,193 @@
+""" Local question router, with the LLM router as a fallback for uncertain questions.
+
+The LLM router spends a 70B call on every question only to choose between the
+vectorstore and web search. `LocalRouter` decides most questions locally, from signals
+that cost microseconds once the question is embedded:
+1. Keyword rules: city service terms ("parking permit", "slow street", "register to
+    vote") route to the vectorstore, time-sensitive or off-topic terms ("news",
+    "tonight", "weather", "restaurants") to web search. Questions matching both lists
+    are left to the next signals.
+2. A nearest-prototype classifier: the cosine similarity of the question to the closest
+    labelled example question of each route (`ROUTE_EXAMPLES`). The route of the closer
+    example wins if it is closer by at least `margin`.
+3. The corpus match: the cosine similarity of the question to its nearest indexed
+    chunk, at least `corpus_threshold` for questions the vectorstore can answer.
+
+The classifier decides only when the corpus match agrees with it; otherwise, and when
+there is no corpus match, the decision is uncertain and the agent asks the LLM router.
+Counters of the decisions are exposed by `stats()`, and `evaluate_router.py` checks the
+agreement of the local decisions with the LLM router on labelled questions.
+
+Select it with ROUTER_MODE=local (see `AgentConfig`). The router embeds the question
+itself; the retriever reuses that embedding only through the embedding cache, so with
+EMBEDDING_CACHE_ENABLED=false every routed question is embedded twice.
+
+Example usage:
+```python
+router = LocalRouter(embedding_function, margin=0.05, corpus_threshold=0.5)
+embedding = embedding_function.embed_query(question)
+decision = router.route(question, embedding, corpus_score)
+if decision.route is None:
+    decision.route = llm_route(question)
+```
+"""
+
+from collections import Counter
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence
+import re
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+VECTORSTORE_KEYWORDS = [
+    r"parking", r"permits?", r"rpp", r"slow streets?", r"curbs?",
+    r"tow(ed|ing)?", r"citations?", r"tickets?", r"street cleaning", r"meters?",
+    r"driveways?", r"register(ed)? to vote", r"voter registration", r"vote by mail",
+    r"polling places?", r"sfmta", r"311", r"city services?", r"motorcycles?",
+]
+WEBSEARCH_KEYWORDS = [
+    r"news", r"latest", r"today", r"tonight", r"tomorrow", r"this (week|weekend)",
+    r"right now", r"weather", r"forecast", r"concerts?", r"festivals?", r"restaurants?",
+    r"bars?", r"hotels?", r"things to do", r"travel guides?", r"tourists?", r"who won",
+    r"scores?", r"games?", r"stocks?",
+]
+
+ROUTE_EXAMPLES = {
+    "vectorstore": [
+        "How do I apply for a residential parking permit?",
+        "How much does an RPP permit cost?",
+        "How to apply for the slow street program in SF?",
+        "How do I register to vote in San Francisco?",
+        "What do the colored curbs mean in San Francisco?",
+        "What should I do if my car was towed?",
+        "How do I pay or contest a parking citation?",
+        "When is street cleaning on my block?",
+        "What safety gear should motorcycle riders wear?",
+        "How do I request a new stop sign or speed bump?",
+    ],
+    "websearch": [
+        "What is the weather in San Francisco right now?",
+        "Who won the Giants game last night?",
+        "What are the latest news in the Bay Area?",
+        "What concerts are happening this weekend?",
+        "What are the best restaurants in the Mission?",
+        "Which hotels are close to Union Square?",
+        "What are the top things to do in San Francisco for tourists?",
+        "How is the stock market doing today?",
+        "When does the next iPhone come out?",
+        "What is the capital of France?",
+    ],
+}
+
+
+def compile_keywords(keywords: Sequence[str]) -> re.Pattern:
+    return re.compile(r"\b(" + "|".join(keywords) + r")\b", re.IGNORECASE)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+@dataclass
+class RouteDecision:
+    route: Optional[str]  # "vectorstore", "websearch", or None when uncertain.
+    reason: str  # "keywords", "classifier" or "uncertain".
+    scores: Dict[str, float]
+
+
+class LocalRouter:
+    """Route questions with keyword rules, example prototypes and the corpus match."""
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        examples: Optional[Dict[str, List[str]]] = None,
+        margin: float = 0.05,
+        corpus_threshold: float = 0.5,
+    ):
+        """
+        Args:
+            embedding_function: The embedding model used by the retriever.
+            examples: Labelled example questions of each route, `ROUTE_EXAMPLES` by default.
+            margin: Minimum cosine similarity gap between the closest examples of the
+                two routes for the classifier to decide.
+            corpus_threshold: Minimum cosine similarity of the nearest chunk for a
+                question the vectorstore can answer.
+        """
+        self.embedding_function = embedding_function
+        self.examples = examples or ROUTE_EXAMPLES
+        self.margin = margin
+        self.corpus_threshold = corpus_threshold
+        self.keywords = {
+            "vectorstore": compile_keywords(VECTORSTORE_KEYWORDS),
+            "websearch": compile_keywords(WEBSEARCH_KEYWORDS),
+        }
+        self.prototypes: Optional[Dict[str, np.ndarray]] = None
+        self.counters: Counter = Counter()
+        self.lock = Lock()
+
+    def load_prototypes(self) -> Dict[str, np.ndarray]:
+        """Embed the example questions once, on first use."""
+        if self.prototypes is None:
+            self.prototypes = {
+                route: normalize_rows(
+                    np.asarray(self.embedding_function.embed_documents(questions), np.float32)
+                )
+                for route, questions in self.examples.items()
+            }
+        return self.prototypes
+
+    def keyword_route(self, question: str) -> Optional[str]:
+        """The route whose keywords, and only whose keywords, the question contains."""
+        matches = [route for route, pattern in self.keywords.items() if pattern.search(question)]
+        return matches[0] if len(matches) == 1 else None
+
+    def classify(self, embedding: Sequence[float]) -> Dict[str, float]:
+        """Cosine similarity of the question to the closest example of each route."""
+        query = normalize_rows(np.asarray(embedding, dtype=np.float32))
+        return {
+            route: float((prototypes @ query).max())
+            for route, prototypes in self.load_prototypes().items()
+        }
+
+    def route(
+        self, question: str, embedding: Sequence[float], corpus_score: Optional[float] = None
+    ) -> RouteDecision:
+        """Route a question, or return an uncertain decision for the LLM router.
+
+        Args:
+            question: The user question.
+            embedding: The query embedding of the question.
+            corpus_score: Cosine similarity of the question to its nearest indexed chunk,
+                or None if it is not known.
+        """
+        keyword_route = self.keyword_route(question)
+        if keyword_route is not None:
+            return self.record(RouteDecision(keyword_route, "keywords", {}))
+
+        scores = self.classify(embedding)
+        if corpus_score is not None:
+            scores["corpus"] = corpus_score
+        gap = scores["vectorstore"] - scores["websearch"]
+        route = None
+        if corpus_score is not None and abs(gap) >= self.margin:
+            route = "vectorstore" if gap > 0 else "websearch"
+            if (corpus_score >= self.corpus_threshold) != (route == "vectorstore"):
+                route = None
+        return self.record(RouteDecision(route, "classifier" if route else "uncertain", scores))
+
+    def record(self, decision: RouteDecision) -> RouteDecision:
+        with self.lock:
+            self.counters[decision.reason] += 1
+            if decision.route is not None:
+                self.counters[decision.route] += 1
+        return decision
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            decided = self.counters["keywords"] + self.counters["classifier"]
+            total = decided + self.counters["uncertain"]
+            return {**self.counters, "local_rate": decided / total if total else None}
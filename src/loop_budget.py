@@ -0,0 +1,131 @@
+""" Deadline and retry budget of the generate/grade loop of one CityHub question.
+
+After `generate`, the graders can send the agent back to `generate` ("not supported",
+the answer is not grounded in the documents) or to `websearch` ("not useful", the
+answer does not address the question). Unbounded, these loops run until LangGraph's
+recursion limit fails the request, after the worst possible latency. `LoopBudget`
+bounds them per question:
+- at most `max_generations` generations and `max_web_searches` web searches;
+- a `deadline_seconds` deadline, after which the graders are skipped or cut short.
+
+When a loop is not affordable anymore the agent ends with the best answer it has, the
+last grounded generation if any, marked as unverified so it is not cached. The budget
+travels in the graph state; `LoopMetrics`, shared by all questions, counts how often
+each loop is taken and how questions end (see /stats).
+
+Example usage:
+```python
+budget = LoopBudget(deadline_seconds=30, max_generations=3, metrics=metrics)
+budget.start_generation()
+route = budget.retry("not supported")  # "not supported", or "exhausted" if over budget.
+answer = budget.final_answer(generation)
+```
+"""
+
+from collections import Counter
+from threading import Lock
+from typing import Any, Dict, Optional
+import time
+
+from loguru import logger
+
+LOOP_LIMITS = {"not supported": "generations", "not useful": "web_searches"}
+
+
+class LoopMetrics:
+    """Counters of the loops taken and of the outcomes of the generate/grade cycle."""
+
+    def __init__(self):
+        self.counters: Counter = Counter()
+        self.lock = Lock()
+
+    def record(self, event: str) -> None:
+        with self.lock:
+            self.counters[event] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.counters)
+
+
+class LoopBudget:
+    """Generations, web searches and time left for one question."""
+
+    def __init__(
+        self,
+        deadline_seconds: Optional[float] = 30.0,
+        max_generations: int = 3,
+        max_web_searches: int = 1,
+        metrics: Optional[LoopMetrics] = None,
+    ):
+        """
+        Args:
+            deadline_seconds: Seconds from now until the agent must answer; None or 0
+                disables the deadline.
+            max_generations: Maximum number of generations, retries included.
+            max_web_searches: Maximum number of web searches, retries included.
+            metrics: Shared counters of the loops and outcomes.
+        """
+        self.deadline = time.monotonic() + deadline_seconds if deadline_seconds else None
+        self.limits = {"generations": max_generations, "web_searches": max_web_searches}
+        self.counts: Counter = Counter()
+        self.metrics = metrics or LoopMetrics()
+        self.outcome: Optional[str] = None
+        self.grounded_generation: Optional[str] = None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left until the deadline, None if there is no deadline."""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def start_generation(self) -> None:
+        self.counts["generations"] += 1
+
+    def start_web_search(self) -> None:
+        self.counts["web_searches"] += 1
+
+    def record_grounded(self, generation: str) -> None:
+        """Keep the last generation the hallucination grader found grounded."""
+        self.grounded_generation = generation
+
+    def retry(self, route: str) -> str:
+        """Take the "not supported" or "not useful" loop if the budget allows it.
+
+        Returns:
+            The route, or "exhausted" if the loop is over budget.
+        """
+        if self.expired():
+            return self.exhaust("deadline")
+        limit = LOOP_LIMITS[route]
+        if self.counts[limit] >= self.limits[limit]:
+            return self.exhaust(limit)
+        self.metrics.record(f"loop_{route.replace(' ', '_')}")
+        return route
+
+    def exhaust(self, reason: str) -> str:
+        """End the loop with an unverified answer because `reason` is over budget."""
+        logger.warning(
+            f"Loop budget exhausted ({reason}) after {self.counts['generations']} "
+            f"generations and {self.counts['web_searches']} web searches"
+        )
+        self.finish(f"exhausted_{reason}")
+        return "exhausted"
+
+    def finish(self, outcome: str) -> None:
+        self.outcome = outcome
+        self.metrics.record(outcome)
+        self.metrics.record(f"generations_{self.counts['generations']}")
+
+    @property
+    def verified(self) -> bool:
+        return self.outcome == "verified"
+
+    def final_answer(self, generation: str) -> str:
+        """The answer to return: the last grounded one if the loop was cut short."""
+        if self.verified or self.grounded_generation is None:
+            return generation
+        return self.grounded_generation
@@ -1,24 +1,54 @@
 import argparse
+import asyncio
+import os
 import sys
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from loguru import logger
 from uvicorn import run
 
-from api_resources import ChatbotRequest, ChatbotResponse, get_response_schema, get_response
-from cityhub_agent import get_cityhub_agent
+from api_resources import (
+    ChatbotRequest,
+    ChatbotResponse,
+    format_server_sent_event,
+    get_response_schema,
+    get_response,
+)
+from agent_config import AgentConfig
+from cityhub_agent import get_cityhub_agent, get_initial_state, get_resources
 
+from langchain_core.callbacks import AsyncCallbackHandler
 from langchain_core.runnables import RunnableConfig
-config = RunnableConfig(recursion_limit=8)
+
+FALLBACK_RESPONSE = "Sorry, I don't know. Please try rephrasing the question."
+
+agent_config = AgentConfig.from_env()
+# Building the graph is cheap; models, vector store and chains are built lazily
+cityhub_agent = get_cityhub_agent(agent_config)
+# Enough steps for the loop budget of a question, which ends the run first
+config = RunnableConfig(recursion_limit=get_resources().recursion_limit())
+
+# Build the models and chains before serving instead of on the first request
+WARM_UP_ON_STARTUP = os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARM_UP_ON_STARTUP:
+        await asyncio.to_thread(get_resources().warm_up)
+    yield
+
 
 # define the fastAPI app
 app = FastAPI(
     title="CityHub API",
     version="1.0",
     description="CityHub API that retrun the chatbot response",
+    lifespan=lifespan,
 )
 
 origins = [
@@ -34,10 +64,122 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-cityhub_agent = get_cityhub_agent()
-
 RESPONSES = get_response_schema()
 
+
+def clean_generation(generation: str) -> str:
+    return generation.replace("According to the provided context, ", "")
+
+
+class TokenStreamHandler(AsyncCallbackHandler):
+    """Forward `rag_chain` tokens to the queue feeding the SSE response.
+
+    A new generation run (e.g. a re-try after the hallucination check) is announced with a
+    `generation_start` event so the client can discard the previous partial answer.
+    """
+
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.generation_run_id = None
+
+    def put(self, event, data=None):
+        self.queue.put_nowait((event, data or {}))
+
+    async def on_llm_new_token(self, token, *, run_id, tags=None, **kwargs):
+        if "rag_chain" not in (tags or []):
+            return
+        if run_id != self.generation_run_id:
+            self.generation_run_id = run_id
+            self.put("generation_start")
+        self.put("token", {"token": token})
+
+
+async def lookup_answer(question: str):
+    """Look up a cached answer; returns (answer or None, question embedding)."""
+    if not agent_config.answer_cache_enabled:
+        return None, None
+    try:
+        return await get_resources().answer_cache.alookup(question)
+    except Exception as error:
+        logger.warning(f"Answer cache lookup failed: {error}")
+        return None, None
+
+
+def store_answer(question: str, embedding, answer: str, nodes: set, verified: bool = True):
+    """Cache a verified answer, with the shorter TTL if it went through web search."""
+    if embedding is None or not verified:
+        return
+    source = "websearch" if "websearch" in nodes else "vectorstore"
+    get_resources().answer_cache.store(question, embedding, answer, source)
+
+
+async def astream_agent(inputs: dict, run_config: dict):
+    """Stream the agent's node outputs, cancelling leftover speculative work when it ends.
+
+    The speculative retrieval or web search of the run is cancelled once the graph finishes,
+    fails or is cancelled (e.g. the SSE client disconnected), so it stops using LLM tokens
+    and speculation budget after the response is done.
+    """
+    speculation = None
+    try:
+        async for output in cityhub_agent.astream(inputs, run_config):
+            for value in output.values():
+                if isinstance(value, dict) and value.get("speculation") is not None:
+                    speculation = value["speculation"]
+            yield output
+    finally:
+        if speculation is not None:
+            speculation.cancel_all()
+
+
+async def stream_agent_events(question: str):
+    """Run the agent and yield its progress as Server-Sent Events.
+
+    Events: `node` after each graph node finishes, `generation_start` and `token` while
+    the answer is generated, `verification` once the graders have run and `done` with the
+    final answer. The agent run is cancelled if the client disconnects.
+    """
+    queue = asyncio.Queue()
+    handler = TokenStreamHandler(queue)
+
+    async def run_agent():
+        try:
+            cached_answer, embedding = await lookup_answer(question)
+            if cached_answer is not None:
+                handler.put("node", {"node": "answer_cache"})
+                handler.put("generation_start")
+                handler.put("token", {"token": cached_answer})
+                handler.put("verification", {"verified": True})
+                handler.put("done", {"answer": cached_answer})
+                return
+            inputs = get_initial_state(question)
+            budget = inputs["budget"]
+            nodes = set()
+            async for output in astream_agent(inputs, {**config, "callbacks": [handler]}):
+                for key, value in output.items():
+                    logger.info(f"Finished running: {key}")
+                    nodes.add(key)
+                    handler.put("node", {"node": key})
+            final_response = clean_generation(budget.final_answer(value["generation"]))
+            store_answer(question, embedding, final_response, nodes, budget.verified)
+            handler.put("verification", {"verified": budget.verified})
+            handler.put("done", {"answer": final_response})
+        except Exception as error:
+            logger.error(f"Streaming agent failed: {error}")
+            handler.put("verification", {"verified": False})
+            handler.put("done", {"answer": FALLBACK_RESPONSE})
+        finally:
+            queue.put_nowait(None)
+
+    agent_run = asyncio.create_task(run_agent())
+    try:
+        while (item := await queue.get()) is not None:
+            event, data = item
+            yield format_server_sent_event(event, data)
+    finally:
+        agent_run.cancel()
+
+
 @app.post("/askcityhub", response_model=ChatbotResponse, responses=RESPONSES)
 async def get_chatbot_result(user_request: ChatbotRequest) -> JSONResponse:
     question = user_request.question
@@ -51,16 +193,24 @@ async def get_chatbot_result(user_request: ChatbotRequest) -> JSONResponse:
         )
 
     try:
+        cached_answer, embedding = await lookup_answer(question)
+        if cached_answer is not None:
+            return JSONResponse(content=cached_answer, status_code=200)
+
         # app logic
-        inputs = {"question": question}
+        inputs = get_initial_state(question)
+        budget = inputs["budget"]
         #inputs = {"question": "How to apply for the slow street program in SF?"}
-        for output in cityhub_agent.stream(inputs, config):
+        nodes = set()
+        async for output in astream_agent(inputs, config):
             #print(output.items())
             for key, value in output.items():
                 logger.info(f"Finished running: {key}")
-        final_response = value["generation"]
+                nodes.add(key)
+        final_response = budget.final_answer(value["generation"])
         logger.info(f"{final_response=}")
-        final_response = final_response.replace("According to the provided context, ", "")
+        final_response = clean_generation(final_response)
+        store_answer(question, embedding, final_response, nodes, budget.verified)
         #final_response[0] = final_response[0].upper()
         #final_response = "abc"
         return JSONResponse(
@@ -71,10 +221,37 @@ async def get_chatbot_result(user_request: ChatbotRequest) -> JSONResponse:
         response["body"].update({"message": f"{str(error)}"})
         logger.error(f"{response=}")
         return JSONResponse(
-            content="Sorry, I don't know. Please try rephrasing the question.", status_code=200#response["status_code"]
+            content=FALLBACK_RESPONSE, status_code=200#response["status_code"]
         )
 
 
+@app.post("/askcityhub/stream", responses=RESPONSES)
+async def stream_chatbot_result(user_request: ChatbotRequest) -> StreamingResponse:
+    question = user_request.question
+    logger.info(f"Receive User question for streaming: {question}")
+    return StreamingResponse(
+        stream_agent_events(question),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/stats")
+async def get_stats() -> JSONResponse:
+    """Cache, router, speculation, loop and compression counters, used to tune settings."""
+    resources = get_resources()
+    names = [
+        "answer_cache", "llm_cache", "embedding_cache", "local_router", "speculation_budget",
+        "loop_metrics", "context_compressor",
+    ]
+    stats = {
+        name: getattr(resources, name).stats()
+        for name in names
+        if resources.is_built(name) and getattr(resources, name) is not None
+    }
+    return JSONResponse(content=stats, status_code=200)
+
+
 
 if __name__ == "__main__":
     ENV = 'local'
@@ -0,0 +1,494 @@
+""" Int8-quantized IVF vector index, a lighter alternative to Chroma for large corpora.
+
+Chroma keeps float32 embeddings and its HNSW graph in memory, so opening a large
+multi-city collection is slow and RAM grows with 4 bytes per dimension per chunk.
+`QuantizedIndex` is built from an existing Chroma collection and stored in
+"data/chroma_db/ivf" as:
+- `centroids.npy`: k-means centroids of the inverted lists (IVF).
+- `codes.npy`: int8 codes of every vector (one scale per vector), grouped by list, so
+    scanning a list reads one contiguous block. This is the only per-chunk data that
+    needs to stay in RAM: a quarter of the float32 embeddings.
+- `scales.npy`, `norms.npy`, `offsets.npy`: per-vector scale and squared norm, and the
+    start of each list.
+- `vectors.npy`: the float32 embeddings, memory-mapped and only read to rescore the best
+    candidates exactly.
+- `documents.sqlite`: chunk id, text and metadata of each row.
+
+A search ranks the lists by centroid distance, scans the `nprobe` closest with the int8
+codes, and rescores the `rescore` best candidates with the exact L2 distance (the
+distance Chroma uses for the "rag-chroma" collection).
+
+`QuantizedVectorStore` wraps the index as a read-only LangChain vector store with the
+Chroma read calls used by the hybrid retriever (`get` and `_collection.query`, with
+`where` metadata filters and embeddings), so it can replace Chroma for retrieval.
+Select it with VECTOR_BACKEND=quantized.
+
+Example usage:
+```bash
+python quantized_index.py build                 # From ../data/chroma_db
+python quantized_index.py benchmark --queries 200
+```
+"""
+
+from argparse import ArgumentParser
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import json
+import math
+import os
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from loguru import logger
+
+QUANTIZED_DIRECTORY = "ivf"
+ARRAYS = ["centroids", "codes", "scales", "norms", "offsets", "vectors"]
+# SQLite limits the number of variables in one statement.
+QUERY_BATCH_SIZE = 500
+# Metadata filter operators supported by `matches_filter`.
+FILTER_OPERATORS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+}
+
+
+def assign(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 4096) -> np.ndarray:
+    """Return the index of the nearest centroid of each vector."""
+    centroid_norms = (centroids**2).sum(axis=1)
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start : start + batch_size], dtype=np.float32)
+        lists[start : start + len(batch)] = np.argmin(
+            centroid_norms - 2 * batch @ centroids.T, axis=1
+        )
+    return lists
+
+
+def train_centroids(
+    sample: np.ndarray, nlist: int, iterations: int = 10, seed: int = 0
+) -> np.ndarray:
+    """Lloyd's k-means on a sample of the vectors."""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        counts = np.bincount(lists, minlength=nlist)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty lists with random vectors.
+        centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 quantization with one scale per vector."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def matches_filter(metadata: Dict[str, Any], where: Dict[str, Any]) -> bool:
+    """Evaluate a Chroma `where` filter ($and, $or, $eq, $ne, $in, $nin) on metadata."""
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, clause) for clause in condition):
+                return False
+        else:
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if operator not in FILTER_OPERATORS:
+                    raise ValueError(f"Unsupported filter operator {operator!r}")
+                if not FILTER_OPERATORS[operator](value, operand):
+                    return False
+    return True
+
+
+def build_quantized_index(
+    collection,
+    directory: str,
+    nlist: Optional[int] = None,
+    sample_size: int = 100000,
+    page_size: int = 5000,
+) -> None:
+    """Build the index from every vector of a Chroma collection into `directory`.
+
+    Args:
+        collection: The Chroma collection, e.g. `vectorstore._collection`.
+        directory: Where to save the index; an existing index is replaced when done.
+        nlist: Number of inverted lists, by default about 4 * sqrt(number of vectors).
+        sample_size: Number of vectors the k-means centroids are trained on.
+        page_size: Number of vectors read from Chroma at a time.
+    """
+    start_time = time.perf_counter()
+    count = collection.count()
+    if count == 0:
+        raise ValueError("The collection is empty, nothing to quantize")
+    temp_directory = f"{directory}.tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    # 1. Copy the vectors to a memory-mapped file and the documents to SQLite.
+    connection = sqlite3.connect(os.path.join(temp_directory, "documents.sqlite"))
+    connection.execute(
+        "CREATE TABLE documents "
+        "(row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, metadata TEXT)"
+    )
+    unsorted_path = os.path.join(temp_directory, "vectors.unsorted")
+    unsorted = None
+    for offset in range(0, count, page_size):
+        page = collection.get(
+            include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset
+        )
+        embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+        if unsorted is None:
+            unsorted = np.lib.format.open_memmap(
+                unsorted_path, mode="w+", dtype=np.float32, shape=(count, embeddings.shape[1])
+            )
+        unsorted[offset : offset + len(embeddings)] = embeddings
+        connection.executemany(
+            "INSERT INTO documents (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+            [
+                (offset + i, chunk_id, text, json.dumps(metadata or {}))
+                for i, (chunk_id, text, metadata) in enumerate(
+                    zip(page["ids"], page["documents"], page["metadatas"])
+                )
+            ],
+        )
+    connection.commit()
+
+    # 2. Train the centroids and group the rows by inverted list.
+    nlist = nlist or max(1, min(int(4 * math.sqrt(count)), count // 39 or 1))
+    rng = np.random.default_rng(0)
+    sample_rows = np.sort(rng.choice(count, min(sample_size, count), replace=False))
+    sample = np.asarray(unsorted[sample_rows])
+    centroids = train_centroids(sample, nlist)
+    lists = assign(unsorted, centroids)
+    order = np.argsort(lists, kind="stable")
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(lists, minlength=nlist))
+    new_rows = np.empty(count, dtype=np.int64)
+    new_rows[order] = np.arange(count)
+    connection.execute("UPDATE documents SET row = -1 - row")  # Keep rows unique while moving.
+    connection.executemany(
+        "UPDATE documents SET row = ? WHERE row = ?",
+        [(int(new_row), -1 - old_row) for old_row, new_row in enumerate(new_rows)],
+    )
+    connection.commit()
+    connection.close()
+
+    # 3. Write the sorted float vectors and their int8 codes.
+    dim = unsorted.shape[1]
+    vectors = np.lib.format.open_memmap(
+        os.path.join(temp_directory, "vectors.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(count, dim),
+    )
+    codes = np.lib.format.open_memmap(
+        os.path.join(temp_directory, "codes.npy"), mode="w+", dtype=np.int8, shape=(count, dim)
+    )
+    scales = np.empty(count, dtype=np.float32)
+    norms = np.empty(count, dtype=np.float32)
+    for start in range(0, count, page_size):
+        batch = np.asarray(unsorted[order[start : start + page_size]])
+        end = start + len(batch)
+        vectors[start:end] = batch
+        codes[start:end], scales[start:end] = quantize(batch)
+        norms[start:end] = (batch**2).sum(axis=1)
+    vectors.flush()
+    codes.flush()
+    del vectors, codes, unsorted
+    os.remove(unsorted_path)
+    for name, array in [
+        ("centroids", centroids), ("scales", scales), ("norms", norms), ("offsets", offsets)
+    ]:
+        np.save(os.path.join(temp_directory, f"{name}.npy"), array)
+
+    old_directory = f"{directory}.old"
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(temp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+    logger.info(
+        f"Built quantized index of {count} vectors in {nlist} lists "
+        f"in {time.perf_counter() - start_time:.1f}s"
+    )
+
+
+class QuantizedIndex:
+    """Search the int8 IVF index and read its documents, with Chroma-like results."""
+
+    def __init__(self, directory: str, nprobe: int = 8, rescore: int = 50):
+        """
+        Args:
+            directory: The directory written by `build_quantized_index`.
+            nprobe: Number of inverted lists scanned per search.
+            rescore: Number of best int8 candidates rescored with the float vectors.
+        """
+        self.directory = directory
+        self.nprobe = nprobe
+        self.rescore = rescore
+        for name in ARRAYS:
+            # Small arrays are loaded, the per-chunk codes and vectors are memory-mapped.
+            mmap_mode = "r" if name in ("codes", "vectors") else None
+            array = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            setattr(self, name, array)
+        self.connection = sqlite3.connect(
+            os.path.join(directory, "documents.sqlite"), check_same_thread=False
+        )
+        self.lock = Lock()
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, "offsets.npy"))
+
+    def count(self) -> int:
+        return len(self.scales)
+
+    def search(self, embedding: Sequence[float], k: int = 4) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the rows and squared L2 distances of the `k` nearest vectors."""
+        query = np.asarray(embedding, dtype=np.float32)
+        centroid_distances = ((self.centroids - query) ** 2).sum(axis=1)
+        nprobe = min(self.nprobe, len(centroid_distances))
+        probed = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+
+        rows, approximate = [], []
+        for list_id in probed:
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            dot = (self.codes[start:end].astype(np.float32) @ query) * self.scales[start:end]
+            # ||x - q||^2 without the constant ||q||^2
+            approximate.append(self.norms[start:end] - 2 * dot)
+            rows.append(np.arange(start, end))
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        rows, approximate = np.concatenate(rows), np.concatenate(approximate)
+
+        rescore = min(max(self.rescore, k), len(rows))
+        candidates = np.sort(rows[np.argpartition(approximate, rescore - 1)[:rescore]])
+        distances = ((self.vectors[candidates] - query) ** 2).sum(axis=1)
+        best = np.argsort(distances)[:k]
+        return candidates[best], distances[best]
+
+    def fetch(
+        self, column: str, values: Sequence[Any]
+    ) -> Dict[Any, Tuple[str, int, str, dict]]:
+        """Read (id, row, document, metadata) of the rows whose `column` is in `values`."""
+        found = {}
+        with self.lock:
+            for start in range(0, len(values), QUERY_BATCH_SIZE):
+                batch = list(values[start : start + QUERY_BATCH_SIZE])
+                for key, chunk_id, row, text, metadata in self.connection.execute(
+                    f"SELECT {column}, id, row, document, metadata FROM documents "
+                    f"WHERE {column} IN ({','.join('?' * len(batch))})",
+                    batch,
+                ):
+                    found[key] = (chunk_id, row, text, json.loads(metadata))
+        return found
+
+    def query(
+        self,
+        query_embeddings: List[Sequence[float]],
+        n_results: int = 4,
+        where: Optional[dict] = None,
+        include=None,
+    ) -> Dict[str, list]:
+        """Nearest neighbours of each query embedding, shaped like `Collection.query`.
+
+        With a `where` filter the `rescore` best candidates are filtered, so fewer than
+        `n_results` may be returned for very selective filters.
+        """
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if include and "embeddings" in include:
+            result["embeddings"] = []
+        for embedding in query_embeddings:
+            k = max(n_results, self.rescore) if where else n_results
+            rows, distances = self.search(embedding, k)
+            found = self.fetch("row", [int(row) for row in rows])
+            hits = [
+                (int(row), float(distance))
+                for row, distance in zip(rows, distances)
+                if int(row) in found
+                and (not where or matches_filter(found[int(row)][3], where))
+            ][:n_results]
+            result["ids"].append([found[row][0] for row, _ in hits])
+            result["documents"].append([found[row][2] for row, _ in hits])
+            result["metadatas"].append([found[row][3] for row, _ in hits])
+            result["distances"].append([distance for _, distance in hits])
+            if "embeddings" in result:
+                result["embeddings"].append([self.vectors[row].tolist() for row, _ in hits])
+        return result
+
+    def get(
+        self, ids: Optional[Sequence[str]] = None, where: Optional[dict] = None, include=None
+    ) -> Dict[str, list]:
+        """Documents by id (all of them if `ids` is None), shaped like `Collection.get`."""
+        if ids is None:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, row, document, metadata FROM documents ORDER BY row"
+                ).fetchall()
+            found = {
+                chunk_id: (chunk_id, row, text, json.loads(metadata))
+                for chunk_id, row, text, metadata in rows
+            }
+            ids = list(found)
+        else:
+            found = self.fetch("id", ids)
+            ids = [chunk_id for chunk_id in ids if chunk_id in found]
+        if where:
+            ids = [chunk_id for chunk_id in ids if matches_filter(found[chunk_id][3], where)]
+        result = {
+            "ids": ids,
+            "documents": [found[chunk_id][2] for chunk_id in ids],
+            "metadatas": [found[chunk_id][3] for chunk_id in ids],
+        }
+        if include and "embeddings" in include:
+            result["embeddings"] = [
+                self.vectors[found[chunk_id][1]].tolist() for chunk_id in ids
+            ]
+        return result
+
+
+class QuantizedVectorStore(VectorStore):
+    """Read-only LangChain vector store backed by a `QuantizedIndex`."""
+
+    def __init__(self, index: QuantizedIndex, embedding_function: Embeddings):
+        self._collection = index
+        self._embedding_function = embedding_function
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def __len__(self) -> int:
+        return self._collection.count()
+
+    def get(
+        self, ids: Optional[Sequence[str]] = None, where: Optional[dict] = None, include=None
+    ) -> Dict[str, list]:
+        return self._collection.get(ids=ids, where=where, include=include)
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        result = self._collection.query([embedding], n_results=k)
+        return [
+            (Document(page_content=text, metadata=metadata), distance)
+            for text, metadata, distance in zip(
+                result["documents"][0], result["metadatas"][0], result["distances"][0]
+            )
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k)
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any
+    ) -> List[str]:
+        raise NotImplementedError(
+            "The quantized index is read-only, rebuild it from the Chroma collection"
+        )
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError(
+            "Build the quantized index from a Chroma collection with build_quantized_index"
+        )
+
+
+def benchmark(index: QuantizedIndex, queries: int = 200, k: int = 3) -> Dict[str, float]:
+    """Measure search latency and recall@k against exact search over the float vectors.
+
+    Queries are stored vectors with a little noise, so no embedding model is needed.
+    """
+    rng = np.random.default_rng(0)
+    count, dim = index.vectors.shape
+    query_rows = np.sort(rng.choice(count, min(queries, count), replace=False))
+    base = np.asarray(index.vectors[query_rows])
+    noise = rng.normal(scale=base.std() * 0.1, size=base.shape).astype(np.float32)
+    query_vectors = base + noise
+
+    exact_distances = np.full((len(query_vectors), k), np.inf, dtype=np.float32)
+    exact_rows = np.zeros((len(query_vectors), k), dtype=np.int64)
+    for start in range(0, count, 65536):
+        block = np.asarray(index.vectors[start : start + 65536])
+        distances = (
+            (block**2).sum(axis=1)[None, :] - 2 * query_vectors @ block.T
+            + (query_vectors**2).sum(axis=1)[:, None]
+        )
+        merged = np.concatenate([exact_distances, distances], axis=1)
+        merged_rows = np.concatenate(
+            [exact_rows, np.broadcast_to(np.arange(start, start + len(block)), distances.shape)],
+            axis=1,
+        )
+        best = np.argsort(merged, axis=1)[:, :k]
+        exact_distances = np.take_along_axis(merged, best, axis=1)
+        exact_rows = np.take_along_axis(merged_rows, best, axis=1)
+
+    latencies, hits = [], 0
+    for query, expected in zip(query_vectors, exact_rows):
+        start = time.perf_counter()
+        rows, _ = index.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        hits += len(set(rows.tolist()) & set(expected.tolist()))
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "vectors": count,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        f"recall@{k}": hits / (len(query_vectors) * k),
+        "codes_mb": index.codes.nbytes / 2**20,
+        "float_vectors_mb": count * dim * 4 / 2**20,
+    }
+
+
+if __name__ == "__main__":
+    from agent_config import AgentConfig
+
+    config = AgentConfig.from_env()
+    parser = ArgumentParser()
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--index-path", type=str, default=config.index_path)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, default=config.quantized_nprobe)
+    parser.add_argument("--rescore", type=int, default=config.quantized_rescore)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    directory = os.path.join(args.index_path, QUANTIZED_DIRECTORY)
+    if args.command == "build":
+        import chromadb
+
+        client = chromadb.PersistentClient(path=args.index_path)
+        build_quantized_index(client.get_collection("rag-chroma"), directory, nlist=args.nlist)
+    else:
+        index = QuantizedIndex(directory, nprobe=args.nprobe, rescore=args.rescore)
+        print(json.dumps(benchmark(index, queries=args.queries), indent=2))
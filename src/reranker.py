@@ -0,0 +1,62 @@
+""" Local cross-encoder reranking of retrieved documents.
+
+In the default grading modes every retrieved chunk costs one LLM call for a yes/no
+relevance grade. `CrossEncoderReranker` instead scores all (question, chunk) pairs with
+a small cross-encoder on the CPU, in batched forward passes, so the retriever can
+over-retrieve (e.g. 20 chunks) and the agent keeps the best `top_n` chunks whose
+score passes a threshold.
+
+Select it with GRADING_MODE=rerank (see `AgentConfig`). `evaluate_reranker.py`
+compares its latency and its agreement with the LLM grader.
+
+Example usage:
+```python
+reranker = CrossEncoderReranker("cross-encoder/ms-marco-MiniLM-L-6-v2")
+documents, scores = reranker.rerank(question, documents, top_n=3, threshold=0.5)
+```
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+
+class CrossEncoderReranker:
+    """Score documents against a question with a sentence-transformers `CrossEncoder`."""
+
+    def __init__(
+        self,
+        model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2",
+        batch_size: int = 32,
+        max_length: int = 512,
+    ):
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def score(self, question: str, documents: List[Document]) -> np.ndarray:
+        """Return the relevance of each document to the question, between 0 and 1."""
+        if not documents:
+            return np.zeros(0, dtype=np.float32)
+        pairs = [(question, d.page_content) for d in documents]
+        # Single-label cross-encoders apply a sigmoid, so scores are probabilities.
+        return np.asarray(
+            self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False),
+            dtype=np.float32,
+        )
+
+    def rerank(
+        self, question: str, documents: List[Document], top_n: int = 3, threshold: float = 0.5
+    ) -> Tuple[List[Document], List[float]]:
+        """Keep the `top_n` best documents scoring at least `threshold`, best first.
+
+        Returns:
+            The kept documents and their scores.
+        """
+        scores = self.score(question, documents)
+        order = np.argsort(-scores)[:top_n]
+        kept = [i for i in order if scores[i] >= threshold]
+        return [documents[i] for i in kept], [float(scores[i]) for i in kept]
@@ -1,8 +1,10 @@
 """ Scrape the SF government website using the Grok and Llama3 with SmartScraperGraph.
 
-The main functionality is provided by the `main()` function, which:
+The main functionality is provided by the `main()` function, which runs a `Crawler`:
 1. Starts with a set of initial URLs to visit.
-2. For each URL, it checks if the URL is valid and has not been visited before.
+2. Workers take URLs from a queue concurrently. For each URL, a single HEAD request
+    (through a shared keep-alive client, with a per-host concurrency limit and a
+    politeness delay) checks that it is valid and gives its redirect target.
 3. If the URL is an internal link (starting with "https://www.sf.gov/topics"), 
     it uses the `link_prompt` to scrape the page for additional URLs and their 
     descriptions.
@@ -11,8 +13,16 @@ The main functionality is provided by the `main()` function, which:
 5. The scraped URLs and their descriptions are stored in the 
     `visited_url_descriptions` dictionary.
 6. If a URL is a redirect, the redirect URL is stored in the `redirected_urls` 
-    dictionary, and the redirect URL is added to the `urls_to_visit` dictionary.
-7. The process continues until all URLs in `urls_to_visit` have been visited.
+    dictionary, and the redirect URL is added to the queue of URLs to visit.
+7. Pages are scraped by a bounded pool of concurrent `smart_scrape` calls, each run in a
+    worker thread. The process continues until no URL is left to visit.
+    The queue, the per-URL state and the scraped descriptions live in a `CrawlFrontier`
+    ("data/crawl_frontier.sqlite") that is checkpointed as the crawl goes, so a crashed
+    or interrupted crawl continues where it stopped with `--resume`. URLs whose check or
+    scrape raised (timeouts, rate limits) are left to retry on resume, not failed.
+    When the LLM provider reports a rate limit or an exhausted quota, scraping pauses
+    with exponential backoff, and the crawl stops after `max_quota_errors` such errors
+    in a row instead of draining the frontier.
 8. Finally, the `visited_url_descriptions` dictionary is saved to a JSON file named 
     "data/visited_urls.json".
 
@@ -23,26 +33,38 @@ actual scraping. The configuration for the SmartScraperGraph is obtained using t
 The module also includes utility functions:
 - `is_url_valid(url)`: Checks if a URL returns a 200 status code.
 - `is_url_redirect(url)`: Checks if a URL is a redirect.
+- `head_url(client, limiter, url)`: Async validity and redirect check with one HEAD.
+All three share the HEAD results (validity and redirect target) of the on-disk
+`HTTPCache`, so a URL is only checked once per day across runs and modules.
 - `retry_with_exponential_backoff()`: A decorator that retries a function with 
     exponential backoff if an exception is raised.
 
 To use this module, ensure that the required dependencies are installed and the 
     necessary environment variables are set. Then, simply run the `main()` function 
+    (or `python src/smart_scraper.py --workers 16 --max-scrapers 4 [--resume]` from the
+    repo root)
     to start the scraping process.
 """
 
+from argparse import ArgumentParser
+from contextlib import asynccontextmanager
 from dotenv import find_dotenv, load_dotenv
 from functools import wraps
 from scrapegraphai.graphs import SmartScraperGraph
 from scrapegraphai.utils import prettify_exec_info
 from typing import Any, Callable, Dict, TypeVar
+from urllib.parse import urlparse
+import asyncio
 import json
 import os
-import requests
 import time
 
+import httpx
 from loguru import logger
 
+from crawl_frontier import CrawlFrontier
+from http_cache import HeadResult, get_http_cache
+
 load_dotenv(find_dotenv())
 
 # Type variable for generic type hinting.
@@ -103,28 +125,12 @@ graph_config = get_config(model="groq/llama3-8b-8192")
 
 def is_url_valid(url: str) -> bool:
     """Check if a URL is valid."""
-    try:
-        # Send a HEAD request to the URL
-        response = requests.head(url, allow_redirects=True)
-        # Check if the HTTP status code is OK (200 range)
-        if response.ok:
-            return True
-        else:
-            return False
-    except requests.RequestException as e:
-        # Handle exceptions that may occur during the request
-        logger.error(f"An error occurred validating {url=}: {e}")
-        return False
+    # A single HEAD request, reused from the HTTP cache when it was checked before.
+    return get_http_cache().head(url).ok
 
 
 def is_url_redirect(url):
-    try:
-        response = requests.head(url, allow_redirects=True, verify=False)
-    except requests.RequestException as e:
-        logger.error(f"An error occurred validating {url=}: {e}")
-        raise e
-
-    return url != response.url
+    return get_http_cache().head(url).redirected
 
 
 def retry_with_exponential_backoff(
@@ -210,34 +216,136 @@ def smart_scrape(url: str, prompt: str):
     return SmartScraperGraph(prompt=prompt, source=url, config=graph_config).run()
 
 
-def main():
-    """Run the SmartScraperGraph on the San Francisco government website as a script.
-
-    Saves the visited URLs and their descriptions to a JSON file:
-        "data/visited_urls.json"
+def is_quota_error(error: Exception) -> bool:
+    """Whether a scrape failed on a rate limit or an exhausted quota of the LLM provider."""
+    status_code = getattr(error, "status_code", None) or getattr(
+        getattr(error, "response", None), "status_code", None
+    )
+    message = f"{type(error).__name__} {error}".lower()
+    return status_code == 429 or any(
+        marker in message for marker in ("ratelimit", "rate limit", "rate_limit", "quota")
+    )
+
+
+class HostLimiter:
+    """Limit concurrent requests per host and space them by a politeness delay."""
+
+    def __init__(self, max_per_host: int = 4, delay: float = 0.5):
+        self.max_per_host = max_per_host
+        self.delay = delay
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+        self.next_request: dict[str, float] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    async def wait_turn(self, host: str) -> None:
+        """Wait until `delay` seconds have passed since the last request to `host`."""
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            wait = self.next_request.get(host, 0.0) - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.next_request[host] = loop.time() + self.delay
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        """Hold one of the `max_per_host` request slots of the URL's host."""
+        host = urlparse(url).netloc
+        semaphore = self.semaphores.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        async with semaphore:
+            await self.wait_turn(host)
+            yield
+
+
+async def head_url(client: httpx.AsyncClient, limiter: HostLimiter, url: str) -> HeadResult:
+    """Check validity and redirect target of a URL with one HEAD request, unless cached."""
+    http_cache = get_http_cache()
+    head = http_cache.cached_head(url)
+    if head is not None:
+        return head
+    async with limiter.slot(url):
+        return await http_cache.ahead(url, client)
+
+
+class Crawler:
+    """Crawl sf.gov topics with concurrent HEAD checks and a bounded pool of scrapers.
+
+    Workers take URLs from a persistent `CrawlFrontier`. Each URL gets one HEAD request,
+    through a shared keep-alive client, with at most `max_per_host` requests per host in
+    flight, spaced by `delay` seconds. Valid URLs are scraped with `smart_scrape` in
+    worker threads, at most `max_scrapers` at a time. The frontier is checkpointed as
+    the crawl goes, so an interrupted crawl can be resumed.
+
+    A rate limit or quota error of the scraper's LLM pauses all scrapes for
+    `quota_backoff` seconds, doubled on every consecutive error, and the crawl stops
+    after `max_quota_errors` of them; the URLs it did not scrape are left for `--resume`.
     """
-    visited_urls = set()  # Ones we have already scraped, whether saved or not.
-    visited_url_descriptions: dict[str, Any] = {}  # Ones we want to keep.
-    urls_to_visit: dict[str, Any] = {
-        root_url: "The main page of the San Francisco government website."
-    }
-    redirected_urls: dict[str, str] = {}
-
-    while urls_to_visit:
-        url = list(urls_to_visit.keys())[0]
-        if url in visited_urls or not is_url_valid(url):
-            visited_urls.add(url)
-            continue  # Already scraped this URL or it does not return a 200.
-
-        description = urls_to_visit.pop(url)
-        visited_url_descriptions[url] = description
-        # Use the redirect URL if it is different from the original URL.
-        redirected_url = ""
-        if is_url_redirect(url):
-            redirected_url = requests.head(url, allow_redirects=True, verify=False).url
-            redirected_urls[url] = redirected_url
-            urls_to_visit[redirected_url] = ""  # No description means not internal.
-            urls_to_visit.pop(url, None)
+
+    def __init__(
+        self,
+        frontier: CrawlFrontier,
+        workers: int = 16,
+        max_scrapers: int = 4,
+        max_per_host: int = 4,
+        delay: float = 0.5,
+        quota_backoff: float = 60.0,
+        max_quota_errors: int = 5,
+    ):
+        self.frontier = frontier
+        self.workers = workers
+        self.limiter = HostLimiter(max_per_host=max_per_host, delay=delay)
+        self.scrapers = asyncio.Semaphore(max_scrapers)
+        self.redirected_urls: dict[str, str] = frontier.redirects()
+        self.in_flight = 0
+        self.wakeup = asyncio.Event()
+        self.quota_backoff = quota_backoff
+        self.max_quota_errors = max_quota_errors
+        self.quota_errors = 0  # Consecutive rate limit or quota errors.
+        self.paused_until = 0.0
+        self.stopped = False
+
+    def notify(self) -> None:
+        """Wake up the workers waiting for new URLs."""
+        self.wakeup.set()
+        self.wakeup = asyncio.Event()
+
+    def enqueue(self, url: str, description: str) -> None:
+        if self.frontier.add(url, description):
+            self.notify()
+
+    def quota_exceeded(self, error: Exception) -> None:
+        """Pause the scrapes with exponential backoff, or stop the crawl."""
+        if self.stopped:
+            return
+        self.quota_errors += 1
+        if self.quota_errors >= self.max_quota_errors:
+            logger.error(
+                f"Stopping the crawl after {self.quota_errors} rate limit or quota errors, "
+                f"continue it later with --resume: {error}"
+            )
+            self.stopped = True
+            self.notify()
+            return
+        backoff = self.quota_backoff * 2 ** (self.quota_errors - 1)
+        logger.warning(f"Rate limit or quota error, pausing scrapes for {backoff:.0f}s: {error}")
+        self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+
+    async def wait_for_quota(self) -> None:
+        while not self.stopped and (pause := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(pause)
+
+    async def visit(self, client: httpx.AsyncClient, url: str, description: str) -> None:
+        head = await head_url(client, self.limiter, url)
+        if not head.ok:
+            # A network error or a server error does not mean the URL is invalid.
+            self.frontier.mark(url, "failed" if head.definite else "retry")
+            return
+
+        self.frontier.save_result(url, description)
+        # Also visit the redirect URL if it is different from the original URL.
+        if head.redirected:
+            self.redirected_urls[url] = head.final_url
+            self.enqueue(head.final_url, "")  # No description means not internal.
         if url == root_url or url.startswith(topic_url) and description:
             # This is sf.gov or an internal link to sf.gov/topics/...
             internal = True
@@ -246,35 +354,160 @@ def main():
             internal = False
             prompt = external_link_prompt
 
-        result = {}
         try:
-            logger.info(f"Scraping {url}")
-            result = smart_scrape(url, prompt)
+            async with self.scrapers:
+                await self.wait_for_quota()
+                if self.stopped:
+                    self.frontier.mark(url, "pending")  # Left for --resume.
+                    return
+                await self.limiter.wait_turn(urlparse(url).netloc)
+                logger.info(f"Scraping {url}")
+                result = await asyncio.to_thread(smart_scrape, url, prompt)
         except Exception as e:
             logger.warning(
                 f"Failed to scrape {url}. {prettify_exec_info(e)}"  # type: ignore
             )
-            continue
+            if is_quota_error(e):
+                self.quota_exceeded(e)
+            self.frontier.mark(url, "retry")
+            return
+        self.quota_errors = 0
 
         if not isinstance(result, dict):
             logger.warning(f"Failed to scrape {url}. {result}")
-            continue
+            self.frontier.mark(url, "failed")
+            return
 
-        visited_url_count = len(visited_url_descriptions)
-        for link, description in result.items():
+        for link, link_description in result.items():
             if not link.startswith("http"):
                 continue  # Skip non-URLs.
-            if link in redirected_urls:
-                forwarded_url = redirected_urls[link]
-                description += f" [{forwarded_url}]({forwarded_url})"
-            logger.info(f"{link=}, {description=}")
-            visited_url_descriptions[link] = description
-            if link not in visited_urls and link not in urls_to_visit and internal:
+            if link in self.redirected_urls:
+                forwarded_url = self.redirected_urls[link]
+                link_description += f" [{forwarded_url}]({forwarded_url})"
+            logger.info(f"{link=}, {link_description=}")
+            self.frontier.save_result(link, link_description)
+            if internal:
                 # Only add links found in topics.
-                urls_to_visit[link] = description
+                self.enqueue(link, link_description)
 
-        logger.info(f"Size of visited URLs: {visited_url_count}")
-        logger.info(f"Size of URLs to visit: {len(urls_to_visit)}")
+        if head.redirected:
+            self.frontier.mark(url, "redirected", redirect=head.final_url)
+        else:
+            self.frontier.mark(url, "done")
+        logger.info(f"Crawl frontier: {self.frontier.counts()}")
+
+    async def worker(self, client: httpx.AsyncClient) -> None:
+        while not self.stopped:
+            item = self.frontier.pop()
+            if item is None:
+                if self.in_flight == 0:
+                    self.notify()  # Nothing left anywhere: let the other workers stop too.
+                    return
+                await self.wakeup.wait()  # A visit in flight may still queue URLs.
+                continue
+            url, description = item
+            self.in_flight += 1
+            try:
+                await self.visit(client, url, description)
+            except Exception as e:
+                logger.error(f"Unexpected error visiting {url}: {e}")
+                self.frontier.mark(url, "retry")
+            finally:
+                self.in_flight -= 1
+                self.frontier.checkpoint()
+                self.notify()
+
+    async def run(self, start_urls: dict[str, Any]) -> dict[str, Any]:
+        """Crawl from `start_urls` until no URL is left and return the URL descriptions."""
+        for url, description in start_urls.items():
+            self.enqueue(url, description)
+        limits = httpx.Limits(max_keepalive_connections=self.workers, max_connections=self.workers)
+        try:
+            async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+                await asyncio.gather(*[self.worker(client) for _ in range(self.workers)])
+        finally:
+            self.frontier.checkpoint(force=True)
+        return self.frontier.results()
+
+
+def main(
+    resume: bool = False,
+    frontier_path: str = "data/crawl_frontier.sqlite",
+    workers: int = 16,
+    max_scrapers: int = 4,
+    max_per_host: int = 4,
+    delay: float = 0.5,
+    checkpoint_interval: float = 10.0,
+    max_attempts: int = 3,
+    quota_backoff: float = 60.0,
+    max_quota_errors: int = 5,
+):
+    """Run the SmartScraperGraph on the San Francisco government website as a script.
+
+    Saves the visited URLs and their descriptions to a JSON file:
+        "data/visited_urls.json"
+
+    Args:
+        resume: Continue the crawl saved in `frontier_path` instead of starting over.
+        frontier_path: The SQLite file the crawl state is checkpointed to.
+        workers: Number of URLs processed concurrently.
+        max_scrapers: Maximum number of concurrent `smart_scrape` calls.
+        max_per_host: Maximum number of concurrent requests per host.
+        delay: Minimum number of seconds between two requests to the same host.
+        checkpoint_interval: Maximum number of seconds between two checkpoints.
+        max_attempts: Failed attempts after which a URL is not retried on resume.
+        quota_backoff: Seconds scrapes pause after a rate limit or quota error.
+        max_quota_errors: Consecutive rate limit or quota errors that stop the crawl.
+    """
+    frontier = CrawlFrontier(
+        frontier_path,
+        resume=resume,
+        checkpoint_interval=checkpoint_interval,
+        max_attempts=max_attempts,
+    )
+    crawler = Crawler(
+        frontier,
+        workers=workers,
+        max_scrapers=max_scrapers,
+        max_per_host=max_per_host,
+        delay=delay,
+        quota_backoff=quota_backoff,
+        max_quota_errors=max_quota_errors,
+    )
+    start_urls = {root_url: "The main page of the San Francisco government website."}
+    try:
+        visited_url_descriptions = asyncio.run(crawler.run(start_urls))
+    finally:
+        frontier.close()
 
     with open("data/visited_urls.json", "w") as f:
         json.dump(visited_url_descriptions, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--resume", action="store_true", help="Continue the interrupted crawl."
+    )
+    parser.add_argument("--frontier", type=str, default="data/crawl_frontier.sqlite")
+    parser.add_argument("--checkpoint-interval", type=float, default=10.0)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--max-scrapers", type=int, default=4)
+    parser.add_argument("--max-per-host", type=int, default=4)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--quota-backoff", type=float, default=60.0)
+    parser.add_argument("--max-quota-errors", type=int, default=5)
+    args = parser.parse_args()
+    main(
+        resume=args.resume,
+        frontier_path=args.frontier,
+        workers=args.workers,
+        max_scrapers=args.max_scrapers,
+        max_per_host=args.max_per_host,
+        delay=args.delay,
+        checkpoint_interval=args.checkpoint_interval,
+        max_attempts=args.max_attempts,
+        quota_backoff=args.quota_backoff,
+        max_quota_errors=args.max_quota_errors,
+    )
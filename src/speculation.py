@@ -0,0 +1,135 @@
+""" Speculative retrieval and web search while the CityHub agent routes a question.
+
+The router is a 70B LLM call, and the retrieval or web search it picks can only start
+once it returns; a web search fallback after grading adds another round trip. With
+SPECULATIVE_MODE=true the async graph starts the work before it is known to be needed:
+- the retriever always runs next to the router call, as it is cheap;
+- the Brave web search also runs next to the router call when the best corpus match of
+    the question is weak (cosine similarity below SPECULATIVE_WEB_SEARCH_THRESHOLD),
+    which is when the router picks web search or grading falls back to it, and only
+    within a budget of SPECULATIVE_WEB_SEARCH_PER_MINUTE paid calls.
+
+`Speculation` holds the in-flight tasks of one question in the graph state. The nodes
+take their results instead of starting the same work again, and the work of the branch
+that is not taken is cancelled: the retrieval when the router picks web search, the
+web search when grading finds the retrieved documents relevant.
+
+`SpeculationBudget` is a token bucket of speculative web searches, shared by all
+questions, which also counts how speculation pays off (see /stats).
+
+Example usage:
+```python
+budget = SpeculationBudget(per_minute=10)
+web_search = asyncio.create_task(search(question)) if budget.try_spend() else None
+speculation = Speculation(asyncio.create_task(retrieve(question)), web_search, budget)
+documents = await speculation.take_retrieval()
+```
+"""
+
+from collections import Counter
+from threading import Lock
+from typing import Any, Dict, Optional
+import asyncio
+import time
+
+from loguru import logger
+
+
+class SpeculationBudget:
+    """Token bucket of speculative web searches, with counters of speculation outcomes."""
+
+    def __init__(self, per_minute: float = 10.0):
+        """
+        Args:
+            per_minute: Speculative web searches allowed per minute, and burst size.
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.counters: Counter = Counter()
+        self.lock = Lock()
+
+    def try_spend(self) -> bool:
+        """Take a token for a speculative web search, if there is one left."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.counters["web_search_over_budget"] += 1
+                return False
+            self.tokens -= 1
+            self.counters["web_search_speculated"] += 1
+            return True
+
+    def record(self, event: str) -> None:
+        with self.lock:
+            self.counters[event] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {**self.counters, "web_search_tokens": round(self.tokens, 2)}
+
+
+def ignore_task_errors(task: asyncio.Task) -> None:
+    """Retrieve the exception of a speculative task whose result may never be awaited."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Speculative task failed: {task.exception()}")
+
+
+class Speculation:
+    """The speculative retrieval and web search tasks of one question."""
+
+    def __init__(
+        self,
+        retrieval: Optional[asyncio.Task],
+        web_search: Optional[asyncio.Task],
+        budget: SpeculationBudget,
+    ):
+        self.retrieval = retrieval
+        self.web_search = web_search
+        self.budget = budget
+        for task in (retrieval, web_search):
+            if task is not None:
+                task.add_done_callback(ignore_task_errors)
+
+    async def take(self, name: str) -> Optional[Any]:
+        """Await the result of a speculative task, once; None if there is none or it failed."""
+        task = getattr(self, name)
+        if task is None:
+            return None
+        setattr(self, name, None)
+        try:
+            # Shielded, so a cancelled node does not look like a cancelled speculation.
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                task.cancel()
+                raise
+            return None
+        except Exception as error:
+            logger.warning(f"Speculative {name} failed, running it again: {error}")
+            return None
+        self.budget.record(f"{name}_used")
+        return result
+
+    async def take_retrieval(self) -> Optional[Any]:
+        return await self.take("retrieval")
+
+    async def take_web_search(self) -> Optional[Any]:
+        return await self.take("web_search")
+
+    def cancel(self, name: str) -> None:
+        """Discard a speculative task that turned out not to be needed."""
+        task = getattr(self, name)
+        if task is None:
+            return
+        setattr(self, name, None)
+        if not task.done():
+            task.cancel()
+        self.budget.record(f"{name}_discarded")
+
+    def cancel_all(self) -> None:
+        self.cancel("retrieval")
+        self.cancel("web_search")
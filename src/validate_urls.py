@@ -1,40 +1,48 @@
-""" Processes a list of visited URLs and identifies external URLs that are redirects.
-
-The main functionality is provided by the script itself, which:
-1. Reads a list of visited URLs from a JSON file named "data/visited_urls_edited.json".
-2. For each URL in the list, it checks if the URL is valid using the `is_url_valid()` 
-    function from the `smart_scraper` module.
-3. If the URL is valid and is a redirect (determined using the `is_url_redirect()` 
-    function from the `smart_scraper` module), the redirect URL is added to the 
-    `external_urls` dictionary.
-4. If the URL is not valid, the script attempts to remove the topic from the URL 
-    (using the `remove_topic_from_url()` function) and checks if the resulting URL 
-    is valid.
-5. If the URL without the topic is valid, it replaces the original URL in the 
-    `visited_urls` dictionary.
-6. If the URL without the topic is a redirect, the redirect URL is added to the 
-    `external_urls` dictionary.
-
-The module uses the `requests` library to check if a URL is a redirect and to get 
-the redirect URL.
-
-The `remove_topic_from_url()` function is a utility function that removes the topic 
-from a URL. It replaces "sf.gov/topics/" with "sf.gov/" in the URL.
+""" Validates a list of visited URLs and identifies the ones that are redirects.
+
+The main functionality is provided by the `validate_urls()` function, which:
+1. Reads a list of visited URLs from a JSON file ("data/visited_urls_edited.json").
+2. Checks every URL with a single HEAD request (following redirects), concurrently with
+    at most `max_workers` requests in flight over one shared session.
+3. If a URL is invalid (a 404, 410 or other client error), checks the URL with the
+    topic removed (using the `remove_topic_from_url()` function) and, if that one is
+    valid, replaces the original URL with it, keeping its description.
+4. Records the final URL of every valid URL that is a redirect in a redirect table.
+5. Writes the corrected URL map ("data/visited_urls_validated.json"), the redirect
+    table ("data/redirects.json", original URL -> redirect target) and the URLs that
+    could not be checked ("data/unreachable_urls.json").
 
-The script relies on the `is_url_valid()` and `is_url_redirect()` functions from the 
-`smart_scraper` module to check the validity and redirect status of URLs.
+Only URLs that are still invalid after removing the topic are dropped from the corrected
+map. URLs whose check failed (network error, timeout, 429 or server error) are checked
+again up to `retries` times and, if they still fail, kept in the corrected map and
+reported separately, since nothing says they are invalid. All HEAD requests go through
+the shared `HTTPCache`, so a URL's validity and redirect target are checked once and
+reused by later runs and by the scrapers.
+
+The `remove_topic_from_url()` function is a utility function that removes the topic
+from a URL. It replaces "sf.gov/topics/" with "sf.gov/" in the URL.
 
-To use this module, ensure that the required dependencies are installed and that the 
-"data/visited_urls_edited.json" file exists with the list of visited URLs. 
-The script will process the URLs and update the `visited_urls` dictionary with valid 
-URLs and add redirect URLs to the `external_urls` dictionary.
+Example usage (from the repository root):
+```bash
+python src/validate_urls.py --workers 32
+```
 """
 
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Tuple
 import json
-import requests
+import time
 
+import requests
 from loguru import logger
-from smart_scraper import is_url_valid, is_url_redirect
+
+from http_cache import HeadResult, get_http_cache
+
+INPUT_PATH = "data/visited_urls_edited.json"
+OUTPUT_PATH = "data/visited_urls_validated.json"
+REDIRECTS_PATH = "data/redirects.json"
+UNREACHABLE_PATH = "data/unreachable_urls.json"
 
 
 def remove_topic_from_url(url: str) -> str:
@@ -49,24 +57,103 @@ def remove_topic_from_url(url: str) -> str:
     return url.replace("sf.gov/topics/", "sf.gov/")
 
 
-with open("data/visited_urls_edited.json", "r") as f:
-    visited_urls = json.load(f)
-
-external_urls = {}
-
-url_count = len(visited_urls)
-for i, url in enumerate(visited_urls):
-    logger.info(f"{i}/{url_count}: Checking {url}")
-    if is_url_valid(url):
-        if is_url_redirect(url):
-            redirected_url = requests.head(url, allow_redirects=True, verify=False).url
-            external_urls[redirected_url] = ""
-    else:
-        possible_url = remove_topic_from_url(url)
-        if is_url_valid(possible_url):
-            visited_urls[possible_url] = visited_urls.pop(url)
-            if is_url_redirect(possible_url):
-                redirected_url = requests.head(
-                    possible_url, allow_redirects=True, verify=False
-                ).url
-                external_urls[redirected_url] = ""
+def head_with_retries(url: str, session: requests.Session, retries: int = 2) -> HeadResult:
+    """HEAD a URL, checking it again after a failure that does not say it is invalid."""
+    http_cache = get_http_cache()
+    head = http_cache.head(url, session=session)
+    for attempt in range(retries):
+        if head.definite:
+            break
+        time.sleep(2**attempt)
+        head = http_cache.head(url, session=session)
+    return head
+
+
+def check_url(url: str, session: requests.Session, retries: int = 2) -> HeadResult:
+    """Find the valid variant of a URL, with one HEAD request per candidate.
+
+    Returns:
+        The HEAD result of the URL, or of the URL without its topic if the URL is
+        invalid and that one is not.
+    """
+    head = head_with_retries(url, session, retries)
+    possible_url = remove_topic_from_url(url)
+    if not head.invalid or possible_url == url:
+        return head
+    possible_head = head_with_retries(possible_url, session, retries)
+    return head if possible_head.invalid else possible_head
+
+
+def validate_urls(
+    visited_urls: Dict[str, Any], max_workers: int = 16, retries: int = 2
+) -> Tuple[Dict[str, Any], Dict[str, str], Dict[str, Any]]:
+    """Validate all URLs concurrently.
+
+    Args:
+        visited_urls: The URL -> description map to validate.
+        max_workers: Maximum number of concurrent HEAD requests.
+        retries: Number of times a URL whose check failed is checked again.
+
+    Returns:
+        The corrected URL -> description map, in the original order, the redirect
+        table (URL -> redirect target) of its URLs, and the URL -> description map of
+        the URLs that could not be checked (kept in the corrected map).
+    """
+    start = time.perf_counter()
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            heads = list(
+                executor.map(lambda url: check_url(url, session, retries), visited_urls)
+            )
+
+    validated_urls, redirects, unreachable_urls = {}, {}, {}
+    for (url, description), head in zip(visited_urls.items(), heads):
+        if head.invalid:
+            logger.warning(f"Dropping invalid URL {url} ({head.status})")
+            continue
+        if not head.ok:
+            logger.warning(f"Keeping {head.url}, which could not be checked ({head.status})")
+            unreachable_urls[head.url] = description
+        if head.url != url:
+            logger.info(f"Replacing {url} with {head.url}")
+        validated_urls[head.url] = description
+        if head.redirected:
+            redirects[head.url] = head.final_url
+
+    logger.info(
+        f"Validated {len(visited_urls)} URLs in {time.perf_counter() - start:.1f}s: "
+        f"{len(validated_urls) - len(unreachable_urls)} valid, {len(redirects)} redirects, "
+        f"{len(unreachable_urls)} unreachable, "
+        f"{len(visited_urls) - len(validated_urls)} dropped"
+    )
+    return validated_urls, redirects, unreachable_urls
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input", type=str, default=INPUT_PATH)
+    parser.add_argument("--output", type=str, default=OUTPUT_PATH)
+    parser.add_argument("--redirects", type=str, default=REDIRECTS_PATH)
+    parser.add_argument("--unreachable", type=str, default=UNREACHABLE_PATH)
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent HEAD requests.")
+    parser.add_argument("--retries", type=int, default=2, help="Checks of failed URLs.")
+    args = parser.parse_args()
+
+    with open(args.input, "r") as f:
+        visited_urls = json.load(f)
+
+    validated_urls, redirects, unreachable_urls = validate_urls(
+        visited_urls, max_workers=args.workers, retries=args.retries
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(validated_urls, f, indent=2)
+    with open(args.redirects, "w") as f:
+        json.dump(redirects, f, indent=2)
+    with open(args.unreachable, "w") as f:
+        json.dump(unreachable_urls, f, indent=2)
@@ -1,9 +1,22 @@
-""" Tools for traditional web scraping using BeautifulSoup."""
+""" Tools for traditional web scraping using BeautifulSoup.
+
+Pages are fetched through the shared on-disk `HTTPCache`, so repeated runs revalidate
+them with cheap 304 responses instead of downloading them again.
+
+Links and text are pulled out of pages in a single pass with `html_extract.extract_page()`,
+without building a BeautifulSoup tree. The parser backend (of both the extractor and
+`parse_html()`) is set by the HTML_PARSER environment variable: "auto" (lxml if
+installed, else html.parser), "lxml", "html.parser" or "html5lib".
+
+Run as a script to list the topic pages of sf.gov:
+```bash
+python src/web_scraper.py
+```
+"""
 
 from functools import wraps
-from typing import Any, Callable, TypeVar
-from urllib.parse import urljoin, urlparse, urlunparse
-import requests
+from typing import Any, Callable, Optional, TypeVar
+from urllib.parse import urlparse, urlunparse
 import time
 
 from bs4 import BeautifulSoup as Soup
@@ -11,13 +24,16 @@ from dotenv import find_dotenv, load_dotenv
 from loguru import logger
 from langchain_community.document_loaders.recursive_url_loader import RecursiveUrlLoader
 
+from html_extract import extract_page, extract_text, get_backend
+from http_cache import CachedResponse, get_http_cache
+
 load_dotenv(find_dotenv())
 
 # Type variable for generic type hinting.
 T = TypeVar("T")
 
 # HTML parser used by BeautifulSoup.
-HTML_PARSER = "html5lib"
+HTML_PARSER = get_backend()
 
 
 def retry_with_exponential_backoff(
@@ -78,10 +94,11 @@ def retry_with_exponential_backoff(
 # BaseIngestor.retry_with_exponential_backoff(
 #    max_retries=3, initial_delay=1.0, backoff_factor=2.0
 # )
-def make_request(url: str, timeout: float = 10.0) -> requests.Response:
+def make_request(url: str, timeout: float = 10.0) -> CachedResponse:
     """Make an HTTP request with retry and delay.
 
-    This function makes an HTTP GET request to the specified URL.
+    This function makes an HTTP GET request to the specified URL, through the HTTP
+    cache: a page fetched before is only downloaded again if it changed.
 
     Args:
         url: The URL to where the request is made.
@@ -93,7 +110,7 @@ def make_request(url: str, timeout: float = 10.0) -> requests.Response:
     Raises:
         requests.exceptions.RequestException: If the request fails after all retries.
     """
-    response = requests.get(url, timeout=timeout)
+    response = get_http_cache().get(url, timeout=timeout)
     response.raise_for_status()
     return response
 
@@ -101,7 +118,8 @@ def make_request(url: str, timeout: float = 10.0) -> requests.Response:
 def parse_html(html: str) -> Soup:
     """Parse HTML content using BeautifulSoup.
 
-    Uses the 'html5lib' parser to parse the HTML content.
+    Uses the `HTML_PARSER` parser to parse the HTML content. Prefer `extract_page()`
+    when only the links or the text of the page are needed.
 
     Args:
         html: The HTML content to parse.
@@ -112,11 +130,12 @@ def parse_html(html: str) -> Soup:
     return Soup(markup=html, features=HTML_PARSER)
 
 
-def get_base_url(soup: Soup) -> str:
+def get_base_url(soup: Soup, url: str) -> str:
     """Extract the base URL from a BeautifulSoup object.
 
     Args:
         soup: The BeautifulSoup object representing the parsed HTML content.
+        url: The URL of the page, used when it has no base tag.
 
     Returns:
         The base URL.
@@ -132,46 +151,28 @@ def get_base_url(soup: Soup) -> str:
     return base_url if isinstance(base_url, str) else base_url[0]
 
 
-url = "https://www.sf.gov"
-parsed_url = urlparse(url)
-base_url = urlunparse((parsed_url.scheme, parsed_url.netloc, "", "", "", ""))
-
-loader = RecursiveUrlLoader(
-    url=url, max_depth=2, extractor=lambda x: Soup(x, "html.parser").text
-)
+def get_relative_links(url: str, link_class: Optional[str] = None) -> list[str]:
+    """Get the absolute URLs of the links of a page.
 
+    Args:
+        url: The URL of the page.
+        link_class: Only return the links of anchors with this class.
 
-def get_relative_links(url: str) -> list[str]:
+    Returns:
+        The link URLs, in page order.
+    """
     response = make_request(url)
     if response.status_code != 200:
         logger.error(f"Failed to download {url}. Status code: {response.status_code}")
         return []
+    return extract_page(response.text, url, link_class=link_class).links
 
-    soup = parse_html(response.text)
-    base_url = get_base_url(soup)
-
-    urls = []
-    links = soup.find_all("a", href=True)
-    for link in links:
-        href = link.get("href")
-        if href:
-            urls.append(urljoin(base_url, href))
-    return urls
-
-
-response = make_request(url)
-if response.status_code != 200:
-    logger.error(f"Failed to download {url}. Status code: {response.status_code}")
-
-soup = parse_html(response.text)
 
-base_url = get_base_url(soup)
+if __name__ == "__main__":
+    url = "https://www.sf.gov"
+    loader = RecursiveUrlLoader(url=url, max_depth=2, extractor=extract_text)
 
-urls = []
-links = soup.find_all("a", class_="sfgov-topic-card")
-for link in links:
-    href = link.get("href")
-    if href:
-        urls.append(urljoin(base_url, href))
+    urls = get_relative_links(url, link_class="sfgov-topic-card")
+    logger.info(f"Found {len(urls)} topic pages: {urls}")
 
-model_id = "meta-llama/Meta-Llama-3-8B"
+    model_id = "meta-llama/Meta-Llama-3-8B"
@@ -0,0 +1,34 @@
+import pytest
+
+from html_extract import etree, extract_page
+
+BACKENDS = ["html.parser", pytest.param(
+    "lxml", marks=pytest.mark.skipif(etree is None, reason="lxml is not installed")
+)]
+
+# Pages with their expected main content.
+MAIN_TEXT_CASES = {
+    "article header": (
+        "<html><body><header><a href='/'>SF.gov</a></header><main><article><header>"
+        "<h1>Residential Parking Permits</h1></header><p>Apply online.</p></article></main>"
+        "<footer>City and County of San Francisco</footer></body></html>",
+        "Residential Parking Permits\nApply online.",
+    ),
+    "section header and footer": (
+        "<body><header>Menu</header><section><header><h2>Fees</h2></header><p>$170 a year."
+        "</p><footer>Last updated May 1</footer></section><footer>Footer</footer></body>",
+        "Fees\n$170 a year.\nLast updated May 1",
+    ),
+    "role main": (
+        "<body><nav>Topics</nav><div role='main'><header><h1>Slow Streets</h1></header>"
+        "<p>Request a slow street.</p><aside>Related</aside></div></body>",
+        "Slow Streets\nRequest a slow street.",
+    ),
+}
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("html, expected", MAIN_TEXT_CASES.values(), ids=MAIN_TEXT_CASES)
+def test_main_text(backend, html, expected):
+    page = extract_page(html, "https://www.sf.gov/", backend=backend)
+    assert page.main_text == expected